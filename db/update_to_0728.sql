@@ -0,0 +1,135 @@
+CREATE TABLE `cache_generations` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(64) COLLATE utf8_unicode_ci NOT NULL,
+  `generation` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+INSERT INTO `cache_generations` (`name`, `generation`) VALUES ('fates', 1);
+
+CREATE TABLE `outbox` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `kind` varchar(16) COLLATE utf8_unicode_ci NOT NULL,
+  `payload` text COLLATE utf8_unicode_ci NOT NULL,
+  `creation_time` datetime NOT NULL,
+  `attempts` int(11) NOT NULL DEFAULT '0',
+  `sent_time` datetime DEFAULT NULL,
+  `last_error` text COLLATE utf8_unicode_ci,
+  PRIMARY KEY (`id`),
+  KEY `outbox_idx` (`sent_time`,`attempts`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+CREATE INDEX `event_timestamp_idx` ON `events` (`timestamp`, `id`);
+
+ALTER TABLE `events` ADD INDEX `event_host_time_idx` (`host_id`, `timestamp`);
+ALTER TABLE `events` ADD INDEX `event_type_time_idx` (`event_type_id`, `timestamp`);
+ALTER TABLE `events` DROP INDEX `event_idx`;
+ALTER TABLE `events` DROP INDEX `ix_events_host_id`;
+ALTER TABLE `events` DROP INDEX `ix_events_event_type_id`;
+
+ALTER TABLE `labors` ADD INDEX `labor_host_completion_idx` (`host_id`, `completion_time`);
+ALTER TABLE `labors` ADD INDEX `labor_quest_completion_idx` (`quest_id`, `completion_event_id`);
+ALTER TABLE `labors` DROP INDEX `labor_idx`;
+ALTER TABLE `labors` DROP INDEX `ix_labors_host_id`;
+ALTER TABLE `labors` DROP INDEX `ix_labors_quest_id`;
+
+CREATE TABLE `event_batches` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `creation_time` datetime NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+-- Start allocating transaction ids above the ones already in use
+INSERT INTO `event_batches` (`id`, `creation_time`)
+  SELECT COALESCE(MAX(`tx`), 0) + 1, UTC_TIMESTAMP() FROM `events`;
+
+CREATE TABLE `archived_events` (
+  `id` int(11) NOT NULL,
+  `host_id` int(11) NOT NULL,
+  `timestamp` datetime NOT NULL,
+  `user` varchar(64) COLLATE utf8_unicode_ci NOT NULL,
+  `event_type_id` int(11) NOT NULL,
+  `note` text COLLATE utf8_unicode_ci,
+  `tx` bigint(20) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `archived_event_host_time_idx` (`host_id`, `timestamp`),
+  KEY `archived_event_type_time_idx` (`event_type_id`, `timestamp`),
+  KEY `archived_event_timestamp_idx` (`timestamp`, `id`),
+  CONSTRAINT `archived_events_ibfk_1` FOREIGN KEY (`host_id`) REFERENCES `hosts` (`id`),
+  CONSTRAINT `archived_events_ibfk_2` FOREIGN KEY (`event_type_id`) REFERENCES `event_types` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci ROW_FORMAT=COMPRESSED;
+
+CREATE TABLE `host_states` (
+  `host_id` int(11) NOT NULL,
+  `category` varchar(64) COLLATE utf8_unicode_ci NOT NULL,
+  `state` varchar(32) COLLATE utf8_unicode_ci NOT NULL,
+  `event_type_id` int(11) NOT NULL,
+  `event_id` int(11) NOT NULL,
+  `timestamp` datetime NOT NULL,
+  PRIMARY KEY (`host_id`, `category`),
+  CONSTRAINT `host_states_ibfk_1` FOREIGN KEY (`host_id`) REFERENCES `hosts` (`id`),
+  CONSTRAINT `host_states_ibfk_2` FOREIGN KEY (`event_type_id`) REFERENCES `event_types` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+-- Seed the states from the latest event of each host and category
+INSERT INTO `host_states`
+  (`host_id`, `category`, `state`, `event_type_id`, `event_id`, `timestamp`)
+  SELECT e.`host_id`, t.`category`, t.`state`, e.`event_type_id`, e.`id`, e.`timestamp`
+  FROM `events` e
+  JOIN `event_types` t ON t.`id` = e.`event_type_id`
+  JOIN (
+    SELECT le.`host_id`, lt.`category`, MAX(le.`id`) AS `event_id`
+    FROM `events` le
+    JOIN `event_types` lt ON lt.`id` = le.`event_type_id`
+    GROUP BY le.`host_id`, lt.`category`
+  ) latest ON latest.`event_id` = e.`id`;
+
+ALTER TABLE `quests`
+  ADD COLUMN `labor_count` int(11) NOT NULL DEFAULT 0,
+  ADD COLUMN `closed_labor_count` int(11) NOT NULL DEFAULT 0,
+  ADD COLUMN `starting_labor_count` int(11) NOT NULL DEFAULT 0,
+  ADD COLUMN `unstarted_labor_count` int(11) NOT NULL DEFAULT 0,
+  ADD COLUMN `inprogress_labor_count` int(11) NOT NULL DEFAULT 0,
+  ADD KEY `quest_completion_idx` (`completion_time`);
+
+-- Seed the progress counters from the labors of each quest
+UPDATE `quests` q
+  JOIN (
+    SELECT `quest_id`,
+      COUNT(*) AS `labor_count`,
+      SUM(`completion_event_id` IS NOT NULL) AS `closed_labor_count`,
+      SUM(`starting_labor_id` IS NULL) AS `starting_labor_count`,
+      SUM(`starting_labor_id` IS NULL AND `completion_event_id` IS NULL) AS `unstarted_labor_count`,
+      SUM(`starting_labor_id` IS NOT NULL AND `completion_event_id` IS NULL) AS `inprogress_labor_count`
+    FROM `labors`
+    WHERE `quest_id` IS NOT NULL
+    GROUP BY `quest_id`
+  ) l ON l.`quest_id` = q.`id`
+  SET q.`labor_count` = l.`labor_count`,
+    q.`closed_labor_count` = l.`closed_labor_count`,
+    q.`starting_labor_count` = l.`starting_labor_count`,
+    q.`unstarted_labor_count` = l.`unstarted_labor_count`,
+    q.`inprogress_labor_count` = l.`inprogress_labor_count`;
+
+CREATE TABLE `quest_jobs` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `status` varchar(16) COLLATE utf8_unicode_ci NOT NULL,
+  `creator` varchar(64) COLLATE utf8_unicode_ci NOT NULL,
+  `fate_id` int(11) NOT NULL,
+  `description` varchar(4096) COLLATE utf8_unicode_ci NOT NULL,
+  `target_time` datetime DEFAULT NULL,
+  `quest_id` int(11) DEFAULT NULL,
+  `host_count` int(11) NOT NULL,
+  `hosts_processed` int(11) NOT NULL,
+  `labors_created` int(11) NOT NULL,
+  `error` text COLLATE utf8_unicode_ci,
+  `creation_time` datetime NOT NULL,
+  `update_time` datetime NOT NULL,
+  `completion_time` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  CONSTRAINT `quest_jobs_ibfk_1` FOREIGN KEY (`fate_id`) REFERENCES `fates` (`id`),
+  CONSTRAINT `quest_jobs_ibfk_2` FOREIGN KEY (`quest_id`) REFERENCES `quests` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+ALTER TABLE `labors` ADD INDEX `labor_host_quest_idx` (`host_id`, `quest_id`);
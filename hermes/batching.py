@@ -0,0 +1,169 @@
+from datetime import timedelta
+import logging
+import Queue
+import threading
+
+from sqlalchemy.exc import IntegrityError
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from . import exc
+from .models import Event, EventBatch
+
+
+log = logging.getLogger(__name__)
+
+
+def split_by_host(items, host_id=lambda item: item["host_id"]):
+    """Split Events into rounds holding at most one Event per Host.
+
+    The Fates of Events created together are evaluated together, so a
+    second Event for the same Host has to be created in a later round to
+    see the labors opened or closed by the first one.  Events keep their
+    order within each Host.
+
+    Args:
+        items: the list of Events (or items holding Events)
+        host_id: callable returning the Host id of an item
+
+    Returns:
+        the list of rounds, each a list of items
+    """
+    rounds = []
+    while items:
+        current = []
+        deferred = []
+        host_ids = set()
+        for item in items:
+            if host_id(item) in host_ids:
+                deferred.append(item)
+            else:
+                host_ids.add(host_id(item))
+                current.append(item)
+        rounds.append(current)
+        items = deferred
+
+    return rounds
+
+
+class EventCoalescer(object):
+    """Coalesces single Event creations into batched transactions.
+
+    Events submitted within the batching window are written with a single
+    Event.create_many call and a single evaluation of the Fates.  Since the
+    Fates for a batch are evaluated together, a batch never holds more than
+    one Event for the same Host; any extra Events for a Host are deferred to
+    a follow-up batch so they are applied in the order they arrived.
+
+    The batches are written by a background thread, one after the other,
+    so the IOLoop keeps serving requests while a write waits on locks.
+
+    Args:
+        session_factory: callable returning a new database session
+        window: the batching window in milliseconds
+    """
+    def __init__(self, session_factory, window):
+        self.session_factory = session_factory
+        self.window = window
+        self.pending = []
+        self.timeout = None
+        self.queue = Queue.Queue()
+        self.writer = None
+
+    def submit(self, host_id, user, event_type_id, note=None):
+        """Queue an Event for creation in the next batch
+
+        The Host has to be committed already, since the Event is written by
+        another session.
+
+        Args:
+            host_id: the id of the Host to which this event pertains
+            user: the user that created this event
+            event_type_id: the id of the EventType of this event
+            note: the optional note to be made about this event
+
+        Returns:
+            a Future resolving to the id of the created Event
+        """
+        future = Future()
+        self.pending.append(({
+            "host_id": host_id,
+            "user": user,
+            "event_type_id": event_type_id,
+            "note": note,
+        }, future))
+
+        if self.timeout is None:
+            self.timeout = IOLoop.current().add_timeout(
+                timedelta(milliseconds=self.window), self.flush
+            )
+
+        return future
+
+    def flush(self):
+        """Hand all pending Events to the writer thread"""
+        self.timeout = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        if self.writer is None:
+            self.writer = threading.Thread(
+                target=self._write, name="event-coalescer"
+            )
+            self.writer.daemon = True
+            self.writer.start()
+
+        self.queue.put((IOLoop.current(), pending))
+
+    def _write(self):
+        """Write out the queued Events, forever"""
+        while True:
+            io_loop, pending = self.queue.get()
+            for batch in split_by_host(
+                pending, lambda item: item[0]["host_id"]
+            ):
+                try:
+                    self._write_batch(io_loop, batch)
+                except Exception as err:
+                    log.exception("Error writing coalesced events")
+                    self._fail(io_loop, batch, err)
+
+    def _write_batch(self, io_loop, batch):
+        """Create a batch of Events holding at most one Event per Host
+
+        Args:
+            io_loop: the IOLoop the Futures of the batch belong to
+            batch: list of (Event dict, Future) tuples
+        """
+        events = [dict(event) for event, future in batch]
+
+        session = self.session_factory()
+        try:
+            tx = EventBatch.allocate(session)
+            log.info("EVENTS [{}]: Creating {} coalesced events".format(
+                tx, len(batch)
+            ))
+            event_ids = Event.create_many(session, events, tx)
+        except IntegrityError as err:
+            session.rollback()
+            self._fail(io_loop, batch, exc.Conflict(err.orig.message))
+            return
+        except exc.ValidationError as err:
+            session.rollback()
+            self._fail(io_loop, batch, exc.BadRequest(err.message))
+            return
+        except Exception as err:
+            session.rollback()
+            self._fail(io_loop, batch, err)
+            return
+        finally:
+            session.close()
+
+        for (event, future), event_id in zip(batch, event_ids):
+            io_loop.add_callback(future.set_result, event_id)
+
+    def _fail(self, io_loop, batch, error):
+        log.error("Failed to create coalesced events: {}".format(error))
+        for event, future in batch:
+            io_loop.add_callback(future.set_exception, error)
@@ -9,6 +9,9 @@ class ModelError(Error):
 class ValidationError(ModelError):
     """ Raised when validation fails on a model."""
 
+class ConcurrencyError(ModelError):
+    """ Raised when a concurrent change keeps a model from being updated."""
+
 class BaseHttpError(HTTPError):
     def __init__(self, log_message, *args, **kwargs):
         HTTPError.__init__(
@@ -0,0 +1,280 @@
+from datetime import datetime, timedelta
+import logging
+
+from sqlalchemy import func
+from tornado.concurrent import Future
+from tornado.ioloop import PeriodicCallback
+
+from .models import Event, Labor, Quest
+
+
+log = logging.getLogger(__name__)
+
+
+def latest_event_id(session):
+    """Get the id of the most recent Event
+
+    Args:
+        session: an active database session
+
+    Returns:
+        the highest Event id, or 0 if there are no Events
+    """
+    return session.query(func.max(Event.id)).scalar() or 0
+
+
+def get_changes(session, after_event_id, limit=1000, grace=30):
+    """Get the changes committed after an Event
+
+    Every change in Hermes is caused by an Event: creating it may close
+    and open Labors, and closing the last open Labor of a Quest completes
+    the Quest.  So the id of the last Event seen is all a client needs to
+    pick up where it left off.
+
+    Each change is a dict holding its type (eventCreated, laborClosed,
+    laborOpened or questCompleted), the changed resource and the eventId,
+    hostId, eventTypeId and questIds of the Event that caused it, which is
+    what the changes are filtered on.
+
+    Event ids are allocated when the Events are inserted, not when they are
+    committed, so a gap in the ids may be a transaction that hasn't
+    committed yet.  We stop at a gap until the Events after it are grace
+    seconds old; by then the gap is taken to be a rolled back transaction.
+
+    Args:
+        session: an active database session
+        after_event_id: the id of the last Event already seen
+        limit: the maximum number of Events to look at
+        grace: the number of seconds to wait for the Events of a gap in the
+            ids to be committed
+
+    Returns:
+        tuple of the list of changes, in the order they were committed, and
+        the id of the last Event looked at
+    """
+    events = (
+        session.query(Event).filter(Event.id > after_event_id)
+        .order_by(Event.id).limit(limit).all()
+    )
+
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    expected_id = after_event_id + 1
+    for index, event in enumerate(events):
+        if event.id != expected_id and event.timestamp > cutoff:
+            events = events[:index]
+            break
+        expected_id = event.id + 1
+
+    if not events:
+        return [], after_event_id
+
+    event_ids = [event.id for event in events]
+
+    opened = (
+        session.query(Labor).filter(Labor.creation_event_id.in_(event_ids))
+        .order_by(Labor.id).all()
+    )
+    closed = (
+        session.query(Labor).filter(Labor.completion_event_id.in_(event_ids))
+        .order_by(Labor.id).all()
+    )
+
+    # A Quest was completed by an Event if that Event closed the last
+    # of its Labors
+    completed = {}
+    quest_ids = set(labor.quest_id for labor in closed if labor.quest_id)
+    if quest_ids:
+        progress = (
+            session.query(
+                Labor.quest_id, func.max(Labor.completion_event_id),
+                func.count(Labor.id) - func.count(Labor.completion_event_id)
+            )
+            .filter(Labor.quest_id.in_(quest_ids))
+            .group_by(Labor.quest_id).all()
+        )
+        completing_events = dict(
+            (quest_id, event_id)
+            for quest_id, event_id, open_labors in progress
+            if open_labors == 0
+        )
+        for quest in session.query(Quest).filter(
+            Quest.id.in_(completing_events.keys()),
+            Quest.completion_time != None
+        ):
+            completed.setdefault(
+                completing_events[quest.id], []
+            ).append(quest)
+
+    labors_by_event = {}
+    for labor in closed:
+        labors_by_event.setdefault(
+            labor.completion_event_id, []
+        ).append(("laborClosed", labor))
+    for labor in opened:
+        labors_by_event.setdefault(
+            labor.creation_event_id, []
+        ).append(("laborOpened", labor))
+
+    changes = []
+    for event in events:
+        labors = labors_by_event.get(event.id, [])
+        quests = completed.get(event.id, [])
+        cause = {
+            "eventId": event.id,
+            "hostId": event.host_id,
+            "eventTypeId": event.event_type_id,
+            "questIds": sorted(set(
+                labor.quest_id for change_type, labor in labors
+                if labor.quest_id
+            )),
+        }
+
+        changes.append(dict(cause, type="eventCreated", event=event.to_dict()))
+        for change_type, labor in labors:
+            changes.append(dict(cause, type=change_type, labor=labor.to_dict()))
+        for quest in quests:
+            changes.append(dict(cause, type="questCompleted", quest=quest.to_dict()))
+
+    return changes, event_ids[-1]
+
+
+class ChangeFilter(object):
+    """Server side filter of changes.
+
+    A change matches if it was caused by an Event matching each of the
+    given criteria.  Criteria left empty match everything.
+
+    Args:
+        quest_ids: the ids of the Quests of interest
+        host_ids: the ids of the Hosts of interest
+        event_type_ids: the ids of the EventTypes of interest
+    """
+    def __init__(self, quest_ids=None, host_ids=None, event_type_ids=None):
+        self.quest_ids = set(quest_ids or [])
+        self.host_ids = set(host_ids or [])
+        self.event_type_ids = set(event_type_ids or [])
+
+    def matches(self, change):
+        if self.quest_ids and self.quest_ids.isdisjoint(change["questIds"]):
+            return False
+        if self.host_ids and change["hostId"] not in self.host_ids:
+            return False
+        if self.event_type_ids and (
+            change["eventTypeId"] not in self.event_type_ids
+        ):
+            return False
+        return True
+
+    def apply(self, changes):
+        return [change for change in changes if self.matches(change)]
+
+
+class ChangeFeed(object):
+    """Publishes the changes committed by any Hermes process.
+
+    Changes can be committed by any of the server processes (or by the
+    command line tools), so the feed polls the database for new Events
+    every interval milliseconds.  It only does so while someone is
+    listening, and the listeners of a process share a single poll.
+
+    Event ids are allocated when the Events are inserted, so the feed holds
+    back at a gap in the ids for up to grace seconds, in case a transaction
+    holding lower Event ids commits after one holding higher ones.  A
+    rolled back insert leaves a gap for good, so it delays every listener
+    by up to grace seconds.
+
+    Args:
+        session_factory: callable returning a new database session
+        interval: the number of milliseconds between polls
+        batch_size: the maximum number of Events to look at in one poll
+        grace: the number of seconds to wait for the Events of a gap in the
+            ids to be committed
+    """
+    def __init__(self, session_factory, interval, batch_size=1000, grace=30):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.grace = grace
+        self.last_event_id = None
+        self.subscribers = set()
+        self.waiters = []
+        self.periodic = None
+
+    def subscribe(self, callback):
+        """Call back with each list of new changes
+
+        Args:
+            callback: callable taking the list of changes
+        """
+        self.subscribers.add(callback)
+        self._start()
+
+    def unsubscribe(self, callback):
+        self.subscribers.discard(callback)
+
+    def wait(self):
+        """Wait for new changes
+
+        Returns:
+            a Future resolving to the id of the last Event looked at, once
+            there are new changes
+        """
+        future = Future()
+        self.waiters.append(future)
+        self._start()
+        return future
+
+    def cancel(self, future):
+        """Stop waiting on a Future returned by wait"""
+        if future in self.waiters:
+            self.waiters.remove(future)
+
+    def _start(self):
+        if self.periodic is not None:
+            return
+
+        if self.last_event_id is None:
+            session = self.session_factory()
+            try:
+                self.last_event_id = latest_event_id(session)
+            finally:
+                session.close()
+
+        self.periodic = PeriodicCallback(self.poll, self.interval)
+        self.periodic.start()
+
+    def _stop(self):
+        self.periodic.stop()
+        self.periodic = None
+        # Listeners arriving later want the changes from then on
+        self.last_event_id = None
+
+    def poll(self):
+        """Look for new changes and hand them to the listeners"""
+        if not self.subscribers and not self.waiters:
+            self._stop()
+            return
+
+        session = self.session_factory()
+        try:
+            changes, self.last_event_id = get_changes(
+                session, self.last_event_id, self.batch_size, self.grace
+            )
+        except Exception:
+            log.exception("Error polling for changes")
+            return
+        finally:
+            session.close()
+
+        if not changes:
+            return
+
+        waiters, self.waiters = self.waiters, []
+        for future in waiters:
+            future.set_result(self.last_event_id)
+
+        for callback in list(self.subscribers):
+            try:
+                callback(changes)
+            except Exception:
+                log.exception("Error publishing changes")
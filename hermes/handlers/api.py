@@ -1,24 +1,34 @@
 from __future__ import division
 
 
-from datetime import datetime
+import base64
+from datetime import datetime, timedelta
 from dateutil import parser, tz
 import json
 import logging
 import pytz
-import random
 import re
 import sqlalchemy
-from sqlalchemy import desc, or_, and_
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import desc, or_, and_, select, func, exists
+from sqlalchemy.orm import aliased, subqueryload
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 import string
-import time
-
-
-from .util import ApiHandler
-from ..util import id_generator, PluginHelper, email_message
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.web import stream_request_body
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from werkzeug.http import parse_options_header
+
+
+from .util import ApiHandler, BaseHandler, API_VER
+from ..batching import EventCoalescer, split_by_host
+from ..feed import ChangeFeed, ChangeFilter, get_changes, latest_event_id
+from ..jobs import QuestJobRunner
+from ..util import id_generator, PluginHelper
 from .. import exc
-from ..models import Host, EventType, Event, Labor, Fate, Quest
+from ..models import Host, EventType, Event, EventBatch, Labor, Fate, Quest
+from ..models import ArchivedEvent, HostState, QuestJob
+from ..models import notify_email
 from ..settings import settings
 
 
@@ -26,6 +36,88 @@ log = logging.getLogger(__name__)
 
 EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
 
+CURSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(timestamp, id):
+    """Build an opaque pagination cursor pointing at an Event
+
+    Args:
+        timestamp: the timestamp of the Event
+        id: the id of the Event
+
+    Returns:
+        the cursor string
+    """
+    return base64.urlsafe_b64encode("{}|{}".format(
+        timestamp.strftime(CURSOR_TIME_FORMAT), id
+    ))
+
+
+def decode_cursor(cursor):
+    """Parse a pagination cursor built by encode_cursor
+
+    Args:
+        cursor: the cursor string
+
+    Returns:
+        the (timestamp, id) tuple of the Event the cursor points at
+    """
+    try:
+        timestamp, id = base64.urlsafe_b64decode(str(cursor)).split("|")
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+    except (TypeError, ValueError):
+        raise exc.BadRequest("Invalid cursor {}".format(cursor))
+
+
+def get_change_feed(my_settings):
+    """Get the ChangeFeed of this process
+
+    Args:
+        my_settings: the settings of the application
+
+    Returns:
+        the ChangeFeed
+    """
+    if my_settings.get("change_feed") is None:
+        my_settings["change_feed"] = ChangeFeed(
+            my_settings["db_session"],
+            my_settings.get("change_feed_interval", 1000),
+            grace=my_settings.get("change_feed_grace", 30)
+        )
+    return my_settings["change_feed"]
+
+
+def get_change_filter(handler):
+    """Build the ChangeFilter asked for by the arguments of a request
+
+    Args:
+        handler: the handler of the request
+
+    Returns:
+        the ChangeFilter
+    """
+    try:
+        quest_ids = [int(id) for id in handler.get_arguments("questId")]
+        event_type_ids = [
+            int(id) for id in handler.get_arguments("eventTypeId")
+        ]
+    except ValueError:
+        raise exc.BadRequest("questId and eventTypeId must be integers")
+
+    hostnames = set(handler.get_arguments("hostname"))
+    host_ids = []
+    if hostnames:
+        hosts = Host.get_ids(handler.session, hostnames)
+        missing = hostnames - set(hosts)
+        if missing:
+            raise exc.NotFound("No such Host(s) {}".format(
+                ", ".join(sorted(missing))
+            ))
+        host_ids = hosts.values()
+
+    return ChangeFilter(quest_ids, host_ids, event_type_ids)
+
 
 class HostsHandler(ApiHandler):
 
@@ -153,6 +245,94 @@ class HostsHandler(ApiHandler):
             [host["hostname"] for host in hostnames]
         )))
 
+    def put(self):
+        """**Rename many Hosts at once**
+
+        Hosts renamed to the name of an existing Host are merged into it:
+        their Events, Labors and states are moved over and they are deleted.
+        All the renames happen in one transaction.
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            PUT /api/v1/hosts HTTP/1.1
+            Host: localhost
+            Content-Type: application/json
+
+            {
+                "hosts": [
+                    {
+                        "hostname": "server1.old.example.com",
+                        "newHostname": "server1.example.com"
+                    },
+                    ...
+                ]
+            }
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "status": "ok",
+                "hosts": [
+                    {
+                        "hostname": "server1.old.example.com",
+                        "newHostname": "server1.example.com",
+                        "id": 1
+                    },
+                    ...
+                ],
+                "totalHosts": 1
+            }
+
+        :reqjson list hosts: The hostname and newHostname of each Host to rename
+
+        :reqheader Content-Type: The server expects a json body specified with
+                                 this header.
+
+        :statuscode 200: The request was successful.
+        :statuscode 400: The request was malformed or a Host was not found.
+        :statuscode 401: The request was made without being logged in.
+        :statuscode 409: There was a conflict with another resource.
+        """
+        try:
+            renames = dict(
+                (host["hostname"], host["newHostname"])
+                for host in self.jbody["hosts"]
+            )
+        except KeyError as err:
+            raise exc.BadRequest(
+                "Missing Required Argument: {}".format(err.message)
+            )
+        except (TypeError, ValueError) as err:
+            raise exc.BadRequest(err.message)
+
+        log.info("HOSTS: Renaming {} hosts".format(len(renames)))
+
+        try:
+            host_ids = Host.rename_many(self.session, renames)
+        except IntegrityError as err:
+            raise exc.Conflict(err.orig.message)
+        except exc.ValidationError as err:
+            raise exc.BadRequest(err.message)
+
+        self.success({
+            "hosts": [
+                {
+                    "hostname": hostname,
+                    "newHostname": renames[hostname],
+                    "id": host_id,
+                }
+                for hostname, host_id in sorted(host_ids.iteritems())
+            ],
+            "totalHosts": len(host_ids),
+        })
+
     def get(self):
         """**Get all Hosts**
 
@@ -189,6 +369,7 @@ class HostsHandler(ApiHandler):
         :query string hostQuery: (*optional*) the query to send to the plugin to come up with the list of hostnames
         :query int limit: (*optional*) Limit result to N resources.
         :query int offset: (*optional*) Skip the first N resources.
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
 
         :statuscode 200: The request was successful.
         :statuscode 401: The request was made without being logged in.
@@ -216,7 +397,10 @@ class HostsHandler(ApiHandler):
             hosts = hosts.filter(Host.hostname.in_(hostnames))
 
         offset, limit, expand = self.get_pagination_values()
-        hosts, total = self.paginate_query(hosts, offset, limit)
+        hosts, total = self.paginate_query(
+            hosts, offset, limit,
+            filtered=hostname is not None or bool(host_query)
+        )
 
         json = {
             "limit": limit,
@@ -275,76 +459,125 @@ class HostHandler(ApiHandler):
         :statuscode 404: The Host was not found.
         """
         offset, limit, expand = self.get_pagination_values()
-        host = self.session.query(Host).filter_by(hostname=hostname).scalar()
-        if not host:
+
+        # The Host and the time of its last Event in one go; the subquery
+        # is answered from the event_host_time_idx index
+        last_event_time = (
+            select([func.max(Event.timestamp)])
+            .where(Event.host_id == Host.id).as_scalar()
+        )
+        found = self.session.query(Host, last_event_time).filter(
+            Host.hostname == hostname
+        ).first()
+        if not found:
             raise exc.NotFound("No such Host {} found".format(hostname))
+        host, last_event_time = found
 
         json = host.to_dict(self.href_prefix)
         json["limit"] = limit
         json["offset"] = offset
 
-        # add the labors and quests
-        labors = []
-        quests = []
-
         # We will perform labor and quest expansion here b/c we want to apply
-        # limits and offsets
-        for labor in (
-                host.get_labors().limit(limit).offset(offset)
-                .from_self().order_by(Labor.creation_time).all()
-        ):
+        # limits and offsets.  The Quests (and the rest of their relations)
+        # are loaded along with the Labors, and the pages are fetched latest
+        # first and shown oldest first.
+        labors = host.get_labors().limit(limit).offset(offset).all()
+        labors.reverse()
+        events = host.get_latest_events().limit(limit).offset(offset).all()
+        events.reverse()
+        self._prefetch(labors, events, expand)
+
+        json["labors"] = []
+        json["quests"] = []
+        for labor in labors:
             if "labors" in expand:
-                labors.append(
+                json["labors"].append(
                     labor.to_dict(
                         base_uri=self.href_prefix, expand=set(expand)
                     )
                 )
             else:
-                labors.append({
+                json["labors"].append({
                     "id": labor.id, "href": labor.href(self.href_prefix)
                 })
 
             if labor.quest and "quests" in expand:
-                quests.append(
+                json["quests"].append(
                     labor.quest.to_dict(self.href_prefix, expand=set(expand))
                 )
             elif labor.quest:
-                quests.append(
+                json["quests"].append(
                     {
                         "id": labor.quest.id,
                         "href": labor.quest.href(self.href_prefix)
                     }
                 )
-        json["labors"] = labors
-        json["quests"] = quests
 
         # We will perform the events expansion here b/c we want to apply
         # limits and offsets
-        events = []
-        last_event = host.get_latest_events().first()
-        for event in (
-                host.get_latest_events().limit(limit).offset(offset)
-                .from_self().order_by(Event.timestamp).all()
-        ):
+        json["events"] = []
+        for event in events:
             if "events" in expand:
-                events.append(
+                json["events"].append(
                     event.to_dict(
                         base_uri=self.href_prefix, expand=set(expand)
                     )
                 )
             else:
-                events.append({
+                json["events"].append({
                     "id": event.id, "href": event.href(self.href_prefix)
                 })
 
-        if last_event:
-            json["lastEvent"] = str(last_event.timestamp)
+        if last_event_time:
+            json["lastEvent"] = str(last_event_time)
         else:
             json["lastEvent"] = None
-        json["events"] = events
 
         self.success(json)
 
+    def _prefetch(self, labors, events, expand):
+        """Load the collections the expansion of Labors and Events would
+        otherwise lazily load one by one
+
+        Args:
+            labors: the Labors to be expanded
+            events: the Events to be expanded
+            expand: the children to expand
+        """
+        quest_ids = set(labor.quest_id for labor in labors if labor.quest_id)
+        if quest_ids and "quests" in expand and "labors" in expand:
+            quests = self.session.query(Quest).filter(
+                Quest.id.in_(quest_ids)
+            ).options(subqueryload(Quest.labors)).all()
+            labors = labors + [
+                labor for quest in quests for labor in quest.labors
+            ]
+
+        if "fates" not in expand:
+            return
+
+        fate_ids = set(labor.fate_id for labor in labors) | set(
+            labor.closing_fate_id for labor in labors if labor.closing_fate_id
+        )
+        if fate_ids:
+            self.session.query(Fate).filter(
+                Fate.id.in_(fate_ids)
+            ).options(subqueryload(Fate.precedes)).all()
+
+        # Expanded EventTypes list the Fates they create
+        if "eventtypes" in expand:
+            if "events" in expand:
+                events = events + [
+                    event for labor in labors
+                    for event in (labor.creation_event, labor.completion_event)
+                    if event
+                ]
+            event_type_ids = set(event.event_type_id for event in events)
+            if event_type_ids:
+                self.session.query(EventType).filter(
+                    EventType.id.in_(event_type_ids)
+                ).options(subqueryload(EventType.auto_creates)).all()
+
     def put(self, hostname):
         """**Update a Host**
 
@@ -402,7 +635,10 @@ class HostHandler(ApiHandler):
                 "Missing Required Argument: {}".format(err.message)
             )
 
-        host = host.update_name(new_hostname);
+        try:
+            host = host.update_name(new_hostname)
+        except exc.ValidationError as err:
+            raise exc.BadRequest(err.message)
 
         json = host.to_dict(self.href_prefix)
 
@@ -418,6 +654,148 @@ class HostHandler(ApiHandler):
         self.not_supported()
 
 
+class HostStateHandler(ApiHandler):
+    def get(self, hostname):
+        """**Get the latest state of a Host in each EventType category**
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            GET /api/v1/hosts/example/state HTTP/1.1
+            Host: localhost
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "status": "ok",
+                "hostname": "example",
+                "states": [
+                    {
+                        "hostId": 1,
+                        "hostname": "example",
+                        "category": "system-reboot",
+                        "state": "completed",
+                        "eventTypeId": 2,
+                        "eventId": 12,
+                        "timestamp": "2015-05-05 22:13:11",
+                        "href": "/api/v1/hosts/example/state"
+                    },
+                    ...
+                ]
+            }
+
+        :param hostname: hostname of the Host
+        :type hostname: string
+
+        :statuscode 200: The request was successful.
+        :statuscode 401: The request was made without being logged in.
+        :statuscode 404: The Host was not found.
+        """
+        host_id = Host.get_id(self.session, hostname)
+        if host_id is None:
+            raise exc.NotFound("No such Host {} found".format(hostname))
+
+        states = (
+            self.session.query(HostState).filter(HostState.host_id == host_id)
+            .order_by(HostState.category).all()
+        )
+
+        self.success({
+            "hostname": hostname,
+            "states": [state.to_dict(self.href_prefix) for state in states],
+        })
+
+
+class HostStatesHandler(ApiHandler):
+    def get(self):
+        """**Get the latest states of many Hosts**
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            GET /api/v1/hoststates?category=system-reboot&limit=all HTTP/1.1
+            Host: localhost
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "status": "ok",
+                "limit": null,
+                "offset": 0,
+                "totalHostStates": 2,
+                "hostStates": [
+                    {
+                        "hostId": 1,
+                        "hostname": "example",
+                        "category": "system-reboot",
+                        "state": "completed",
+                        "eventTypeId": 2,
+                        "eventId": 12,
+                        "timestamp": "2015-05-05 22:13:11",
+                        "href": "/api/v1/hosts/example/state"
+                    },
+                    ...
+                ]
+            }
+
+        :query string hostname: (*optional/multiple*) Only the states of these Hosts.
+        :query string category: (*optional/multiple*) Only the states in these categories.
+        :query string state: (*optional/multiple*) Only the Hosts in these states.
+        :query int limit: (*optional*) Limit result to N resources.
+        :query int offset: (*optional*) Skip the first N resources.
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
+
+        :statuscode 200: The request was successful.
+        :statuscode 401: The request was made without being logged in.
+        """
+        hostnames = self.get_arguments("hostname")
+        categories = self.get_arguments("category")
+        states = self.get_arguments("state")
+
+        host_states = self.session.query(HostState)
+
+        if hostnames:
+            host_states = host_states.filter(HostState.host_id.in_(
+                select([Host.id]).where(Host.hostname.in_(hostnames))
+            ))
+        if categories:
+            host_states = host_states.filter(
+                HostState.category.in_(categories)
+            )
+        if states:
+            host_states = host_states.filter(HostState.state.in_(states))
+
+        offset, limit, expand = self.get_pagination_values()
+        host_states, total = self.paginate_query(
+            host_states.order_by(HostState.host_id, HostState.category),
+            offset, limit, filtered=bool(hostnames or categories or states)
+        )
+
+        json = {
+            "limit": limit,
+            "offset": offset,
+            "hostStates": [
+                state.to_dict(self.href_prefix) for state in host_states
+            ],
+        }
+        if total is not None:
+            json["totalHostStates"] = total
+
+        self.success(json)
+
+
 class EventTypesHandler(ApiHandler):
 
     def post(self):
@@ -637,6 +1015,7 @@ class EventTypesHandler(ApiHandler):
         :query string state: (*optional*) Filter EventTypes by state.
         :query int limit: (*optional*) Limit result to N resources.
         :query int offset: (*optional*) Skip the first N resources.
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
         :query boolean startingTypes: (*optional*) Return the event types that can create non-intermediate Labors
 
         :statuscode 200: The request was successful.
@@ -666,7 +1045,13 @@ class EventTypesHandler(ApiHandler):
             )
 
         offset, limit, expand = self.get_pagination_values()
-        event_types, total = self.paginate_query(event_types, offset, limit)
+        event_types, total = self.paginate_query(
+            event_types, offset, limit,
+            filtered=(
+                category is not None or state is not None
+                or bool(starting_types)
+            )
+        )
 
         json = {
             "limit": limit,
@@ -843,9 +1228,31 @@ class EventTypeHandler(ApiHandler):
 
 
 class EventsHandler(ApiHandler):
+    def get_event_coalescer(self):
+        """Get the EventCoalescer of this process, if batching is enabled
+
+        Returns:
+            the EventCoalescer or None if the batching window is not set
+        """
+        my_settings = self.application.my_settings
+        window = my_settings.get("event_batch_window")
+        if not window:
+            return None
+
+        if my_settings.get("event_coalescer") is None:
+            my_settings["event_coalescer"] = EventCoalescer(
+                my_settings["db_session"], window
+            )
+        return my_settings["event_coalescer"]
+
+    @gen.coroutine
     def post(self):
         """**Create an Event entry**
 
+        If the server is configured with an ``event_batch_window``, single
+        host Events arriving within that window are created together in one
+        batch.  Each request still receives its own created Event.
+
         **Example Request:**
 
         .. sourcecode:: http
@@ -962,10 +1369,8 @@ class EventsHandler(ApiHandler):
         :statuscode 409: There was a conflict with another resource.
         """
 
-        # we need a unique tx number so we can look these back up again
-        # as well as for logging
-        # FIXME: how can we guarantee uniqueness here?
-        tx = int(time.time() * 100000) + random.randrange(10000, 99999)
+        # a random id to tie together the log lines of this request
+        tx = id_generator()
 
         log.info("EVENTS [{}]: Creating events".format(tx))
 
@@ -1026,84 +1431,53 @@ class EventsHandler(ApiHandler):
             )
         )
 
-        # If a host query was specified, we need to talk to the external
-        # query server to resolve this into a list of hostnames
-        if "hostQuery" in self.jbody:
-            query = self.jbody["hostQuery"]
-            log.info("EVENTS [{}]: Running query {}".format(tx, query))
-            response = PluginHelper.request_get(params={"query": query})
-            if response.json()["status"] == "ok":
-                hostnames.extend(response.json()["results"])
-                log.info(
-                    "EVENTS [{}]: Hostnames after query: {}".format(
-                        tx, ", ".join(hostnames)
-                    )
-                )
-
-        # If a quest Id was given, look up the labors in that quest and
-        # get all the hostnames for those labors.
-        if "questId" in self.jbody:
-            log.info("EVENTS [{}]: Looking up quest {}".format(
-                tx, self.jbody["questId"])
-            )
-            quest = self.session.query(Quest).filter_by(
-                id=self.jbody["questId"]
-            ).scalar()
-            if not quest:
-                raise exc.NotFound("No such Quest {} found".format(id))
-            for labor in quest.labors:
-                hostnames.append(labor.host.hostname)
-
-            log.info(
-                "EVENTS [{}]: Hostnames after quest expansion: {}".format(
-                    tx, ", ".join(hostnames)
-                )
-            )
-
-        # We need to create a list of hostnames that don't have a Host record
-        new_hosts_needed = set(hostnames)
-        hosts = (
-            self.session.query(Host).filter(Host.hostname.in_(hostnames)).all()
+        # Resolve the hostnames, host query results and the hosts of the
+        # quest to Hosts, creating the ones we don't know about yet
+        host_ids = self.resolve_hosts(
+            hostnames,
+            host_query=self.jbody.get("hostQuery"),
+            quest_id=self.jbody.get("questId")
         )
+        log.info("EVENTS [{}]: Resolved {} hosts".format(tx, len(host_ids)))
 
-        for host in hosts:
-            new_hosts_needed.remove(str(host.hostname))
-
-        # if we need to create hosts, do them all at once
-        if new_hosts_needed:
-            log.info("EVENTS [{}]: Creating hosts {}".format(
-                tx, ", ".join(new_hosts_needed)
-            ))
-            Host.create_many(self.session, new_hosts_needed)
-            hosts = (
-                self.session.query(Host).filter(
-                    Host.hostname.in_(hostnames)
-                ).all()
-            )
-
-        if not hosts:
+        if not host_ids:
             raise exc.BadRequest("No hosts found with given list")
 
         try:
-            if len(hosts) > 1:
+            if len(host_ids) > 1:
                 # if we are supposed to create many events,
                 #  we want to do them as a giant batch
-                log.info("EVENTS [{}]: Creating multiple events".format(tx))
+                batch_tx = EventBatch.allocate(self.session)
+                log.info("EVENTS [{}]: Creating multiple events in batch {}"
+                         .format(tx, batch_tx))
                 events_to_create = []
-                for host in hosts:
+                for hostname, host_id in sorted(host_ids.iteritems()):
                     events_to_create.append({
-                        "host_id": host.id,
+                        "host_id": host_id,
                         "user": user,
                         "event_type_id": event_type.id,
                         "note": note,
-                        "tx": tx
                     })
-                Event.create_many(self.session, events_to_create, tx)
+                event_ids = Event.create_many(
+                    self.session, events_to_create, batch_tx
+                )
+            elif self.get_event_coalescer():
+                # if we are just creating one event and batching is enabled,
+                # hand it off to be created along with other single events
+                log.info("EVENTS [{}]: Queueing 1 event".format(tx))
+                # The event is written by the coalescer's own session, which
+                # has to see the host we may have just created
+                self.session.commit()
+                event_id = yield self.get_event_coalescer().submit(
+                    host_ids.values()[0], user, event_type.id, note=note
+                )
+                event = self.session.query(Event).get(event_id)
             else:
                 # if we are just creating one event, do it the simple way
                 log.info("EVENTS [{}]: Creating 1 event".format(tx))
+                host = self.session.query(Host).get(host_ids.values()[0])
                 event = Event.create(
-                    self.session, hosts[0], user, event_type, note=note
+                    self.session, host, user, event_type, note=note
                 )
 
         except IntegrityError as err:
@@ -1117,16 +1491,18 @@ class EventsHandler(ApiHandler):
         self.session.commit()
         log.info("EVENTS [{}]: Committed".format(tx))
 
-        if len(hosts) == 1:
+        if len(host_ids) == 1:
             json = event.to_dict(self.href_prefix)
             json["href"] = "/api/v1/events/{}".format(event.id)
             self.created(
                 "/api/v1/events/{}".format(event.id), json
             )
         else:
-            # if we created many events, we need to look them up by the TX
-            # number to figure out what they were since the were created in bulk
-            created_events = self.session.query(Event).filter(Event.tx == tx).all()
+            # we know what we created in bulk, no need to look it back up
+            created_events = [
+                Event(id=event_id, **event)
+                for event_id, event in zip(event_ids, events_to_create)
+            ]
             self.created(
                 data={
                     "events": (
@@ -1181,13 +1557,24 @@ class EventsHandler(ApiHandler):
         :query string hostname: (*optional*) Filter Events by Host's hostname
         :query int limit: (*optional*) Limit result to N resources.
         :query int offset: (*optional*) Skip the first N resources.
-        :query string after: (*optional*) Only select events at and after a given timestamp
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
+        :query string cursor: (*optional*) Page through the Events with the
+            given cursor instead of an offset.  Pass an empty cursor to get
+            the most recent page, then pass the returned ``nextCursor`` to
+            get the page of Events before it.  ``nextCursor`` is null on
+            the last page.  No total is computed in this mode.
+        :query string after: (*optional*) Only select events at and after a given timestamp.
+            Archived events are included unless the timestamp is newer than
+            the newest archived event.
         :query string before: (*optional*) Only select events before a given timestamp
         :query int afterEventType: (*optional*) Only select events at and after the last event of a given event type
+        :query boolean afterEventTypePerHost: (*optional*) If true, select the events of each host at and after that host's last event of the afterEventType type, skipping hosts without one
         :query int afterEventId: (*optional*) Only select events at and after the specified event Id
         :query string hostQuery: (*optional*) Only select events that match a given host query
 
         :statuscode 200: The request was successful.
+        :statuscode 400: The cursor was invalid, or there is no event of
+                         the afterEventType type.
         :statuscode 401: The request was made without being logged in.
         """
 
@@ -1195,6 +1582,10 @@ class EventsHandler(ApiHandler):
         host_id = self.get_argument("hostId", None)
         hostname = self.get_argument("hostname", None)
         after_event_type = self.get_argument("afterEventType", None)
+        after_event_type_per_host = (
+            self.get_argument("afterEventTypePerHost", "false").lower()
+            == "true"
+        )
         after_event_id = self.get_argument("afterEventId", None)
         host_query = self.get_argument("hostQuery", None)
 
@@ -1208,27 +1599,12 @@ class EventsHandler(ApiHandler):
             before_time = parser.parse(before_time, yearfirst=True)
             before_time = before_time.replace(tzinfo=None)
 
-        events = self.session.query(Event).order_by(desc(Event.timestamp))
-
-        if event_type_id:
-            events = events.filter(Event.event_type_id.in_(event_type_id))
-
-        if host_id:
-            events = events.filter_by(host_id=host_id)
-
-        found_host = None
+        found_host_id = None
         if hostname:
-            try:
-                found_host = (
-                    self.session.query(Host).filter(
-                        Host.hostname == hostname
-                    ).one()
-                )
-            except sqlalchemy.orm.exc.NoResultFound:
+            found_host_id = Host.get_id(self.session, hostname)
+            if found_host_id is None:
                 raise exc.BadRequest("No host {} found".format(hostname))
 
-            events = events.filter(Event.host == found_host)
-
         hostnames = []
         if host_query:
             response = PluginHelper.request_get(params={"query": host_query})
@@ -1242,45 +1618,92 @@ class EventsHandler(ApiHandler):
             else:
                 raise exc.BadRequest("Bad host query: {}".format(host_query))
 
-        if hostnames:
-            events = (
-                events.join(Event.host).filter(Host.hostname.in_(hostnames))
-            )
-
-        if after_time:
-            logging.info(after_time)
-            events = events.filter(Event.timestamp >= after_time)
-        if before_time:
-            logging.info(before_time)
-            events = events.filter(Event.timestamp < before_time)
-
-        if after_event_type:
-            # find most recent event of that type for the given host
-            # want all events greater than or equal to the time for that event
-            subquery = self.session.query(Event).order_by(desc(Event.timestamp)).filter(Event.event_type_id == after_event_type)
-
+        def host_criteria(model):
+            clauses = []
             if host_id:
-                subquery = subquery.filter_by(host_id=host_id)
+                clauses.append(model.host_id == host_id)
+            if found_host_id:
+                clauses.append(model.host_id == found_host_id)
+            if hostnames:
+                clauses.append(model.host_id.in_(
+                    select([Host.id]).where(Host.hostname.in_(hostnames))
+                ))
+            return clauses
+
+        # Old events may have been moved to the archive, so we also look
+        # there unless the requested time range starts after the newest
+        # archived event
+        horizon = ArchivedEvent.get_horizon(self.session)
+        span_archive = horizon is not None and (
+            after_time is None or after_time <= horizon
+        )
 
-            if found_host:
-                subquery = subquery.filter(Event.host == found_host)
+        # The last event of the type is looked up by a subquery, per host if
+        # asked to.  It may have been archived, so we look there too.
+        if after_event_type and horizon is not None:
+            span_archive = True
+
+        if after_event_type and not after_event_type_per_host:
+            sources = (Event, ArchivedEvent) if span_archive else (Event,)
+            if not any(
+                self.session.query(exists().where(and_(
+                    source.event_type_id == after_event_type,
+                    *host_criteria(source)
+                ))).scalar()
+                for source in sources
+            ):
+                raise exc.BadRequest(
+                    "No event of type {} found".format(after_event_type)
+                )
 
-            if hostnames:
-                subquery = (
-                    subquery.join(Event.host).filter(Host.hostname.in_(hostnames))
+        def after_event_criterion(model):
+            latest_ids = []
+            for source in (Event, ArchivedEvent) if span_archive else (Event,):
+                latest = aliased(source)
+                clauses = [latest.event_type_id == after_event_type]
+                if after_event_type_per_host:
+                    clauses.append(latest.host_id == model.host_id)
+                else:
+                    clauses.extend(host_criteria(latest))
+                latest_ids.append(
+                    select([latest.id]).where(and_(*clauses))
+                    .order_by(desc(latest.timestamp)).limit(1).as_scalar()
                 )
 
-            event = subquery.first()
-            if not event:
-                raise exc.BadRequest("No event of type {} found".format(after_event_type))
-            else:
-                events = events.from_self().filter(Event.id >= event.id)
+            if len(latest_ids) == 1:
+                return model.id >= latest_ids[0]
+            return model.id >= func.coalesce(*latest_ids)
+
+        def criteria(model):
+            clauses = host_criteria(model)
+            if event_type_id:
+                clauses.append(model.event_type_id.in_(event_type_id))
+            if after_time:
+                clauses.append(model.timestamp >= after_time)
+            if before_time:
+                clauses.append(model.timestamp < before_time)
+            if after_event_type:
+                clauses.append(after_event_criterion(model))
+            if after_event_id:
+                clauses.append(model.id >= int(after_event_id))
+            return clauses
+
+        if span_archive:
+            events = Event.query_with_archive(self.session, criteria)
+        else:
+            events = self.session.query(Event).filter(*criteria(Event))
+        events = events.order_by(desc(Event.timestamp))
 
-        if after_event_id:
-            events = events.filter(Event.id >= int(after_event_id))
+        cursor = self.get_argument("cursor", None)
+        if cursor is not None:
+            self._get_page_by_cursor(events, cursor)
+            return
 
         offset, limit, expand = self.get_pagination_values()
-        events, total = self.paginate_query(events, offset, limit, count=self.count_events)
+        events, total = self.paginate_query(
+            events, offset, limit, count=self.count_events,
+            filtered=span_archive or bool(criteria(Event))
+        )
 
         events = events.from_self().order_by(Event.timestamp)
 
@@ -1297,6 +1720,349 @@ class EventsHandler(ApiHandler):
 
         self.success(json)
 
+    def _get_page_by_cursor(self, events, cursor):
+        """Respond with the page of Events that comes after the given cursor.
+
+        The Events are walked from the most recent to the oldest by
+        (timestamp, id), so a page only has to seek to the cursor instead of
+        skipping over all the Events on the previous pages.
+
+        Args:
+            events: the filtered query of Events to page through
+            cursor: the cursor returned with the previous page, or an empty
+                string for the first page
+        """
+        offset, limit, expand = self.get_pagination_values()
+
+        if cursor:
+            timestamp, event_id = decode_cursor(cursor)
+            events = events.filter(
+                or_(
+                    Event.timestamp < timestamp,
+                    and_(Event.timestamp == timestamp, Event.id < event_id)
+                )
+            )
+
+        events = events.order_by(None).order_by(
+            desc(Event.timestamp), desc(Event.id)
+        )
+        if limit is not None:
+            events = events.limit(limit + 1)
+        events = events.all()
+
+        next_cursor = None
+        if limit is not None and len(events) > limit:
+            events = events[:limit]
+            next_cursor = encode_cursor(events[-1].timestamp, events[-1].id)
+
+        self.success({
+            "limit": limit,
+            "cursor": cursor,
+            "nextCursor": next_cursor,
+            "events": [
+                event.to_dict(base_uri=self.href_prefix, expand=set(expand))
+                for event in reversed(events)
+            ],
+        })
+
+
+@stream_request_body
+class EventsStreamHandler(ApiHandler):
+    # Number of records to create in each chunk
+    chunk_size = 1000
+
+    # The body is streamed, so we can take much more than a regular request
+    max_body_size = 10 * 1024 * 1024 * 1024
+
+    # Longest line we buffer, since a record is held until its newline
+    max_line_size = 1024 * 1024
+
+    def prepare(self):
+        BaseHandler.prepare(self)
+
+        if self.request.method.lower() == "post":
+            content_type = parse_options_header(
+                self.request.headers.get("Content-Type")
+            )[0]
+            if content_type.lower() not in (
+                "application/x-ndjson", "application/json"
+            ):
+                raise exc.BadRequest(
+                    "Invalid Content-Type for streaming POST request."
+                )
+            self.request.connection.set_max_body_size(self.max_body_size)
+
+        self.add_header("Content-Type", "application/x-ndjson")
+        self.href_prefix = "{}://{}{}".format(
+            self.request.protocol,
+            self.request.host,
+            API_VER
+        )
+
+        self.buffer = ""
+        self.skipping_line = False
+        self.line_number = 0
+        self.records = []
+        self.chunk_number = 0
+        self.total_events = 0
+        self.total_errors = 0
+        self.event_types = {}
+
+    def data_received(self, data):
+        self.buffer += data
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+
+        for line in lines:
+            if self.skipping_line:
+                # The rest of a line we already reported as too long
+                self.skipping_line = False
+                continue
+            self.add_record(line)
+
+        if len(self.buffer) > self.max_line_size and not self.skipping_line:
+            self.add_record(self.buffer)
+            self.skipping_line = True
+        if self.skipping_line:
+            self.buffer = ""
+
+    def add_record(self, line):
+        """Parse a line of the body and queue the record for creation
+
+        Args:
+            line: a line of the request body
+        """
+        self.line_number += 1
+        if not line.strip():
+            return
+
+        try:
+            if len(line) > self.max_line_size:
+                raise exc.BadRequest(
+                    "Line longer than {} bytes".format(self.max_line_size)
+                )
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise exc.BadRequest("Record must be a JSON object")
+            if not record["hostname"]:
+                raise exc.BadRequest("Hostname is required")
+            user = record["user"]
+            if not EMAIL_REGEX.match(user):
+                user += "@" + self.domain
+            event_type_id = self.find_event_type_id(
+                record.get("eventTypeId"),
+                record.get("category"),
+                record.get("state")
+            )
+            self.records.append({
+                "line": self.line_number,
+                "hostname": record["hostname"],
+                "user": user,
+                "event_type_id": event_type_id,
+                "note": record.get("note"),
+            })
+        except KeyError as err:
+            self.write_result({
+                "status": "error",
+                "line": self.line_number,
+                "error": {
+                    "code": 400,
+                    "message": "Missing Required Argument: {}".format(
+                        err.message
+                    ),
+                },
+            })
+            self.total_errors += 1
+        except exc.BadRequest as err:
+            self.write_result({
+                "status": "error",
+                "line": self.line_number,
+                "error": {"code": 400, "message": err.log_message},
+            })
+            self.total_errors += 1
+        except (ValueError, TypeError) as err:
+            self.write_result({
+                "status": "error",
+                "line": self.line_number,
+                "error": {"code": 400, "message": str(err)},
+            })
+            self.total_errors += 1
+
+        if len(self.records) >= self.chunk_size:
+            self.create_chunk()
+
+    def find_event_type_id(self, event_type_id, category, state):
+        """Look up the id of the EventType of a record
+
+        Args:
+            event_type_id: the optional id of the EventType
+            category: the category of the EventType if no id was given
+            state: the state of the EventType if no id was given
+
+        Returns:
+            the id of the EventType
+        """
+        if not event_type_id and (not category or not state):
+            raise exc.BadRequest(
+                "Must specify an event type id or both category and state"
+            )
+
+        key = event_type_id or (category, state)
+        if key not in self.event_types:
+            if event_type_id:
+                event_type = self.session.query(EventType).get(event_type_id)
+            else:
+                event_type = self.session.query(EventType).filter(
+                    and_(
+                        EventType.category == category,
+                        EventType.state == state
+                    )
+                ).first()
+            if event_type is None:
+                raise exc.BadRequest("Bad event type")
+            self.event_types[key] = event_type.id
+
+        return self.event_types[key]
+
+    def create_chunk(self):
+        """Create the Events of the queued records and write the result"""
+        records, self.records = self.records, []
+        if not records:
+            return
+        self.chunk_number += 1
+
+        # The chunk is created in a single transaction, so a failed chunk
+        # can be sent again as a whole without duplicating any Events
+        event_ids = []
+        try:
+            with self.session.hold_commits():
+                # Create the hosts we don't know about yet, all at once
+                host_ids = self.resolve_hosts(
+                    record["hostname"] for record in records
+                )
+
+                for events in split_by_host([
+                    {
+                        "host_id": host_ids[record["hostname"]],
+                        "user": record["user"],
+                        "event_type_id": record["event_type_id"],
+                        "note": record["note"],
+                    }
+                    for record in records
+                ]):
+                    tx = EventBatch.allocate(self.session)
+                    event_ids.extend(
+                        Event.create_many(self.session, events, tx)
+                    )
+            self.session.commit()
+        except IntegrityError as err:
+            self.session.rollback()
+            self.write_chunk_error(records, 409, err.orig.message)
+            return
+        except exc.ValidationError as err:
+            self.session.rollback()
+            self.write_chunk_error(records, 400, err.message)
+            return
+        except exc.BaseHttpError as err:
+            self.session.rollback()
+            self.write_chunk_error(records, err.status_code, err.log_message)
+            return
+        except SQLAlchemyError as err:
+            log.exception("EVENTS: Failed to create chunk {}".format(
+                self.chunk_number
+            ))
+            self.session.rollback()
+            self.write_chunk_error(records, 500, str(err))
+            return
+
+        self.total_events += len(event_ids)
+        self.write_result({
+            "status": "created",
+            "chunk": self.chunk_number,
+            "firstLine": records[0]["line"],
+            "lastLine": records[-1]["line"],
+            "totalEvents": len(event_ids),
+            "eventIds": sorted(event_ids),
+        })
+
+    def write_chunk_error(self, records, code, message):
+        self.total_errors += len(records)
+        self.write_result({
+            "status": "error",
+            "chunk": self.chunk_number,
+            "firstLine": records[0]["line"],
+            "lastLine": records[-1]["line"],
+            "error": {"code": code, "message": message},
+        })
+
+    def write_result(self, result):
+        self.write(json.dumps(result) + "\n")
+        self.flush()
+
+    def post(self):
+        """**Create Events from a stream of records**
+
+        Takes newline delimited JSON records, one Event per line, and
+        creates them in chunks as the body is received, so the body never
+        needs to be held in memory.  A result line is streamed back for
+        every chunk of Events created and for every record that could not
+        be used, followed by a final summary line.  Lines longer than
+        max_line_size (a megabyte) are rejected with an error result.
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            POST /api/v1/events/stream HTTP/1.1
+            Host: localhost
+            Content-Type: application/x-ndjson
+
+            {"hostname": "example", "user": "johnny", "eventTypeId": 3}
+            {"hostname": "sample", "user": "johnny", "category": "system-reboot", "state": "completed", "note": "Sample description"}
+            ...
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/x-ndjson
+
+            {"status": "created", "chunk": 1, "firstLine": 1, "lastLine": 1000, "totalEvents": 1000, "eventIds": [1, 2, ...]}
+            {"status": "error", "line": 1001, "error": {"code": 400, "message": "Bad event type"}}
+            {"status": "created", "chunk": 2, "firstLine": 1002, "lastLine": 1500, "totalEvents": 499, "eventIds": [1001, ...]}
+            {"status": "ok", "totalEvents": 1499, "totalErrors": 1}
+
+        :reqjson string hostname: The hostname of the Host of this Event
+        :regjson string user: The user responsible for throwing this Event
+        :regjson int eventTypeId: The id of the EventType
+        :regjson string category: the category to use for the event
+        :regjson string state: the state to use for the event
+        :regjson string note: (*optional*) The human readable note describing this Event
+
+        :reqheader Content-Type: The server expects newline delimited json
+                                 specified with this header.
+
+        :statuscode 200: The stream was processed, see each result line.
+        :statuscode 400: The request was malformed.
+        :statuscode 401: The request was made without being logged in.
+        """
+        if not self.skipping_line:
+            self.add_record(self.buffer)
+        self.buffer = ""
+        self.create_chunk()
+
+        log.info("EVENTS: Streamed {} events with {} errors".format(
+            self.total_events, self.total_errors
+        ))
+
+        self.write_result({
+            "status": "ok",
+            "totalEvents": self.total_events,
+            "totalErrors": self.total_errors,
+        })
+        self.finish()
+
 
 class EventHandler(ApiHandler):
     def get(self, id):
@@ -1337,6 +2103,11 @@ class EventHandler(ApiHandler):
         """
         offset, limit, expand = self.get_pagination_values()
         event = self.session.query(Event).filter_by(id=id).scalar()
+        if not event:
+            # It may have been moved to the archive
+            event = Event.query_with_archive(
+                self.session, lambda model: [model.id == id]
+            ).first()
         if not event:
             raise exc.NotFound("No such Event {} found".format(id))
 
@@ -1512,6 +2283,7 @@ class FatesHandler(ApiHandler):
 
         :query int limit: (*optional*) Limit result to N resources.
         :query int offset: (*optional*) Skip the first N resources.
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
 
         :query string expand: (*optional*) supports eventtypes
 
@@ -1521,7 +2293,9 @@ class FatesHandler(ApiHandler):
         fates = self.session.query(Fate).order_by(Fate.id)
 
         offset, limit, expand = self.get_pagination_values()
-        fates, total = self.paginate_query(fates, offset, limit)
+        fates, total = self.paginate_query(
+            fates, offset, limit, filtered=False
+        )
 
         fates_json = [
             fate.to_dict(base_uri=self.href_prefix, expand=set(expand))
@@ -1728,6 +2502,7 @@ class LaborsHandler(ApiHandler):
         :query string expand: (*optional*) supports hosts, eventtypes, events, quests
         :query int limit: (*optional*) Limit result to N resources.
         :query int offset: (*optional*) Skip the first N resources.
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
 
         :statuscode 200: The request was successful.
         :statuscode 401: The request was made without being logged in.
@@ -1760,11 +2535,17 @@ class LaborsHandler(ApiHandler):
                 EventType.id.in_(valid_event_types)
             )
 
-        # if specifying to filter by open or closed state, add that to the query
+        # if specifying to filter by open or closed state, add that to the
+        # query.  A labor's completion event and time are set together, so we
+        # use the one that is indexed along with the host or quest filter.
+        if hostname is not None and not quest_id:
+            completion_column = Labor.completion_time
+        else:
+            completion_column = Labor.completion_event_id
         if open_flag and open_flag.lower() == "true":
-            labors = labors.filter(Labor.completion_event_id == None)
+            labors = labors.filter(completion_column == None)
         if open_flag and open_flag.lower() == "false":
-            labors = labors.filter(Labor.completion_event_id != None)
+            labors = labors.filter(completion_column != None)
 
         if quest_id:
             labors = labors.filter(Labor.quest_id == quest_id)
@@ -1778,17 +2559,12 @@ class LaborsHandler(ApiHandler):
         # if user wants to filter by a specific host, verify that the host is
         # good and add that to the query
         if hostname is not None:
-            try:
-                host = (
-                    self.session.query(Host).filter(
-                        Host.hostname == hostname
-                    ).one()
-                )
-            except sqlalchemy.orm.exc.NoResultFound:
+            host_id = Host.get_id(self.session, hostname)
+            if host_id is None:
                 raise exc.BadRequest("No host {} found".format(hostname))
 
             labors = (
-                labors.filter(Labor.host == host)
+                labors.filter(Labor.host_id == host_id)
                 .order_by(desc(Labor.creation_time))
             )
 
@@ -1875,7 +2651,13 @@ class LaborsHandler(ApiHandler):
                 ))
 
         offset, limit, expand = self.get_pagination_values()
-        labors, total = self.paginate_query(labors, offset, limit)
+        filtered = any([
+            hostname is not None, starting_labor_id, open_flag, quest_id,
+            host_query, user_query, category, state
+        ])
+        labors, total = self.paginate_query(
+            labors, offset, limit, filtered=filtered
+        )
 
         labors = labors.from_self().order_by(Labor.creation_time)
 
@@ -2033,7 +2815,12 @@ class LaborHandler(ApiHandler):
 
         try:
             if quest_id:
-                labor.update(quest_id=quest_id)
+                quest = self.session.query(Quest).get(quest_id)
+                if not quest:
+                    raise exc.BadRequest(
+                        "No such Quest {} found".format(quest_id)
+                    )
+                labor.add_to_quest(quest)
             if ack_user:
                 labor.acknowledge(ack_user)
         except IntegrityError as err:
@@ -2096,6 +2883,11 @@ class QuestsHandler(ApiHandler):
                 "labors": [],
             }
 
+        When ``async`` is true, the Quest is created in the background and
+        the response is the QuestJob creating it, which can be polled at
+        ``/api/v1/quests/jobs/<id>``.
+
+        :query boolean async: (*optional*) create the Quest in the background
         :reqjson int eventTypeId: the ID of the EventType to for the Events that will be thrown in the creation of this Quest
         :regjson string creator: the user creating this Quest
         :regjson array hostnames: the array of hostnames that will be part of this Quest
@@ -2109,6 +2901,7 @@ class QuestsHandler(ApiHandler):
         :resheader Location: URL to the created resource.
 
         :statuscode 201: The Quest was successfully created.
+        :statuscode 202: The QuestJob creating the Quest was started.
         :statuscode 400: The request was malformed.
         :statuscode 401: The request was made without being logged in.
         :statuscode 409: There was a conflict with another resource.
@@ -2159,35 +2952,38 @@ class QuestsHandler(ApiHandler):
             self.write_error(400, message="Bad fate id {}".format(fate_id))
             return
 
-        # If a host query was specified, we need to talk to the external
-        # query server to resolve this into a list of hostnames
-        if "hostQuery" in self.jbody:
-            query = self.jbody["hostQuery"]
-            response = PluginHelper.request_get(params={"query": query})
-            if response.json()["status"] == "ok":
-                hostnames.extend(response.json()["results"])
-                log.info(
-                    "QUEST [{}]: Hostnames after query: {}".format(
-                        tx, ", ".join(hostnames)
-                    )
-                )
-
-        # We need to create a list of hostnames that don't have a Host record
-        new_hosts_needed = list(hostnames)
-        hosts = (
-            self.session.query(Host).filter(Host.hostname.in_(hostnames)).all()
+        # Resolve the hostnames and host query results to Hosts, creating
+        # the ones we don't know about yet
+        host_ids = self.resolve_hosts(
+            hostnames, host_query=self.jbody.get("hostQuery")
         )
-        for host in hosts:
-            new_hosts_needed.remove(str(host.hostname))
 
-        # if we need to create hosts, do them all at once
-        if new_hosts_needed:
-            Host.create_many(self.session, new_hosts_needed)
-            hosts = (
-                self.session.query(Host).filter(
-                    Host.hostname.in_(hostnames)
-                ).all()
+        # Large quests are better created in the background
+        if host_ids and self.get_argument("async", None) == "true":
+            job = QuestJob.create(
+                self.session, creator=creator, fate_id=fate_id,
+                description=description, target_time=target_time,
+                host_count=len(host_ids)
+            )
+            QuestJobRunner(
+                self.application.my_settings["db_session"], job.id,
+                host_ids.values()
+            ).start()
+
+            self.accepted(
+                "/api/v1/quests/jobs/{}".format(job.id),
+                job.to_dict(self.href_prefix)
             )
+            log.info("QUEST [{}]: Started quest job {} for {} hosts".format(
+                tx, job.id, len(host_ids)
+            ))
+            return
+
+        hosts = []
+        if host_ids:
+            hosts = self.session.query(Host).filter(
+                Host.id.in_(host_ids.values())
+            ).all()
 
         log.info("QUEST [{}]: Working with {} hosts".format(tx, len(hosts)))
 
@@ -2267,6 +3063,7 @@ class QuestsHandler(ApiHandler):
         :query string hostQuery: (*optional*) filter quests to those involving hosts returned by the external query
         :query int limit: (*optional*) Limit result to N resources.
         :query int offset: (*optional*) Skip the first N resources.
+        :query string totals: (*optional*) How to compute the total: exact, cached, estimated or none.
 
         :statuscode 200: The request was successful.
         :statuscode 401: The request was made without being logged in.
@@ -2299,10 +3096,8 @@ class QuestsHandler(ApiHandler):
         quests = self.session.query(Quest).order_by(Quest.embark_time)
 
         if hostnames:
-            quests = (
-                quests.join(Quest.labors).join(Labor.host)
-                .filter(Host.hostname.in_(hostnames))
-            ).group_by(Quest)
+            host_ids = Host.get_ids(self.session, hostnames)
+            quests = quests.filter(Quest.touching_hosts(host_ids.values()))
 
         if filter_closed:
             quests = quests.filter(Quest.completion_time == None)
@@ -2311,18 +3106,33 @@ class QuestsHandler(ApiHandler):
             quests = quests.filter(Quest.creator == by_creator)
 
         offset, limit, expand = self.get_pagination_values()
-        quests, total = self.paginate_query(quests, offset, limit)
-
-        quests = quests.from_self().order_by(Quest.embark_time)
+        quests, total = self.paginate_query(
+            quests, offset, limit,
+            filtered=bool(hostnames or filter_closed or by_creator)
+        )
+        quests = quests.all()
+
+        # The progress and the expanded labors are loaded for the whole page
+        # at once.  The progress is counted from the labors themselves, with
+        # a GROUP BY, rather than read off the counters of the quest rows.
+        if "labors" in expand:
+            Quest.load_labors(self.session, quests)
+        progress = {}
+        if progress_info:
+            progress = Quest.get_progress(
+                self.session, [quest.id for quest in quests]
+            )
 
         quests_json = []
-        for quest in quests.all():
+        for quest in quests:
             quest_json = quest.to_dict(
                 base_uri=self.href_prefix,
                 expand=set(expand)
             )
             if progress_info:
-                quest_json = quest.calculate_progress(quest_json)
+                quest_json = quest.calculate_progress(
+                    quest_json, progress[quest.id]
+                )
             quests_json.append(quest_json)
 
         json = {
@@ -2664,6 +3474,103 @@ class ServerConfig(ApiHandler):
         self.success(result_json)
 
 
+class ServerStats(ApiHandler):
+    def get(self):
+        """ **Get the statistics of the server process**
+
+        Each server process keeps its own caches, so these are the
+        statistics of the process that happened to serve the request.
+
+        **Example Request**:
+
+        .. sourcecode:: http
+
+            GET /api/v1/serverStats HTTP/1.1
+            Host: localhost
+
+        **Example response**:
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "status": "ok",
+                "hostCache": {
+                    "size": 1500,
+                    "maxSize": 100000,
+                    "hits": 48200,
+                    "misses": 1650,
+                    "evictions": 0,
+                    "hitRate": 0.9669
+                }
+            }
+
+        :statuscode 200: The request was successful.
+        """
+        self.success({
+            "hostCache": Host.get_cache().stats(),
+        })
+
+
+class QuestJobHandler(ApiHandler):
+    def get(self, id):
+        """**Get the progress of a QuestJob**
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            GET /api/v1/quests/jobs/1 HTTP/1.1
+            Host: localhost
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "status": "ok",
+                "id": 1,
+                "href": "/api/v1/quests/jobs/1",
+                "state": "running",
+                "creator": "johnny@example.com",
+                "fateId": 1,
+                "description": "This is a quest almighty",
+                "targetTime": null,
+                "questId": 1,
+                "hostCount": 20000,
+                "hostsProcessed": 5000,
+                "laborsCreated": 5000,
+                "error": null,
+                "creationTime": timestamp,
+                "updateTime": timestamp,
+                "completionTime": null
+            }
+
+        The state of a QuestJob is one of pending, running, completed or
+        failed.  The Quest is only announced once the job is completed.  A
+        job that made no progress for quest_job_timeout seconds was left
+        behind by its server process and is failed.
+
+        :param id: id of the QuestJob to retrieve
+        :type id: int
+
+        :statuscode 200: The request was successful.
+        :statuscode 401: The request was made without being logged in.
+        :statuscode 404: The QuestJob was not found.
+        """
+        job = self.session.query(QuestJob).get(id)
+        if not job:
+            raise exc.NotFound("No such QuestJob {} found".format(id))
+        job.check_abandoned()
+
+        self.success(job.to_dict(self.href_prefix))
+
+
 class QuestMailHandler(ApiHandler):
     def post(self, id):
         """**Send a message to all owners that are involved with a quest**
@@ -2812,7 +3719,11 @@ class QuestMailHandler(ApiHandler):
                     recipients.add("{}@{}".format(owner, settings.domain))
 
         # Send email
-        email_message(recipients, subject, message, sender=from_address)
+        notify_email(
+            self.session, list(recipients), subject, message,
+            sender=from_address
+        )
+        self.session.commit()
 
         self.created()
 
@@ -2824,3 +3735,216 @@ class QuestMailHandler(ApiHandler):
                 "labor owners" if labor_owners else ""
             )
         )
+
+
+class ChangesHandler(ApiHandler):
+    def initialize(self):
+        ApiHandler.initialize(self)
+        self.waiter = None
+
+    def on_connection_close(self):
+        if self.waiter is not None:
+            get_change_feed(self.application.my_settings).cancel(self.waiter)
+
+    @gen.coroutine
+    def get(self):
+        """**Wait for changes** (long-poll)
+
+        Returns the Events, Labor openings and closings and Quest completions
+        committed after the Event given by ``since``.  If there aren't any
+        yet, the request is held until there are or until the timeout
+        expires.  Pass the returned ``lastEventId`` as ``since`` in the next
+        request to only get what changed in between.
+
+        Clients that can use WebSockets may connect to
+        ``/api/v1/changes/ws`` instead, which takes the same arguments and
+        pushes each change as a message.
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            GET /api/v1/changes?since=41&questId=2 HTTP/1.1
+            Host: localhost
+
+        **Example response:**
+
+        .. sourcecode:: http
+
+            HTTP/1.1 200 OK
+            Content-Type: application/json
+
+            {
+                "status": "ok",
+                "lastEventId": 42,
+                "changes": [
+                    {
+                        "type": "eventCreated",
+                        "eventId": 42,
+                        "hostId": 1,
+                        "eventTypeId": 3,
+                        "questIds": [2],
+                        "event": {...}
+                    },
+                    {
+                        "type": "laborClosed",
+                        "eventId": 42,
+                        "hostId": 1,
+                        "eventTypeId": 3,
+                        "questIds": [2],
+                        "labor": {...}
+                    },
+                    {
+                        "type": "questCompleted",
+                        "eventId": 42,
+                        "hostId": 1,
+                        "eventTypeId": 3,
+                        "questIds": [2],
+                        "quest": {...}
+                    }
+                ]
+            }
+
+        :query int since: (*optional*) the id of the last Event already seen.
+                          If left out, no changes are returned and
+                          lastEventId is the id of the most recent Event.
+        :query int questId: (*optional*) only changes to these Quests
+        :query string hostname: (*optional*) only changes caused by Events
+                                for these Hosts
+        :query int eventTypeId: (*optional*) only changes caused by Events
+                                of these EventTypes
+        :query int timeout: (*optional*) the number of seconds to wait for
+                            changes, up to the change_feed_timeout setting.
+
+        :statuscode 200: The request was successful.
+        :statuscode 400: The request was malformed.
+        :statuscode 404: A Host was not found.
+        """
+        change_filter = get_change_filter(self)
+        my_settings = self.application.my_settings
+        max_timeout = my_settings.get("change_feed_timeout", 30)
+        grace = my_settings.get("change_feed_grace", 30)
+
+        try:
+            since = self.get_argument("since", None)
+            timeout = min(
+                float(self.get_argument("timeout", max_timeout)), max_timeout
+            )
+            if since is not None:
+                since = int(since)
+        except ValueError:
+            raise exc.BadRequest("since and timeout must be numbers")
+
+        if since is None:
+            self.success({
+                "lastEventId": latest_event_id(self.session),
+                "changes": [],
+            })
+            return
+
+        changes, since = get_changes(self.session, since, grace=grace)
+        changes = change_filter.apply(changes)
+
+        feed = get_change_feed(my_settings)
+        deadline = IOLoop.current().time() + timeout
+        while not changes and IOLoop.current().time() < deadline:
+            # Don't hold a transaction open while we wait, so we see what
+            # the other processes commit
+            self.session.close()
+
+            self.waiter = feed.wait()
+            try:
+                yield gen.with_timeout(deadline, self.waiter)
+            except gen.TimeoutError:
+                feed.cancel(self.waiter)
+                break
+            finally:
+                self.waiter = None
+
+            changes, since = get_changes(self.session, since, grace=grace)
+            changes = change_filter.apply(changes)
+
+        self.success({
+            "lastEventId": since,
+            "changes": changes,
+        })
+
+
+class ChangesSocketHandler(ApiHandler, WebSocketHandler):
+    def get(self, *args, **kwargs):
+        """**Subscribe to changes** (WebSocket)
+
+        Pushes each Event, Labor opening and closing and Quest completion as
+        a JSON message, in the format of the changes returned by
+        ``/api/v1/changes``, as soon as it is committed.
+
+        **Example Request:**
+
+        .. sourcecode:: http
+
+            GET /api/v1/changes/ws?hostname=example HTTP/1.1
+            Host: localhost
+            Upgrade: websocket
+            Connection: Upgrade
+
+        :query int since: (*optional*) the id of the last Event already seen,
+                          to first get the changes committed since then
+        :query int questId: (*optional*) only changes to these Quests
+        :query string hostname: (*optional*) only changes caused by Events
+                                for these Hosts
+        :query int eventTypeId: (*optional*) only changes caused by Events
+                                of these EventTypes
+
+        :statuscode 101: The connection was upgraded to a WebSocket.
+        :statuscode 400: The request was malformed.
+        :statuscode 404: A Host was not found.
+        """
+        self.change_filter = get_change_filter(self)
+        try:
+            self.since = int(self.get_argument("since", 0))
+        except ValueError:
+            raise exc.BadRequest("since must be a number")
+
+        self.feed = get_change_feed(self.application.my_settings)
+        return WebSocketHandler.get(self, *args, **kwargs)
+
+    def open(self):
+        # Subscribing sets the cursor of the feed, so we catch up to it in
+        # batches before the feed gets to poll; publish skips whatever we
+        # already sent
+        self.feed.subscribe(self.publish)
+        if self.since:
+            since = self.since
+            while since < self.feed.last_event_id:
+                changes, last_event_id = get_changes(
+                    self.session, since, self.feed.batch_size,
+                    grace=self.feed.grace
+                )
+                if last_event_id == since:
+                    break
+                self.publish(changes)
+                since = last_event_id
+        self.session.close()
+
+    def publish(self, changes):
+        """Send the matching changes we haven't sent yet
+
+        Args:
+            changes: the list of changes
+        """
+        try:
+            for change in self.change_filter.apply(changes):
+                if change["eventId"] > self.since:
+                    self.write_message(change)
+        except WebSocketClosedError:
+            self.feed.unsubscribe(self.publish)
+            return
+
+        if changes:
+            self.since = max(self.since, changes[-1]["eventId"])
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.feed.unsubscribe(self.publish)
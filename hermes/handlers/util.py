@@ -2,6 +2,7 @@ import json
 import logging
 import requests
 import sys
+import time
 from tornado.web import RequestHandler, urlparse, HTTPError
 from tornado.escape import utf8
 from werkzeug.http import parse_options_header
@@ -9,6 +10,7 @@ from werkzeug.http import parse_options_header
 from .. import exc
 from .. import models
 from ..settings import settings
+from ..util import PluginHelper
 
 
 # Logging object
@@ -27,6 +29,53 @@ else:
 
 API_VER = "/api/v1"
 
+# The ways we can compute the total number of results of a list query
+TOTALS_MODES = ("exact", "cached", "estimated", "none")
+
+# The query arguments that don't change the total number of results
+PAGINATION_ARGUMENTS = ("limit", "offset", "expand", "totals", "cursor")
+
+
+class TotalsCache(object):
+    """Cache of the totals of list queries, kept for ttl seconds.
+
+    Args:
+        ttl: the number of seconds a total is kept for
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.totals = {}
+
+    def get(self, key):
+        """Look up a cached total
+
+        Args:
+            key: the key of the query
+
+        Returns:
+            the total, or None if it isn't cached or has expired
+        """
+        cached = self.totals.get(key)
+        if cached is None or cached[0] < time.time():
+            return None
+        return cached[1]
+
+    def set(self, key, total):
+        """Cache a total
+
+        Args:
+            key: the key of the query
+            total: the total number of results of the query
+        """
+        # Don't let expired totals pile up
+        now = time.time()
+        if len(self.totals) > 10000:
+            self.totals = {
+                key: cached for key, cached in self.totals.iteritems()
+                if cached[0] >= now
+            }
+        self.totals[key] = (now + self.ttl, total)
+
 
 class BaseHandler(RequestHandler):
     def initialize(self):
@@ -127,10 +176,68 @@ class ApiHandler(BaseHandler):
 
         return offset, limit, self.get_arguments("expand")
 
-    def paginate_query(self, query, offset, limit, count=True):
-        total = None
-        if count:
+    def get_totals_mode(self, default="exact"):
+        mode = self.get_argument("totals", default)
+        if mode not in TOTALS_MODES:
+            raise exc.BadRequest(
+                "totals must be one of {}".format(", ".join(TOTALS_MODES))
+            )
+        return mode
+
+    def get_total(self, query, mode, filtered=True):
+        """Compute the total number of results of a list query
+
+        Args:
+            query: the filtered query, before pagination
+            mode: exact to count the results, cached to reuse a count made
+                in the last totals_cache_ttl seconds for the same filters,
+                estimated to use the table statistics when nothing is
+                filtered (and a cached count otherwise) or none
+            filtered: False if the query lists every row of its table, as
+                only the handler can tell
+
+        Returns:
+            the total, or None if mode is none
+        """
+        if mode == "none":
+            return None
+
+        if mode == "exact":
+            return query.count()
+
+        if mode == "estimated" and not filtered:
+            return models.estimate_row_count(
+                self.session,
+                query.column_descriptions[0]["type"].__table__
+            )
+
+        my_settings = self.application.my_settings
+        if my_settings.get("totals_cache") is None:
+            my_settings["totals_cache"] = TotalsCache(
+                my_settings.get("totals_cache_ttl", 60)
+            )
+        totals_cache = my_settings["totals_cache"]
+
+        key = (
+            type(self).__name__, tuple(self.path_args),
+            tuple(sorted(self.path_kwargs.iteritems())),
+            tuple(sorted(
+            (name, tuple(sorted(values)))
+            for name, values in self.request.arguments.iteritems()
+            if name not in PAGINATION_ARGUMENTS
+            ))
+        )
+        total = totals_cache.get(key)
+        if total is None:
             total = query.count()
+            totals_cache.set(key, total)
+        return total
+
+    def paginate_query(self, query, offset, limit, count=True, filtered=True):
+        total = self.get_total(
+            query, self.get_totals_mode("exact" if count else "none"),
+            filtered=filtered
+        )
 
         query = query.offset(offset)
         if limit is not None:
@@ -138,6 +245,49 @@ class ApiHandler(BaseHandler):
 
         return query, total
 
+    def resolve_hosts(self, hostnames=None, host_query=None, quest_id=None):
+        """Resolve the Hosts a request is about, creating the missing ones
+
+        Args:
+            hostnames: the list of hostnames given explicitly
+            host_query: the query to resolve into hostnames with the host
+                query plugin
+            quest_id: the id of a Quest whose Hosts to include
+
+        Returns:
+            dict mapping each hostname to the id of its Host
+        """
+        hostnames = set(hostnames or [])
+        host_ids = {}
+
+        if host_query is not None:
+            response = PluginHelper.request_get(params={"query": host_query})
+            if response.json()["status"] == "ok":
+                hostnames.update(response.json()["results"])
+
+        if quest_id is not None:
+            quest = self.session.query(models.Quest.id).filter(
+                models.Quest.id == quest_id
+            ).scalar()
+            if quest is None:
+                raise exc.NotFound("No such Quest {} found".format(quest_id))
+            host_ids.update(
+                self.session.query(models.Host.hostname, models.Host.id)
+                .join(models.Labor, models.Labor.host_id == models.Host.id)
+                .filter(models.Labor.quest_id == quest_id).distinct()
+            )
+
+        try:
+            host_ids.update(models.Host.upsert_many(
+                self.session, hostnames - set(host_ids)
+            ))
+        except exc.ValidationError as err:
+            raise exc.BadRequest(err.message)
+        except exc.ConcurrencyError as err:
+            raise exc.Conflict(err.message)
+
+        return host_ids
+
     def prepare(self):
         BaseHandler.prepare(self)
 
@@ -216,3 +366,17 @@ class ApiHandler(BaseHandler):
             )
         self.write(data)
         self.finish()
+
+    def accepted(self, location=None, data=None):
+        """202 ACCEPTED"""
+        self.set_status(202)
+        if data is None:
+            data = {}
+        data['status'] = 'accepted'
+        if location is not None:
+            self.set_header(
+                "Location",
+                urlparse.urljoin(utf8(self.request.uri), utf8(location))
+            )
+        self.write(data)
+        self.finish()
@@ -0,0 +1,62 @@
+import logging
+import threading
+
+from .models import QuestJob
+
+
+log = logging.getLogger(__name__)
+
+
+class QuestJobRunner(threading.Thread):
+    """Background thread that runs a QuestJob.
+
+    Each step of the job is its own transaction, run off the IOLoop so the
+    server keeps serving requests while the chunks of Hosts are added.  The
+    Hosts of a job are only known to the process that accepted it, so a job
+    left behind by a process that went away makes no more progress, and is
+    failed once it has been idle for quest_job_timeout seconds.
+
+    Args:
+        session_factory: callable returning a new database session
+        job_id: the id of the QuestJob to run
+        host_ids: the ids of the Hosts to start the Quest on
+    """
+    def __init__(self, session_factory, job_id, host_ids):
+        super(QuestJobRunner, self).__init__(
+            name="quest-job-{}".format(job_id)
+        )
+        self.daemon = True
+        self.session_factory = session_factory
+        self.job_id = job_id
+        self.host_ids = sorted(host_ids)
+
+    def step(self):
+        """Run the next step of the job
+
+        Returns:
+            True if there are more steps to run
+        """
+        session = self.session_factory()
+        try:
+            job = session.query(QuestJob).get(self.job_id)
+            try:
+                more = job.run_step(self.host_ids)
+            except Exception as err:
+                log.exception("QUEST JOB [{}]: Failed".format(self.job_id))
+                session.rollback()
+                job.fail(err)
+                return False
+
+            log.info("QUEST JOB [{}]: {} of {} hosts processed".format(
+                self.job_id, job.hosts_processed, job.host_count
+            ))
+            return more
+        finally:
+            session.close()
+
+    def run(self):
+        try:
+            while self.step():
+                pass
+        except Exception:
+            log.exception("QUEST JOB [{}]: Error".format(self.job_id))
@@ -1,12 +1,18 @@
 from __future__ import unicode_literals, division
 
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 import functools
+import json
 import logging
 import textwrap
+import time
 
 from requests.exceptions import HTTPError
 from sqlalchemy import create_engine, or_, union_all, desc, and_
+from sqlalchemy import select, func, exists, literal, bindparam, false
+from sqlalchemy import text
 from sqlalchemy.event import listen
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
@@ -14,11 +20,14 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, object_session, aliased, validates
 from sqlalchemy.orm import synonym, sessionmaker, Session as _Session, backref
 from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.schema import Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.types import Integer, String, Text, Boolean, BigInteger
 from sqlalchemy.types import DateTime
 
-from .util import slack_message, email_message, PluginHelper
+from .util import slack_message, queue_slack_message, email_message
+from .util import summarize_slack_messages
+from .util import PluginHelper, SmtpTransport, LruCache
 from .settings import settings
 import exc
 
@@ -26,11 +35,30 @@ log = logging.getLogger(__name__)
 
 _HOOKS = []
 
+# The number of hostnames looked up at once, which keeps us well under the
+# limit of bound parameters per statement of SQLite
+HOST_CHUNK_SIZE = 500
+
 
 def register_hook(hook):
     _HOOKS.append(hook)
 
 
+def chunked(items, size=None):
+    """Split a list into chunks
+
+    Args:
+        items: the list to split
+        size: the size of the chunks, HOST_CHUNK_SIZE by default
+
+    Returns:
+        generator of the chunks
+    """
+    size = size or HOST_CHUNK_SIZE
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 class Session(_Session):
     """ Custom session meant to utilize add on the model.
 
@@ -52,6 +80,56 @@ class Session(_Session):
     def delete(self, *args, **kwargs):
         raise NotImplementedError("Use delete method on models instead.")
 
+    # While commits are held, commit() only flushes, and the side effects
+    # of the work wait for the real commit
+    _held_commits = 0
+    _after_commit = None
+
+    def commit(self):
+        if self._held_commits:
+            self.flush()
+            return
+        _Session.commit(self)
+
+        callbacks, self._after_commit = self._after_commit or [], None
+        for callback, args, kwargs in callbacks:
+            callback(*args, **kwargs)
+
+    def rollback(self):
+        self._after_commit = None
+        _Session.rollback(self)
+
+    def close(self):
+        self._after_commit = None
+        _Session.close(self)
+
+    def after_commit(self, callback, *args, **kwargs):
+        """Call back right away, or once committed if commits are held
+
+        Args:
+            callback: the callable to call
+            args: the positional arguments of the callable
+            kwargs: the keyword arguments of the callable
+        """
+        if not self._held_commits:
+            callback(*args, **kwargs)
+            return
+
+        if self._after_commit is None:
+            self._after_commit = []
+        self._after_commit.append((callback, args, kwargs))
+
+    @contextmanager
+    def hold_commits(self):
+        """Hold the commits of a block of work so it runs as a single
+        transaction, to be committed (or rolled back) by the caller.
+        """
+        self._held_commits += 1
+        try:
+            yield
+        finally:
+            self._held_commits -= 1
+
 
 Session = sessionmaker(class_=Session)
 
@@ -181,6 +259,128 @@ def get_db_session(db_engine=None, database=None):
     return Session()
 
 
+def estimate_row_count(session, table):
+    """Estimate the number of rows of a table without counting them
+
+    On MySQL this uses the table statistics, elsewhere the largest id (or
+    the count of rows, for tables without an id).
+
+    Args:
+        session: an active database session
+        table: the Table to estimate
+
+    Returns:
+        the estimated number of rows
+    """
+    if session.bind.dialect.name == "mysql":
+        estimate = session.execute(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table",
+            {"table": table.name}
+        ).scalar()
+    elif "id" in table.c:
+        estimate = session.execute(
+            select([func.max(table.c.id)])
+        ).scalar()
+    else:
+        estimate = session.execute(
+            select([func.count()]).select_from(table)
+        ).scalar()
+
+    return int(estimate or 0)
+
+
+def insert_many(session, table, rows, key_column=None):
+    """Insert many rows into a table and get back their ids
+
+    Postgres hands back the ids with RETURNING.  Elsewhere the rows are
+    inserted with multi-row INSERT statements, each of which is given a
+    contiguous range of ids that we derive from the last row id.  On MySQL
+    that only holds with the consecutive auto-increment lock mode, so when
+    a key column is given we double check the range against it and fall
+    back to looking the ids up by the key.
+
+    Args:
+        session: an active database session
+        table: the Table to insert into
+        rows: the list of row dicts
+        key_column: optional name of a column holding the same value in all
+            the rows, used to verify and look up the ids
+
+    Returns:
+        the list of ids of the inserted rows, in the order of the rows
+    """
+    if not rows:
+        return []
+
+    columns = set()
+    for row in rows:
+        columns.update(row)
+    rows = [
+        dict((column, row.get(column)) for column in columns)
+        for row in rows
+    ]
+
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql":
+        return [
+            row[0] for row in session.execute(
+                table.insert().values(rows).returning(table.c.id)
+            )
+        ]
+
+    # SQLite only allows so many bound parameters per statement
+    if dialect == "sqlite":
+        chunk_size = max(1, 999 // len(columns))
+    else:
+        chunk_size = 1000
+
+    ids = []
+    for start in xrange(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        result = session.execute(table.insert().values(chunk))
+
+        # SQLite reports the id of the last row, MySQL the one of the first
+        if dialect == "sqlite":
+            first_id = result.lastrowid - len(chunk) + 1
+        else:
+            first_id = result.lastrowid
+        last_id = first_id + len(chunk) - 1
+
+        if key_column is not None and dialect != "sqlite":
+            key = chunk[0][key_column]
+            found = session.execute(
+                select([func.count()]).where(
+                    and_(
+                        table.c.id.between(first_id, last_id),
+                        table.c[key_column] == key
+                    )
+                )
+            ).scalar()
+            if found != len(chunk):
+                log.warn("Ids of bulk insert into {} were not contiguous"
+                         .format(table.name))
+                for remaining in xrange(
+                        start + chunk_size, len(rows), chunk_size
+                ):
+                    session.execute(
+                        table.insert().values(
+                            rows[remaining:remaining + chunk_size]
+                        )
+                    )
+                return [
+                    row[0] for row in session.execute(
+                        select([table.c.id]).where(
+                            table.c[key_column] == key
+                        ).order_by(table.c.id)
+                    )
+                ]
+
+        ids.extend(xrange(first_id, last_id + 1))
+
+    return ids
+
+
 def flush_transaction(method):
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
@@ -349,6 +549,11 @@ class Host(Model):
     Attributes:
         id: the unique database id
         hostname: the name of this host
+        _cache: cached map of hostname to Host id, bounded to the
+            host_cache_size most recently used hostnames
+        _generation: the CacheGeneration the cached ids were checked against
+        _checked_at: when the cached ids were last checked against the
+            CacheGeneration
 
     Note:
         matching on hostname is done in a very rudimentary fashion.  The code makes
@@ -365,6 +570,10 @@ class Host(Model):
         Index("host_idx", id, hostname),
     )
 
+    _cache = None
+    _generation = None
+    _checked_at = None
+
     @classmethod
     def create(cls, session, hostname):
         """Create a new Host record
@@ -404,6 +613,84 @@ class Host(Model):
             ])
         session.flush()
 
+    @classmethod
+    def upsert_many(cls, session, hostnames):
+        """Get the ids of Hosts, creating the missing ones
+
+        Hosts are looked up through the cache and the missing ones are
+        created in chunks, taking at most three statements per chunk.  A
+        Host created at the same time by another request is picked up
+        instead of failing the insert: only a duplicate hostname is let
+        through by the insert, and the Hosts are read back with a locking
+        read, which sees the rows committed since the transaction started.
+
+        Args:
+            session: active database session
+            hostnames: the hostnames of the Hosts
+
+        Returns:
+            dict mapping each hostname to the id of its Host
+
+        Raises:
+            ConcurrencyError: if a Host could neither be created nor found,
+                having been deleted by another request
+        """
+        hostnames = sorted(set(hostnames))
+        if None in hostnames or "" in hostnames:
+            raise exc.ValidationError("Hostname is required")
+
+        insert = cls._insert_missing_statement(session)
+
+        host_ids = cls.get_ids(session, hostnames, fresh=True)
+        for chunk in chunked([
+            hostname for hostname in hostnames if hostname not in host_ids
+        ]):
+            session.execute(insert, [
+                {"hostname": hostname} for hostname in chunk
+            ])
+            found = dict(
+                session.query(cls.hostname, cls.id)
+                .filter(cls.hostname.in_(chunk))
+                .with_for_update(read=True)
+            )
+            missing = set(chunk) - set(found)
+            if missing:
+                raise exc.ConcurrencyError(
+                    "Hosts were deleted while being created: {}".format(
+                        ", ".join(sorted(missing))
+                    )
+                )
+            host_ids.update(found)
+
+        return host_ids
+
+    @classmethod
+    def _insert_missing_statement(cls, session):
+        """Helper method to get the statement inserting a Host unless its
+        hostname is taken
+
+        Only the unique hostname is let through; any other error, such as
+        a hostname too long for its column, still fails the insert.
+
+        Args:
+            session: an active database session
+
+        Returns:
+            the INSERT statement, taking a hostname parameter
+        """
+        dialect = session.bind.dialect.name
+        if dialect == "mysql":
+            return text(
+                "INSERT INTO hosts (hostname) VALUES (:hostname) "
+                "ON DUPLICATE KEY UPDATE id = id"
+            )
+        if dialect in ("sqlite", "postgresql"):
+            return text(
+                "INSERT INTO hosts (hostname) VALUES (:hostname) "
+                "ON CONFLICT (hostname) DO NOTHING"
+            )
+        return cls.__table__.insert()
+
     @classmethod
     def get_host(cls, session, hostname):
         """Find a host with a given hostname
@@ -412,7 +699,107 @@ class Host(Model):
             session: a database session
             hostname: the name to look for
         """
-        return session.query(Host).filter(Host.hostname == hostname).first()
+        host_id = cls.get_id(session, hostname)
+        if host_id is None:
+            return None
+        return session.query(Host).get(host_id)
+
+    @classmethod
+    def get_cache(cls):
+        """Get the cache of hostname to Host id of this process
+
+        Returns:
+            the LruCache of Host ids
+        """
+        if Host._cache is None:
+            Host._cache = LruCache(settings.host_cache_size)
+        return Host._cache
+
+    @classmethod
+    def _clear_cache(cls):
+        """Helper method to drop the cached Host ids"""
+        if Host._cache is not None:
+            Host._cache.clear()
+        Host._generation = None
+        Host._checked_at = None
+
+    @classmethod
+    def check_cache(cls, session, force=False):
+        """Drop the cached Host ids if another process renamed or merged
+        Hosts since they were cached.
+
+        Renames are rare, so for reads the CacheGeneration is only looked up
+        once every host_cache_check_interval seconds; until then other
+        processes may resolve a renamed hostname to its old Host.  Lookups
+        made to write rows referring to the Hosts force the check, so they
+        never use a stale id.
+
+        Args:
+            session: an active database session
+            force: if True, look up the CacheGeneration right away
+        """
+        now = time.time()
+        if (
+            not force
+            and Host._checked_at is not None
+            and now - Host._checked_at < settings.host_cache_check_interval
+        ):
+            return
+
+        generation = CacheGeneration.get_generation(session, "hosts")
+        if generation != Host._generation:
+            cls.get_cache().clear()
+            Host._generation = generation
+        Host._checked_at = now
+
+    @classmethod
+    def get_ids(cls, session, hostnames, fresh=False):
+        """Look up the ids of Hosts, going to the database only for the
+        hostnames that aren't cached
+
+        Args:
+            session: an active database session
+            hostnames: the hostnames of the Hosts
+            fresh: if True, make sure no Host was renamed or merged since
+                the ids were cached, as needed when writing rows referring
+                to the Hosts
+
+        Returns:
+            dict mapping the hostnames of the existing Hosts to their ids
+        """
+        cls.check_cache(session, force=fresh)
+        cache = cls.get_cache()
+
+        host_ids = {}
+        missing = []
+        for hostname in set(hostnames):
+            host_id = cache.get(hostname)
+            if host_id is None:
+                missing.append(hostname)
+            else:
+                host_ids[hostname] = host_id
+
+        for chunk in chunked(sorted(missing)):
+            for hostname, host_id in session.query(cls.hostname, cls.id).filter(
+                cls.hostname.in_(chunk)
+            ):
+                cache.set(hostname, host_id)
+                host_ids[hostname] = host_id
+
+        return host_ids
+
+    @classmethod
+    def get_id(cls, session, hostname):
+        """Look up the id of a Host, going through the cache
+
+        Args:
+            session: an active database session
+            hostname: the hostname of the Host
+
+        Returns:
+            the id of the Host, or None if there is no such Host
+        """
+        return cls.get_ids(session, [hostname]).get(hostname)
 
     def get_latest_events(self):
         """Get the latest Events for this Host
@@ -459,19 +846,141 @@ class Host(Model):
         Returns:
             either the renamed host or the existing host that was merged
         """
-        existing_host = (
-            self.session.query(Host).filter(Host.hostname == new_name).scalar()
+        session = self.session
+        host_ids = Host.rename_many(session, {self.hostname: new_name})
+        return session.query(Host).get(host_ids.values()[0])
+
+    @classmethod
+    def rename_many(cls, session, renames, commit=True):
+        """Rename Hosts.  Hosts renamed to an existing name are merged into it.
+
+        Merging moves the Events, archived Events, Labors and latest states
+        of a Host to the Host with the new name, then deletes the emptied
+        Host.  This takes a fixed number of bulk statements however many
+        rows are moved, all in one transaction.
+
+        Args:
+            session: active database session
+            renames: dict mapping current hostnames to new hostnames
+            commit: if True, commit the transaction
+
+        Returns:
+            dict mapping each current hostname to the id of the Host now
+            holding the new name
+        """
+        if not all(renames.itervalues()):
+            raise exc.ValidationError("Hostname is required")
+
+        chained = set(
+            old for old, new in renames.iteritems() if old != new
+        ) & set(renames.itervalues())
+        if chained:
+            raise exc.ValidationError(
+                "Hosts {} can't be both renamed and renamed to".format(
+                    ", ".join(sorted(chained))
+                )
+            )
+
+        host_ids = {}
+        for chunk in chunked(sorted(set(renames) | set(renames.values()))):
+            host_ids.update(session.query(cls.hostname, cls.id).filter(
+                cls.hostname.in_(chunk)
+            ))
+
+        missing = set(renames) - set(host_ids)
+        if missing:
+            raise exc.ValidationError("No such Host(s) {}".format(
+                ", ".join(sorted(missing))
+            ))
+
+        # The first Host renamed to a new name takes it, any other one is
+        # merged into it
+        renamed = {}
+        merged = {}
+        for old, new in sorted(
+            renames.iteritems(), key=lambda rename: host_ids[rename[0]]
+        ):
+            if old == new:
+                continue
+            if new in host_ids:
+                merged[host_ids[old]] = host_ids[new]
+            else:
+                renamed[host_ids[old]] = new
+                host_ids[new] = host_ids[old]
+
+        table = cls.__table__
+        try:
+            if renamed:
+                session.execute(
+                    table.update().where(table.c.id == bindparam("b_id"))
+                    .values(hostname=bindparam("b_hostname")),
+                    [
+                        {"b_id": host_id, "b_hostname": hostname}
+                        for host_id, hostname in renamed.iteritems()
+                    ]
+                )
+            if merged:
+                cls._merge(session, merged)
+
+            CacheGeneration.bump(session, "hosts")
+            session.expire_all()
+            if commit:
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            Host._clear_cache()
+
+        return dict(
+            (old, host_ids[new]) for old, new in renames.iteritems()
         )
 
-        if not existing_host:
-            self.update(hostname=new_name)
-            return self
-        else:
-            for event in self.events:
-                event.update(host_id=existing_host.id)
-            for labor in self.labors:
-                labor.update(host_id=existing_host.id)
-            return existing_host
+    @classmethod
+    def _merge(cls, session, merged):
+        """Move everything of some Hosts to other Hosts and delete them
+
+        Args:
+            session: active database session
+            merged: dict mapping the ids of the Hosts to merge to the ids of
+                the Hosts to merge them into
+        """
+        moves = [
+            {"b_source": source_id, "b_target": target_id}
+            for source_id, target_id in merged.iteritems()
+        ]
+        for table in (
+            Event.__table__, ArchivedEvent.__table__, Labor.__table__
+        ):
+            session.execute(
+                table.update().where(table.c.host_id == bindparam("b_source"))
+                .values(host_id=bindparam("b_target")),
+                moves
+            )
+
+        # Of the states of the merged Hosts, keep the latest per category
+        states = HostState.__table__
+        latest = {}
+        for chunk in chunked(sorted(set(merged) | set(merged.values()))):
+            for state in session.execute(
+                states.select().where(states.c.host_id.in_(chunk))
+            ):
+                state = dict(state.items())
+                state["host_id"] = merged.get(state["host_id"], state["host_id"])
+                key = (state["host_id"], state["category"])
+                if key not in latest or (
+                    (state["timestamp"], state["event_id"]) >
+                    (latest[key]["timestamp"], latest[key]["event_id"])
+                ):
+                    latest[key] = state
+            session.execute(states.delete().where(states.c.host_id.in_(chunk)))
+        if latest:
+            session.execute(states.insert(), latest.values())
+
+        for chunk in chunked(sorted(merged)):
+            session.execute(
+                cls.__table__.delete().where(cls.__table__.c.id.in_(chunk))
+            )
 
     def href(self, base_uri):
         """Create an HREF value for this object
@@ -511,6 +1020,310 @@ class Host(Model):
         return out
 
 
+class CacheGeneration(Model):
+    """A CacheGeneration is a counter that is bumped whenever the data behind
+    an in-process cache is written.  Every server process remembers the
+    generation its copy was built from, so a stale copy can be detected with
+    a single primary key lookup instead of reloading the data.
+
+    Attributes:
+        id: the unique database id
+        name: the name of the cache (ex: "fates")
+        generation: the current generation of the cached data
+    """
+
+    __tablename__ = "cache_generations"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64), nullable=False, unique=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get_generation(cls, session, name):
+        """Look up the current generation of a cache
+
+        Args:
+            session: an active database session
+            name: the name of the cache
+
+        Returns:
+            the current generation, or 0 if it was never bumped
+        """
+        generation = session.query(CacheGeneration.generation).filter(
+            CacheGeneration.name == name
+        ).scalar()
+
+        return generation or 0
+
+    @classmethod
+    def bump(cls, session, name):
+        """Bump the generation of a cache within the current transaction so
+        that other processes know to reload it once the transaction commits.
+
+        Args:
+            session: an active database session
+            name: the name of the cache
+        """
+        table = CacheGeneration.__table__
+        result = session.execute(
+            table.update().where(table.c.name == name).values(
+                generation=table.c.generation + 1
+            )
+        )
+        if not result.rowcount:
+            session.execute(
+                table.insert().values(name=name, generation=1)
+            )
+
+
+class EventBatch(Model):
+    """An EventBatch reserves a transaction id for Events created in bulk.
+
+    The auto-incremented id of the batch is used as the tx of its Events, so
+    that no two bulk creations can ever share the same tx.
+
+    Attributes:
+        id: the unique database id, used as the tx of the Events
+        creation_time: when the batch was allocated
+    """
+
+    __tablename__ = "event_batches"
+
+    id = Column(
+        BigInteger().with_variant(Integer, "sqlite"), primary_key=True
+    )
+    creation_time = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    @classmethod
+    def allocate(cls, session):
+        """Allocate a new transaction id
+
+        Args:
+            session: an active database session
+
+        Returns:
+            the new transaction id
+        """
+        result = session.execute(
+            EventBatch.__table__.insert().values(
+                creation_time=datetime.utcnow()
+            )
+        )
+        return result.inserted_primary_key[0]
+
+
+class OutboxMessage(Model):
+    """An OutboxMessage is a notification (a Slack post or an email) that was
+    queued up as part of a database transaction.  It is delivered later by
+    the outbox worker so that writes don't have to wait on Slack or the mail
+    relay, and it is only delivered if the transaction that queued it was
+    committed.
+
+    Attributes:
+        id: the unique database id
+        kind: the kind of notification ("slack" or "email")
+        payload: the JSON encoded arguments of the notification
+        creation_time: when the notification was queued
+        attempts: the number of failed delivery attempts so far
+        sent_time: when the notification was delivered, if it was
+        last_error: the error of the last failed delivery attempt
+    """
+
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)
+    payload = Column(Text, nullable=False)
+    creation_time = Column(DateTime, default=datetime.utcnow, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    sent_time = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    __table_args__ = (
+        Index("outbox_idx", sent_time, attempts),
+    )
+
+    @classmethod
+    def enqueue(cls, session, kind, **payload):
+        """Queue up a notification within the current transaction
+
+        Args:
+            session: an active database session
+            kind: the kind of notification ("slack" or "email")
+            payload: the arguments of the notification
+        """
+        session.execute(
+            OutboxMessage.__table__.insert().values(
+                kind=kind,
+                payload=json.dumps(payload),
+                creation_time=datetime.utcnow(),
+                attempts=0
+            )
+        )
+
+    @classmethod
+    def deliver_pending(cls, session, limit=100, max_attempts=5):
+        """Deliver a batch of queued notifications.  Failed deliveries are
+        retried on later calls until they have failed max_attempts times.
+
+        Args:
+            session: an active database session
+            limit: the maximum number of notifications to deliver
+            max_attempts: the number of attempts after which we give up
+
+        Returns:
+            the number of notifications that were delivered
+        """
+        messages = session.query(OutboxMessage).filter(
+            and_(
+                OutboxMessage.sent_time == None,
+                OutboxMessage.attempts < max_attempts
+            )
+        ).order_by(OutboxMessage.id).limit(limit).all()
+
+        delivered = 0
+        if settings.slack_window:
+            slack = [message for message in messages if message.kind == "slack"]
+            messages = [
+                message for message in messages if message.kind != "slack"
+            ]
+            delivered += cls._deliver_slack_summary(session, slack)
+
+        transport = SmtpTransport()
+        for message in messages:
+            payload = json.loads(message.payload)
+            try:
+                if message.kind == "slack":
+                    slack_message(payload["message"], raise_errors=True)
+                elif message.kind == "email":
+                    email_message(
+                        raise_errors=True, transport=transport, **payload
+                    )
+                    for recipients, error in transport.flush():
+                        raise error
+                else:
+                    raise ValueError(
+                        "Unknown notification kind {}".format(message.kind)
+                    )
+            except Exception as err:
+                log.warn("Error delivering notification {}: {}".format(
+                    message.id, err
+                ))
+                message.attempts += 1
+                message.last_error = "{}".format(err)
+            else:
+                message.sent_time = datetime.utcnow()
+                delivered += 1
+
+        transport.close()
+        session.commit()
+
+        return delivered
+
+    @classmethod
+    def _deliver_slack_summary(cls, session, messages):
+        """Helper method to deliver queued Slack messages as one summary post
+
+        The messages are held until the oldest of them is slack_window
+        seconds old, so the ones queued in the meantime join the post, and
+        at most slack_max_rate posts are made per minute.  The rate is
+        checked against the Slack messages sent by any process, so it holds
+        for all of the servers sharing the database.  The messages are only
+        marked as sent once the post was made.
+
+        Args:
+            session: an active database session
+            messages: the pending Slack OutboxMessages, oldest first
+
+        Returns:
+            the number of messages that were delivered
+        """
+        if not messages:
+            return 0
+
+        now = datetime.utcnow()
+        age = now - messages[0].creation_time
+        if age.total_seconds() < settings.slack_window:
+            return 0
+
+        if settings.slack_max_rate:
+            last_post = session.query(func.max(OutboxMessage.sent_time)).filter(
+                OutboxMessage.kind == "slack"
+            ).scalar()
+            if last_post is not None and (
+                (now - last_post).total_seconds()
+                < 60.0 / settings.slack_max_rate
+            ):
+                return 0
+
+        summary = summarize_slack_messages([
+            (payload["message"], payload.get("summary"))
+            for payload in (
+                json.loads(message.payload) for message in messages
+            )
+        ])
+        try:
+            slack_message(summary, raise_errors=True)
+        except Exception as err:
+            log.warn("Error delivering {} Slack notifications: {}".format(
+                len(messages), err
+            ))
+            for message in messages:
+                message.attempts += 1
+                message.last_error = "{}".format(err)
+            return 0
+
+        for message in messages:
+            message.sent_time = now
+        return len(messages)
+
+
+def notify_slack(session, message, summary=None):
+    """Post a message to Slack, queueing it in the outbox if enabled
+
+    Args:
+        session: the active database session of the current transaction
+        message: the content of the Slack post
+        summary: optional dict of counts used to summarize the message
+            when it gets combined with others
+    """
+    if not settings.slack_webhook:
+        return
+
+    if settings.notification_outbox:
+        OutboxMessage.enqueue(
+            session, "slack", message=message, summary=summary
+        )
+    else:
+        session.after_commit(queue_slack_message, message, summary)
+
+
+def notify_email(session, recipients, subject, message, transport=None,
+                 **kwargs):
+    """Email a message, queueing it in the outbox if enabled
+
+    Args:
+        session: the active database session of the current transaction
+        recipients: the email address to whom we wish to send the email
+        subject: the subject of the email we wish to send
+        message: the content of the email we wish to send
+        transport: optional SmtpTransport to use if sending right away
+        kwargs: the optional arguments of email_message
+    """
+    if not settings.email_notifications:
+        return
+
+    if settings.notification_outbox:
+        OutboxMessage.enqueue(
+            session, "email", recipients=recipients, subject=subject,
+            message=message, **kwargs
+        )
+    else:
+        session.after_commit(
+            email_message, recipients, subject, message, transport=transport,
+            **kwargs
+        )
+
+
 class Fate(Model):
     """A Fate is a mapping of EventTypes to inform the system what kind of Events
     automatically create or satisfy Labors.
@@ -526,6 +1339,9 @@ class Fate(Model):
         _all_fates: cached list of all Fates
         _intermediate_fates = cached list of all intermediate Fates (Fates that follow other Fates)
         _starting_fates = cached list of all non-intermediate Fates
+        _starting_fates_by_type = cached map of EventType id to the first non-intermediate Fate it triggers
+        _successor_fates = cached map of (creating Fate id, EventType id) to the Fates that close it
+        _generation = the CacheGeneration the cached Fates were loaded from
 
     Notes:
         A Fate can create a Labor can be designated for both the server owner and the quest owner.
@@ -569,6 +1385,9 @@ class Fate(Model):
     _all_fates = None
     _intermediate_fates = None
     _starting_fates = None
+    _starting_fates_by_type = None
+    _successor_fates = None
+    _generation = None
 
     @classmethod
     def create(
@@ -619,9 +1438,8 @@ class Fate(Model):
             obj.add(session)
             session.flush()
 
-            Fate._all_fates = None
-            Fate._intermediate_fates = None
-            Fate._starting_fates = None
+            CacheGeneration.bump(session, "fates")
+            Fate._clear_cache()
 
         except Exception:
             session.rollback()
@@ -629,31 +1447,99 @@ class Fate(Model):
 
         return obj
 
-    @classmethod
-    def _refresh_cache(cls, session):
-        """Helper method to refresh the Fates cache from the database
+    def update(self, **kwargs):
+        """Update this Fate and let every server process know that the
+        cached Fates are now stale.
+        """
+        try:
+            CacheGeneration.bump(self.session, "fates")
+        except Exception:
+            self.session.rollback()
+            raise
+        Fate._clear_cache()
+
+        return super(Fate, self).update(**kwargs)
+
+    @classmethod
+    def _clear_cache(cls):
+        """Helper method to drop the Fates cache so it is reloaded on next use"""
+        Fate._all_fates = None
+        Fate._intermediate_fates = None
+        Fate._starting_fates = None
+        Fate._starting_fates_by_type = None
+        Fate._successor_fates = None
+        Fate._generation = None
+
+    @classmethod
+    def check_cache(cls, session):
+        """Drop the Fates cache if another process has written to the Fates
+        since the cache was loaded.  This costs a single primary key lookup,
+        so it is cheap enough to run once per request.
 
         Args:
             session: an active database session
         """
-        fates = session.query(Fate).all()
-        Fate._all_fates = dict()
-        Fate._starting_fates = []
+        generation = CacheGeneration.get_generation(session, "fates")
+        if generation != Fate._generation:
+            Fate._clear_cache()
+
+    @classmethod
+    def _refresh_cache(cls, session):
+        """Helper method to refresh the Fates cache from the database
+
+        The Fate graph is compiled into lookup tables so that resolving an
+        Event against the Fates is a constant-time operation.  We only pull
+        the columns we need so we don't eager load any of the relationships.
+
+        Args:
+            session: an active database session
+        """
+        # Read the generation first; if the Fates are written while we load
+        # them we will just reload again on the next check.
+        generation = CacheGeneration.get_generation(session, "fates")
+
+        fates = session.query(
+            Fate.id, Fate.creation_type_id, Fate.follows_id,
+            Fate.for_creator, Fate.for_owner
+        ).order_by(Fate.id).all()
+
+        all_fates = dict()
         for fate in fates:
-            fate_dict = {
+            all_fates[fate.id] = {
                 "id": fate.id,
                 "creation_type_id": fate.creation_type_id,
                 "follows_id": fate.follows_id,
-                "precedes_ids": [
-                    linked_fate.id for linked_fate in fate.precedes
-                    ],
+                "precedes_ids": [],
                 "for_creator": fate.for_creator,
                 "for_owner": fate.for_owner
             }
-            Fate._all_fates[fate.id] = fate_dict
-            if not fate.follows_id:
-                Fate._starting_fates.append(fate_dict)
 
+        starting_fates = []
+        intermediate_fates = []
+        starting_fates_by_type = {}
+        successor_fates = {}
+        for fate in fates:
+            fate_dict = all_fates[fate.id]
+            if fate.follows_id:
+                intermediate_fates.append(fate_dict)
+                if fate.follows_id in all_fates:
+                    all_fates[fate.follows_id]["precedes_ids"].append(fate.id)
+                successor_fates.setdefault(
+                    (fate.follows_id, fate.creation_type_id), []
+                ).append(fate_dict)
+            else:
+                starting_fates.append(fate_dict)
+                # we only want to match up to the first fate found
+                starting_fates_by_type.setdefault(
+                    fate.creation_type_id, fate_dict
+                )
+
+        Fate._starting_fates = starting_fates
+        Fate._intermediate_fates = intermediate_fates
+        Fate._starting_fates_by_type = starting_fates_by_type
+        Fate._successor_fates = successor_fates
+        Fate._all_fates = all_fates
+        Fate._generation = generation
 
     @classmethod
     def get_all_fates(cls, session):
@@ -681,7 +1567,7 @@ class Fate(Model):
         Returns:
             list of all intermediate Fates
         """
-        if not Fate._intermediate_fates:
+        if not Fate._all_fates or Fate._intermediate_fates is None:
             Fate._refresh_cache(session)
         return Fate._intermediate_fates
 
@@ -700,6 +1586,39 @@ class Fate(Model):
             Fate._refresh_cache(session)
         return Fate._starting_fates
 
+    @classmethod
+    def get_starting_fates_by_type(cls, session):
+        """Returns the cached map of EventType ids to the non-intermediate Fate
+        each one triggers.  Otherwise, pull from the database first and then
+        return.
+
+        Args:
+            session: an active database connection
+
+        Returns:
+            dict of EventType id to starting Fate
+        """
+        if not Fate._all_fates or Fate._starting_fates_by_type is None:
+            Fate._refresh_cache(session)
+        return Fate._starting_fates_by_type
+
+    @classmethod
+    def get_successor_fates(cls, session):
+        """Returns the cached map of (creating Fate id, EventType id) to the
+        Fates that would close a Labor created by that Fate when an Event of
+        that EventType is thrown.  Otherwise, pull from the database first and
+        then return.
+
+        Args:
+            session: an active database connection
+
+        Returns:
+            dict of (Fate id, EventType id) to a list of successor Fates
+        """
+        if not Fate._all_fates or Fate._successor_fates is None:
+            Fate._refresh_cache(session)
+        return Fate._successor_fates
+
     @classmethod
     def question_the_fates(cls, session, events, quest=None, starting_fates=None):
         """Look through the Fates and see if we need to create or close
@@ -726,12 +1645,23 @@ class Fate(Model):
         all_new_labors = []
         all_achieved_labors = []
 
-        # Get all the fates, in various categories, for easy reference
-        all_fates = Fate.get_all_fates(session)
-        if not starting_fates:
-            starting_fates = session.query(Fate).filter(
-                Fate.follows_id == None
-            )
+        # Track the labors we already batched up so we don't create duplicates
+        seen_new_labors = set()
+
+        # Get the compiled Fate graph so each Event can be resolved with
+        # lookups instead of walking every Fate
+        Fate.check_cache(session)
+        successor_fates = Fate.get_successor_fates(session)
+        if starting_fates:
+            starting_fates_by_type = {}
+            for fate in starting_fates:
+                starting_fates_by_type.setdefault(fate.creation_type_id, {
+                    "id": fate.id,
+                    "for_creator": fate.for_creator,
+                    "for_owner": fate.for_owner
+                })
+        else:
+            starting_fates_by_type = Fate.get_starting_fates_by_type(session)
 
         # Query the database for open labors for hosts of which we have an event
         open_labors = (
@@ -753,70 +1683,66 @@ class Fate(Model):
 
         # Now let's process each of the events and see what we need to do
         for event in events:
-            host = event.host
-            event_type = event.event_type
+            host_id = event.host_id
+            event_type_id = event.event_type_id
 
             # First, lets see if this Event is supposed to create any
             # non-intermediate Labors and add them to the batch
-            for fate in starting_fates:
-                if fate.creation_type_id == event_type.id:
-                    new_labor_dict = {
-                        "host_id": host.id,
-                        "creation_event_id": event.id,
-                        "fate_id": fate.id,
-                        "quest_id": quest.id if quest else None,
-                        "for_creator": fate.for_creator,
-                        "for_owner": fate.for_owner
-                    }
-                    if new_labor_dict not in all_new_labors:
-                        all_new_labors.append(new_labor_dict)
-                    # we only want to match up to the first fate found
-                    break
+            fate = starting_fates_by_type.get(event_type_id)
+            if fate:
+                new_labor_dict = {
+                    "host_id": host_id,
+                    "creation_event_id": event.id,
+                    "fate_id": fate["id"],
+                    "quest_id": quest.id if quest else None,
+                    "for_creator": fate["for_creator"],
+                    "for_owner": fate["for_owner"]
+                }
+                labor_key = tuple(sorted(new_labor_dict.items()))
+                if labor_key not in seen_new_labors:
+                    seen_new_labors.add(labor_key)
+                    all_new_labors.append(new_labor_dict)
 
             # Now let's see if we should be closing any labors.
-            # We will see what fate created a labor, then examine all the fates
-            # that come after it.  If the fates that come after have a creation
-            # event type that matches this events type, we know we should be
+            # We will see what fate created a labor, then look up the fates
+            # that come after it with a creation event type that matches this
+            # events type. If there are any, we know we should be
             # transitioning on and should therefore close this labor (and
             # possible create a new one).
-            if host.id in labors_by_hostid:
-                for labor in labors_by_hostid[host.id]:
-                    creating_fate = all_fates[labor.fate_id]
-                    for fate_id in creating_fate['precedes_ids']:
-                        fate = all_fates[fate_id]
-                        if (
-                            event_type.id == fate["creation_type_id"]
-                        ):
-                            all_achieved_labors.append({
-                                "labor": labor,
-                                "event": event,
-                                "fate": fate,
-                            })
-
-                            # Since this Fate closes this Labor, let's see
-                            # if this Fate also precedes other Fates.  If so,
-                            # we can make the assumption that a new Labor
-                            # should be created.  We will examine those
-                            # subsequent labors to see if the labor should be
-                            # for the quest creator, server owner, or both.
-                            if fate["precedes_ids"]:
-                                new_labor_dict = {
-                                    "host_id": host.id,
-                                    "starting_labor_id": (
-                                        labor.starting_labor_id
-                                        if labor.starting_labor_id
-                                        else labor.id
-                                    ),
-                                    "creation_event_id": event.id,
-                                    "fate_id": fate["id"],
-                                    "quest_id": (
-                                        labor.quest.id if labor.quest else None
-                                    ),
-                                    "for_creator": fate["for_creator"],
-                                    "for_owner": fate["for_owner"],
-                                }
-                                if new_labor_dict not in all_new_labors:
-                                    all_new_labors.append(new_labor_dict)
+            for labor in labors_by_hostid.get(host_id, []):
+                for fate in successor_fates.get(
+                        (labor.fate_id, event_type_id), []
+                ):
+                    all_achieved_labors.append({
+                        "labor": labor,
+                        "event": event,
+                        "fate": fate,
+                    })
+
+                    # Since this Fate closes this Labor, let's see
+                    # if this Fate also precedes other Fates.  If so,
+                    # we can make the assumption that a new Labor
+                    # should be created.  We will examine those
+                    # subsequent labors to see if the labor should be
+                    # for the quest creator, server owner, or both.
+                    if fate["precedes_ids"]:
+                        new_labor_dict = {
+                            "host_id": host_id,
+                            "starting_labor_id": (
+                                labor.starting_labor_id
+                                if labor.starting_labor_id
+                                else labor.id
+                            ),
+                            "creation_event_id": event.id,
+                            "fate_id": fate["id"],
+                            "quest_id": labor.quest_id,
+                            "for_creator": fate["for_creator"],
+                            "for_owner": fate["for_owner"],
+                        }
+                        labor_key = tuple(sorted(new_labor_dict.items()))
+                        if labor_key not in seen_new_labors:
+                            seen_new_labors.add(labor_key)
+                            all_new_labors.append(new_labor_dict)
 
         if all_new_labors:
             Labor.create_many(session, all_new_labors)
@@ -826,6 +1752,190 @@ class Fate(Model):
         session.flush()
         session.commit()
 
+    @classmethod
+    def question_the_fates_by_tx(
+            cls, session, tx, quest=None, starting_fates=None
+    ):
+        """Look through the Fates and see if we need to create or close
+        Labors based on the Events created with the given transaction id.
+
+        This does the same work as question_the_fates, but expresses it as
+        a handful of set-based statements evaluated in the database so the
+        cost does not depend on the number of Events.  The Labors are
+        closed first, then the chained Labors are created from the Labors
+        that were just closed, and finally the starting Labors are created.
+        If more than one Event in the transaction would close the same
+        Labor, the Event with the lowest id wins.
+
+        Args:
+            session: active database session
+            tx: the transaction id of the Events to evaluate
+            quest: the optional quest if events were result of quest creation
+            starting_fates: the explicit list of Fates to use when evaluating
+                for non-intermediate labor creations
+        """
+        now = datetime.utcnow()
+        events = Event.__table__
+        fates = Fate.__table__
+        labors = Labor.__table__
+        successor = fates.alias("successor")
+        following = fates.alias("following")
+
+        tx_host_ids = select([events.c.host_id]).where(events.c.tx == tx)
+        tx_event_ids = select([events.c.id]).where(events.c.tx == tx)
+
+        # Close the open labors of our hosts for which a Fate that follows
+        # the creating Fate is triggered by one of our Events
+        closing_event_id = select([func.min(events.c.id)]).select_from(
+            events.join(
+                successor,
+                successor.c.creation_type_id == events.c.event_type_id
+            )
+        ).where(
+            and_(
+                events.c.tx == tx,
+                events.c.host_id == labors.c.host_id,
+                successor.c.follows_id == labors.c.fate_id
+            )
+        ).as_scalar()
+
+        achieved = session.execute(
+            labors.update().where(
+                and_(
+                    labors.c.completion_time == None,
+                    labors.c.host_id.in_(tx_host_ids),
+                    closing_event_id != None
+                )
+            ).values(
+                completion_event_id=closing_event_id,
+                completion_time=now
+            )
+        ).rowcount
+
+        if achieved:
+            Quest.update_progress(session, closed=Quest.count_labors(
+                session, Labor.completion_event_id.in_(tx_event_ids)
+            ))
+
+            # Record which Fate closed the labors we just closed
+            closing_fate_id = select([func.min(successor.c.id)]).select_from(
+                successor.join(
+                    events,
+                    successor.c.creation_type_id == events.c.event_type_id
+                )
+            ).where(
+                and_(
+                    events.c.id == labors.c.completion_event_id,
+                    successor.c.follows_id == labors.c.fate_id
+                )
+            ).as_scalar()
+
+            session.execute(
+                labors.update().where(
+                    and_(
+                        labors.c.completion_event_id.in_(tx_event_ids),
+                        labors.c.closing_fate_id == None
+                    )
+                ).values(closing_fate_id=closing_fate_id)
+            )
+
+        # Each Fate that closed a labor and precedes other Fates continues
+        # the chain with a new labor, so a labor closed by several Fates at
+        # once continues several chains
+        created = 0
+        if achieved:
+            chained = select([
+                labors.c.host_id,
+                func.coalesce(labors.c.starting_labor_id, labors.c.id),
+                labors.c.completion_event_id,
+                successor.c.id,
+                labors.c.quest_id,
+                successor.c.for_creator,
+                successor.c.for_owner,
+                literal(now, DateTime),
+            ]).select_from(
+                labors.join(
+                    events, events.c.id == labors.c.completion_event_id
+                ).join(
+                    successor,
+                    and_(
+                        successor.c.follows_id == labors.c.fate_id,
+                        successor.c.creation_type_id == events.c.event_type_id
+                    )
+                )
+            ).where(
+                and_(
+                    events.c.tx == tx,
+                    exists().where(following.c.follows_id == successor.c.id)
+                )
+            )
+            created += session.execute(
+                labors.insert().from_select([
+                    "host_id", "starting_labor_id", "creation_event_id",
+                    "fate_id", "quest_id", "for_creator", "for_owner",
+                    "creation_time"
+                ], chained)
+            ).rowcount
+
+        # Finally, create the non-intermediate labors.  We only want to
+        # match up to the first fate found for each event type.
+        starting = and_(
+            following.c.creation_type_id == events.c.event_type_id,
+            following.c.follows_id == None
+        )
+        if starting_fates:
+            starting = and_(
+                starting,
+                following.c.id.in_([fate.id for fate in starting_fates])
+            )
+        first_fate_id = select(
+            [func.min(following.c.id)]
+        ).where(starting).as_scalar()
+
+        started = select([
+            events.c.host_id,
+            events.c.id,
+            fates.c.id,
+            literal(quest.id if quest else None, Integer),
+            fates.c.for_creator,
+            fates.c.for_owner,
+            literal(now, DateTime),
+        ]).select_from(
+            events.join(fates, fates.c.creation_type_id == events.c.event_type_id)
+        ).where(
+            and_(
+                events.c.tx == tx,
+                fates.c.id == first_fate_id
+            )
+        )
+        created += session.execute(
+            labors.insert().from_select([
+                "host_id", "creation_event_id", "fate_id", "quest_id",
+                "for_creator", "for_owner", "creation_time"
+            ], started)
+        ).rowcount
+
+        if created:
+            Quest.update_progress(session, created=Quest.count_labors(
+                session, Labor.creation_event_id.in_(tx_event_ids)
+            ))
+
+        # The statements above bypassed the ORM, so make sure we don't
+        # announce stale copies of the labors we already had loaded
+        session.flush()
+        session.expire_all()
+
+        if created:
+            Labor.announce_created(session, created)
+
+        if achieved:
+            achieved_labors = session.query(Labor).filter(
+                Labor.completion_event_id.in_(tx_event_ids)
+            ).all()
+            Labor.announce_achieved(session, achieved_labors)
+
+        session.commit()
+
     def href(self, base_uri):
         """Create an HREF value for this object
 
@@ -895,23 +2005,25 @@ class Event(Model):
     __tablename__ = "events"
 
     id = Column(Integer, primary_key=True)
-    host_id = Column(
-        Integer, ForeignKey("hosts.id"), nullable=False, index=True
-    )
+    host_id = Column(Integer, ForeignKey("hosts.id"), nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
     host = relationship(
         Host, lazy="joined", backref="events", order_by=timestamp
     )
     user = Column(String(length=64), nullable=False)
     event_type_id = Column(
-        Integer, ForeignKey("event_types.id"), nullable=False, index=True
+        Integer, ForeignKey("event_types.id"), nullable=False
     )
     event_type = relationship(EventType, lazy="joined", backref="events")
     note = Column(Text(), nullable=True)
     tx = Column(BigInteger, nullable=True, index=True)
 
+    # The events of a host or of an event type are always looked at in
+    # time order, so the composite indexes cover both the filter and the sort
     __table_args__ = (
-        Index("event_idx", id, host_id, event_type_id),
+        Index("event_host_time_idx", host_id, timestamp),
+        Index("event_type_time_idx", event_type_id, timestamp),
+        Index("event_timestamp_idx", timestamp, id),
     )
 
     @classmethod
@@ -957,9 +2069,11 @@ class Event(Model):
             session.rollback()
             raise
 
+        HostState.update_from_events(session, Event.id == event.id)
+
         # if we have any hooks defined, call the on_event method on each
         for hook in _HOOKS:
-            hook.on_event(event)
+            session.after_commit(hook.on_event, event)
 
         # refer to fates to see if this event should close or open any labors
         Fate.question_the_fates(session, [event], quest=quest)
@@ -972,29 +2086,69 @@ class Event(Model):
 
         Args:
             session: active database session
-            events: the list of Event dicts
+            events: the list of Event dicts, their tx and timestamp get
+                filled in as they are created
             tx: transaction id tied to these bulk creations
             quest: optional if events tied to quests
             flush: indicate if we should flush after we are done
             fate: the explicit list of fates of use when evaluating for labor creations
+
+        Returns:
+            the list of ids of the created Events, in the order given
         """
         log.debug("Event.create_many()")
 
-        session.execute(
-            Event.__table__.insert(), events
-        )
+        now = datetime.utcnow()
+        for event in events:
+            event["tx"] = tx
+            event.setdefault("timestamp", now)
 
-        events = session.query(Event).filter(Event.tx == tx).all()
+        event_ids = insert_many(
+            session, Event.__table__, events, key_column="tx"
+        )
         log.info("Created {} events".format(len(events)))
 
-        for event in events:
-            # if we have any hooks defined, call the on_event method on each
-            for hook in _HOOKS:
-                hook.on_event(event)
+        HostState.update_from_events(session, Event.tx == tx)
+
+        # if we have any hooks defined, call the on_event method on each
+        if _HOOKS:
+            for event in session.query(Event).filter(Event.id.in_(event_ids)):
+                for hook in _HOOKS:
+                    session.after_commit(hook.on_event, event)
 
         # refer to fates to see if these events should close or open any labors
-        Fate.question_the_fates(
-            session, events, quest=quest, starting_fates=fates
+        Fate.question_the_fates_by_tx(
+            session, tx, quest=quest, starting_fates=fates
+        )
+
+        return event_ids
+
+    @classmethod
+    def query_with_archive(cls, session, criteria):
+        """Query the Events, including the archived ones
+
+        The criteria are applied to the events and archived_events tables
+        separately, so each side can use its own indexes before the results
+        are combined.
+
+        Args:
+            session: an active database session
+            criteria: callable returning the list of filter clauses for the
+                given model (Event or ArchivedEvent)
+
+        Returns:
+            query of Events
+        """
+        names = [column.name for column in cls.__table__.c]
+        selects = []
+        for model in (cls, ArchivedEvent):
+            selected = select([model.__table__.c[name] for name in names])
+            for clause in criteria(model):
+                selected = selected.where(clause)
+            selects.append(selected)
+
+        return session.query(cls).select_entity_from(
+            union_all(*selects).alias("all_events")
         )
 
     def href(self, base_uri):
@@ -1051,6 +2205,240 @@ class Event(Model):
         return out
 
 
+class ArchivedEvent(Model):
+    """An ArchivedEvent is an Event that was moved out of the events table.
+
+    Old Events are rarely looked at, so they are moved to the compressed
+    archived_events table to keep the events table small.  Events closing
+    or opening Labors are never archived since the Labors refer to them.
+    ArchivedEvents keep the ids, and the columns, of the Events they were.
+
+    Attributes:
+        id: the database id of the original Event
+        host_id: the id of the Host to which this event pertains
+        timestamp: when the Event happened
+        user: the user or other arbitrary identifier for the registrar
+        event_type_id: the id of the EventType of the Event
+        note: an optional human readable note attached to this Event
+        tx: the transaction id of the Event
+    """
+
+    __tablename__ = "archived_events"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    host_id = Column(Integer, ForeignKey("hosts.id"), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    user = Column(String(length=64), nullable=False)
+    event_type_id = Column(
+        Integer, ForeignKey("event_types.id"), nullable=False
+    )
+    note = Column(Text(), nullable=True)
+    tx = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        Index("archived_event_host_time_idx", host_id, timestamp),
+        Index("archived_event_type_time_idx", event_type_id, timestamp),
+        Index("archived_event_timestamp_idx", timestamp, id),
+        {"mysql_row_format": "COMPRESSED"},
+    )
+
+    @classmethod
+    def archive(cls, session, before, batch_size=1000):
+        """Move the Events older than a given time to the archive
+
+        Events referenced by a Labor are kept, and so is the most recent
+        Event so the database never hands out the id of an archived Event
+        again.  The Events are moved in batches, each in its own
+        transaction, so the events table is never locked for long.
+
+        Args:
+            session: an active database session
+            before: the Events older than this are archived
+            batch_size: the number of Events to move at once
+
+        Returns:
+            the number of Events archived
+        """
+        events = Event.__table__
+        columns = [column.name for column in events.c]
+
+        latest_id = session.query(func.max(Event.id)).scalar()
+
+        total = 0
+        while True:
+            event_ids = [
+                event_id for event_id, in session.query(Event.id).filter(
+                    Event.timestamp < before,
+                    Event.id < latest_id,
+                    ~exists().where(Labor.creation_event_id == Event.id),
+                    ~exists().where(Labor.completion_event_id == Event.id)
+                ).order_by(Event.timestamp).limit(batch_size)
+            ]
+            if not event_ids:
+                break
+
+            try:
+                session.execute(
+                    cls.__table__.insert().from_select(
+                        columns,
+                        select([events.c[name] for name in columns]).where(
+                            events.c.id.in_(event_ids)
+                        )
+                    )
+                )
+                session.execute(
+                    events.delete().where(events.c.id.in_(event_ids))
+                )
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+
+            total += len(event_ids)
+            log.info("Archived {} events".format(total))
+
+        return total
+
+    @classmethod
+    def get_horizon(cls, session):
+        """Get the time up to which Events may have been archived
+
+        Returns:
+            the timestamp of the newest ArchivedEvent, or None if nothing
+            was archived
+        """
+        return session.query(func.max(cls.timestamp)).scalar()
+
+
+class HostState(Model):
+    """A HostState is the latest state of a Host in an EventType category.
+
+    It is kept up to date as Events are created, so the current state of
+    many Hosts can be read without looking at their Events.
+
+    Attributes:
+        host: the Host this state is for
+        category: the category of the EventType
+        state: the state of the latest EventType of that category
+        event_type_id: the id of the latest EventType of that category
+        event_id: the id of the latest Event of that category
+        timestamp: when the latest Event of that category happened
+    """
+
+    __tablename__ = "host_states"
+
+    host_id = Column(
+        Integer, ForeignKey("hosts.id"), primary_key=True, autoincrement=False
+    )
+    host = relationship(Host, lazy="joined")
+    category = Column(String(length=64), primary_key=True)
+    state = Column(String(length=32), nullable=False)
+    event_type_id = Column(
+        Integer, ForeignKey("event_types.id"), nullable=False
+    )
+    event_id = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+
+    @classmethod
+    def update_from_events(cls, session, criterion):
+        """Record new Events as the latest states of their Hosts
+
+        This is part of the transaction creating the Events.  Each state is
+        inserted, or replaced if it is older than the new Event, with a
+        single upsert so that concurrent first Events for the same Host and
+        category don't conflict.
+
+        Args:
+            session: an active database session
+            criterion: the filter selecting the new Events
+        """
+        latest = {}
+        for event in session.query(
+            Event.id, Event.host_id, Event.timestamp, Event.event_type_id,
+            EventType.category, EventType.state
+        ).join(EventType, Event.event_type_id == EventType.id).filter(criterion):
+            key = (event.host_id, event.category)
+            if key not in latest or (
+                (event.timestamp, event.id) >
+                (latest[key].timestamp, latest[key].id)
+            ):
+                latest[key] = event
+
+        if not latest:
+            return
+
+        session.execute(cls._upsert_statement(session), [
+            {
+                "host_id": event.host_id,
+                "category": event.category,
+                "state": event.state,
+                "event_type_id": event.event_type_id,
+                "event_id": event.id,
+                "timestamp": event.timestamp,
+            }
+            for event in latest.itervalues()
+        ])
+
+    @classmethod
+    def _upsert_statement(cls, session):
+        """Helper method to get the statement inserting a HostState, or
+        replacing the existing one if it is older
+
+        Returns:
+            the INSERT statement, taking the columns as parameters
+        """
+        insert = (
+            "INSERT INTO host_states "
+            "(host_id, category, state, event_type_id, event_id, timestamp) "
+            "VALUES (:host_id, :category, :state, :event_type_id, :event_id, "
+            ":timestamp) "
+        )
+
+        if session.bind.dialect.name == "mysql":
+            # MySQL assigns the columns in order, and each assignment sees
+            # the ones before it, so the columns compared are assigned last
+            newer = (
+                "(VALUES(timestamp), VALUES(event_id)) > (timestamp, event_id)"
+            )
+            return text(insert + "ON DUPLICATE KEY UPDATE " + ", ".join(
+                "{0} = IF({1}, VALUES({0}), {0})".format(column, newer)
+                for column in ("state", "event_type_id", "event_id", "timestamp")
+            ))
+
+        return text(
+            insert + "ON CONFLICT (host_id, category) DO UPDATE SET "
+            "state = excluded.state, event_type_id = excluded.event_type_id, "
+            "event_id = excluded.event_id, timestamp = excluded.timestamp "
+            "WHERE (excluded.timestamp, excluded.event_id) > "
+            "(host_states.timestamp, host_states.event_id)"
+        )
+
+    def to_dict(self, base_uri=None, expand=None):
+        """Translate this object into a dict for serialization
+
+        Args:
+            base_uri: if included, add an href to this resource
+            expand: unused, HostStates have no children
+
+        Returns:
+            dict representation of this object
+        """
+        out = {
+            "hostId": self.host_id,
+            "hostname": self.host.hostname,
+            "category": self.category,
+            "state": self.state,
+            "eventTypeId": self.event_type_id,
+            "eventId": self.event_id,
+            "timestamp": str(self.timestamp),
+        }
+
+        if base_uri:
+            out['href'] = self.host.href(base_uri) + "/state"
+
+        return out
+
+
 class Quest(Model):
     __tablename__ = "quests"
 
@@ -1061,8 +2449,23 @@ class Quest(Model):
     creator = Column(String(64), nullable=False)
     description = Column(String(4096), nullable=False)
 
+    # Counters of the Labors of this Quest, kept up to date as Labors are
+    # created, chained and completed so that progress is read off the row.
+    # Starting Labors are the ones not continuing a chain of Labors.
+    labor_count = Column(Integer, nullable=False, default=0)
+    closed_labor_count = Column(Integer, nullable=False, default=0)
+    starting_labor_count = Column(Integer, nullable=False, default=0)
+    unstarted_labor_count = Column(Integer, nullable=False, default=0)
+    inprogress_labor_count = Column(Integer, nullable=False, default=0)
+
+    _progress_columns = (
+        "labor_count", "closed_labor_count", "starting_labor_count",
+        "unstarted_labor_count", "inprogress_labor_count"
+    )
+
     __table_args__ = (
         Index("quest_idx", id, creator),
+        Index("quest_completion_idx", completion_time),
     )
 
     @classmethod
@@ -1091,21 +2494,42 @@ class Quest(Model):
             create: if True, Events will be created; if False, reclaim existing Labors
             description: a required human readable text to describe this Quest
         """
+        if hosts is None:
+            raise exc.ValidationError("Quest must have a list of hosts")
+
+        quest = cls.embark(
+            session, creator, fate_id, target_time=target_time,
+            description=description
+        )
+        quest.add_hosts(fate_id, [host.id for host in hosts], create=create)
+        quest.announce_embarked(fate_id, len(hosts))
+
+        return quest
+
+    @classmethod
+    def embark(
+            cls, session, creator, fate_id, target_time=None,
+            description=None
+    ):
+        """Create a new Quest without any Hosts yet
+
+        Args:
+            session: an active database session
+            creator: the person or system creating the Quest
+            fate_id: the explicit Fate for which to create events and labors
+            target_time: the optional targeted date and time of Quest completion
+            description: a required human readable text to describe this Quest
+
+        Returns:
+            the newly created Quest
+        """
         if creator is None:
             raise exc.ValidationError("Quest must have a creator")
         if target_time and target_time <= datetime.utcnow():
             raise exc.ValidationError("Quest target date must be in future")
-        if hosts is None:
-            raise exc.ValidationError("Quest must have a list of hosts")
         if fate_id is None:
             raise exc.ValidationError("Quest must have a Fate")
 
-        if fate_id:
-            fate = session.query(Fate).get(fate_id)
-            creation_event_type = fate.creation_event_type
-        else:
-            fate = None
-
         try:
             quest = cls(
                 creator=creator, description=description,
@@ -1118,65 +2542,81 @@ class Quest(Model):
             session.rollback()
             raise
 
+        return quest
+
+    def add_hosts(self, fate_id, host_ids, create=True):
+        """Start this Quest on Hosts, in a single transaction
+
+        If create is True, we will create the Events of the EventType
+        starting the Fate for all the Hosts and tie the created Labors to
+        this Quest.  If create is False, we will claim the existing open
+        Labors of the Hosts created by an Event of that EventType.
+
+        Args:
+            fate_id: the explicit Fate for which to create events and labors
+            host_ids: the ids of the Hosts to start this Quest on
+            create: if True, Events will be created; if False, reclaim
+                existing Labors
+        """
+        session = self.session
+        fate = session.query(Fate).get(fate_id)
+        creation_event_type = fate.creation_event_type
+
         # if we are supposed to create events, we want to do them as a giant batch
-        events_to_create = []
         if create:
-            for host in hosts:
-                events_to_create.append({
-                    "host_id": host.id,
-                    "user": creator,
+            tx = EventBatch.allocate(session)
+            events_to_create = [
+                {
+                    "host_id": host_id,
+                    "user": self.creator,
                     "event_type_id": creation_event_type.id,
-                    "tx": quest.id
-                })
-            if fate:
-                Event.create_many(
-                    session,
-                    events_to_create,
-                    quest.id,
-                    quest=quest,
-                    fates=[fate]
-                )
-            else:
-                Event.create_many(
-                    session,
-                    events_to_create,
-                    quest.id,
-                    quest=quest
-                )
+                    "tx": tx
+                }
+                for host_id in host_ids
+            ]
+            Event.create_many(
+                session,
+                events_to_create,
+                tx,
+                quest=self,
+                fates=[fate]
+            )
         else:
-            open_labors = (
-                session.query(Labor).filter(
-                    Labor.completion_event == None
-                ).all()
+            Labor.reclaim_many(
+                session, self, host_ids, creation_event_type.id
             )
 
-            for open_labor in open_labors:
-                if (
-                    open_labor.creation_event.event_type
-                        == creation_event_type
-                        and open_labor.host in hosts
-                ):
-                    open_labor.add_to_quest(quest)
-
         session.flush()
         session.commit()
 
-        slack_message(
+    def announce_embarked(self, fate_id, host_count):
+        """Send out the notifications for a Quest that was just started
+
+        Args:
+            fate_id: the Fate the Quest was started with
+            host_count: the number of Hosts the Quest was started on
+        """
+        session = self.session
+        fate = session.query(Fate).get(fate_id)
+        creation_event_type = fate.creation_event_type
+
+        notify_slack(
+            session,
             "*Quest {}* created by {}: "
             "{} hosts started with {} {}\n\t\"{}\"".format(
-                quest.id,
-                quest.creator,
-                len(hosts),
+                self.id,
+                self.creator,
+                host_count,
                 creation_event_type.category,
                 creation_event_type.state,
-                quest.description
+                self.description
             )
         )
 
         msg = "QUEST {} STARTED:\n\n\t\"{}\"\n\n".format(
-            quest.id,
+            self.id,
             textwrap.fill(
-                quest.description,
+                self.description,
                 width=60, subsequent_indent="\t "
             )
         )
@@ -1185,22 +2625,28 @@ class Quest(Model):
             "There are {} labors in the Quest.  "
             "They were started with the event \"{} {}.\""
         ).format(
-            len(quest.labors),
+            self.labor_count,
             creation_event_type.category,
             creation_event_type.state,
         )
 
-        email_message(
-            quest.creator, "Quest {} started".format(quest.id),
+        notify_email(
+            session,
+            self.creator, "Quest {} started".format(self.id),
             msg
         )
-        return quest
+
+        session.commit()
 
     def check_for_victory(self):
         """Test to see if all the Labors are completed.
 
-        Called when a labor is completed.
+        Called when a labor is completed.  A Quest still being created by a
+        QuestJob is not complete yet, whatever the state of its Labors.
         """
+        if QuestJob.is_running(self.session, self.id):
+            return
+
         labors = self.session.query(Labor).filter(
             and_(
                 Labor.quest_id == self.id,
@@ -1210,12 +2656,15 @@ class Quest(Model):
 
         if labors == 0:
             self.update(
-                completion_time=datetime.utcnow()
+                completion_time=datetime.utcnow(), commit=False
+            )
+            notify_slack(
+                self.session,
+                "*Quest {}* completed:\n\t\"{}\"".format(
+                    self.id,
+                    self.description
+                )
             )
-            slack_message("*Quest {}* completed:\n\t\"{}\"".format(
-                self.id,
-                self.description
-            ))
 
             msg = "QUEST {} COMPLETED:\n\n\t\"{}\"\n\n".format(
                 self.id,
@@ -1236,6 +2685,7 @@ class Quest(Model):
             # if we aren't going to be sending email notifications, we
             # can just stop here
             if not settings.email_notifications:
+                self.session.commit()
                 return
 
             # Get all the hosts that were in this labor
@@ -1276,10 +2726,12 @@ class Quest(Model):
                 )
 
             # Email quest creator and CC the participants
-            email_message(
+            notify_email(
+                self.session,
                 self.creator, "Quest {} completed".format(self.id),
                 msg, cc=owners
             )
+            self.session.commit()
 
     @classmethod
     def get_open_quests(cls, session):
@@ -1314,6 +2766,8 @@ class Quest(Model):
 
     @classmethod
     def email_quest_updates(cls, quests_updated):
+        # send all the updates over the same SMTP connection
+        transport = SmtpTransport()
         for quest in quests_updated.itervalues():
             msg = "QUEST {} UPDATED:\n\n\t\"{}\"\n\n".format(
                 quest["quest"].id,
@@ -1368,49 +2822,266 @@ class Quest(Model):
                     )
                 )
 
-            email_message(
+            notify_email(
+                quest["quest"].session,
                 quest["quest"].creator,
                 "Quest {} updated".format(quest["quest"].id),
-                msg
+                msg, transport=transport
             )
 
-    def calculate_progress(self, json):
-        """Calcuate quest progress, add it to the json body and return it"""
-        labors = self.session.query(Labor).filter(
-            Labor.quest_id == self.id
-        ).all()
+        transport.flush()
+        transport.close()
 
-        total_complete_count = 0
-        unique_labor_count = 0
-        unstarted_labors_count = 0
-        inprogress_labors_count = 0
+    @classmethod
+    def count_labors(cls, session, criterion):
+        """Count the Labors of Quests matching a criterion
 
-        for labor in labors:
-            if labor.completion_time:
-                total_complete_count += 1
+        Args:
+            session: an active database session
+            criterion: the filter on Labors to count
+
+        Returns:
+            dict mapping (Quest id, True if the Labors are chained) to the
+            number of Labors
+        """
+        chained = Labor.starting_labor_id != None
+        counts = (
+            session.query(Labor.quest_id, chained, func.count(Labor.id))
+            .filter(criterion, Labor.quest_id != None)
+            .group_by(Labor.quest_id, chained)
+        )
+        return dict(
+            ((quest_id, bool(is_chained)), count)
+            for quest_id, is_chained, count in counts
+        )
+
+    @classmethod
+    def update_progress(cls, session, created=None, closed=None):
+        """Update the progress counters of Quests for Labors that were
+        created or closed, with a single statement.  Negative counts take
+        Labors away, as when a Labor moves to another Quest.
 
-            if not labor.starting_labor_id:
-                unique_labor_count += 1
-                if not labor.completion_time:
-                    unstarted_labors_count += 1
+        Args:
+            session: an active database session
+            created: dict mapping (Quest id, True if the Labors are
+                chained) to the number of Labors created
+            closed: dict mapping (Quest id, True if the Labors are
+                chained) to the number of Labors closed
+        """
+        columns = cls._progress_columns
+        deltas = {}
+        for counts, sign in ((created or {}, 1), (closed or {}, -1)):
+            for (quest_id, chained), count in counts.iteritems():
+                if quest_id is None or not count:
+                    continue
+                delta = deltas.setdefault(quest_id, dict.fromkeys(columns, 0))
+                if sign > 0:
+                    delta["labor_count"] += count
+                    if not chained:
+                        delta["starting_labor_count"] += count
+                else:
+                    delta["closed_labor_count"] += count
+                delta[
+                    "inprogress_labor_count" if chained
+                    else "unstarted_labor_count"
+                ] += sign * count
 
-            if not labor.completion_time and labor.starting_labor_id:
-                inprogress_labors_count += 1
+        if not deltas:
+            return
 
-        completed_labors_count = (
-            unique_labor_count
-            - unstarted_labors_count
-            - inprogress_labors_count
+        table = cls.__table__
+        session.execute(
+            table.update().where(table.c.id == bindparam("b_id")).values(
+                dict(
+                    (column, table.c[column] + bindparam("b_" + column))
+                    for column in columns
+                )
+            ),
+            [
+                dict(
+                    [("b_id", quest_id)] + [
+                        ("b_" + column, count)
+                        for column, count in delta.iteritems()
+                    ]
+                )
+                for quest_id, delta in deltas.iteritems()
+            ]
+        )
+
+        # Don't serve stale counters from the Quests already loaded
+        for obj in session.identity_map.values():
+            if isinstance(obj, Quest) and obj.id in deltas:
+                session.expire(obj, cls._progress_columns)
+
+    @classmethod
+    def get_progress(cls, session, quest_ids):
+        """Count the Labors of Quests from the labors table, with one
+        GROUP BY per chunk of Quests
+
+        Args:
+            session: an active database session
+            quest_ids: the ids of the Quests
+
+        Returns:
+            dict mapping each Quest id to a dict of its progress counters
+        """
+        progress = dict(
+            (quest_id, dict.fromkeys(cls._progress_columns, 0))
+            for quest_id in quest_ids
+        )
+
+        starting = Labor.starting_labor_id == None
+        open_labor = Labor.completion_time == None
+        for chunk in chunked(sorted(progress)):
+            for quest_id, is_starting, is_open, count in (
+                session.query(
+                    Labor.quest_id, starting, open_labor, func.count(Labor.id)
+                )
+                .filter(Labor.quest_id.in_(chunk))
+                .group_by(Labor.quest_id, starting, open_labor)
+            ):
+                counts = progress[quest_id]
+                counts["labor_count"] += count
+                if not is_open:
+                    counts["closed_labor_count"] += count
+                if is_starting:
+                    counts["starting_labor_count"] += count
+                    if is_open:
+                        counts["unstarted_labor_count"] += count
+                elif is_open:
+                    counts["inprogress_labor_count"] += count
+
+        return progress
+
+    @classmethod
+    def load_labors(cls, session, quests):
+        """Load the Labors of Quests with one query per chunk of Quests
+        rather than one query per Quest
+
+        Args:
+            session: an active database session
+            quests: the Quests whose labors to load
+        """
+        labors = dict((quest.id, []) for quest in quests)
+        for chunk in chunked(sorted(labors)):
+            for labor in session.query(Labor).filter(
+                Labor.quest_id.in_(chunk)
+            ).order_by(Labor.id):
+                labors[labor.quest_id].append(labor)
+
+        for quest in quests:
+            set_committed_value(quest, "labors", labors[quest.id])
+
+    @classmethod
+    def touching_hosts(cls, host_ids):
+        """Get the criterion matching the Quests with Labors for any of the
+        given Hosts
+
+        The Labors are looked up by Host with a semi-join per chunk of
+        Hosts, so each Quest is matched once however many of its Labors are
+        for those Hosts.
+
+        Args:
+            host_ids: the ids of the Hosts
+
+        Returns:
+            the criterion to filter a Quest query with
+        """
+        host_ids = sorted(set(host_ids))
+        if not host_ids:
+            return false()
+
+        return or_(*[
+            exists().where(and_(
+                Labor.quest_id == cls.id, Labor.host_id.in_(chunk)
+            ))
+            for chunk in chunked(host_ids)
+        ])
+
+    @classmethod
+    def repair_progress(cls, session, quest_ids=None):
+        """Recompute the progress counters of Quests from their Labors
+
+        Args:
+            session: an active database session
+            quest_ids: the ids of the Quests to repair, all of them if None
+
+        Returns:
+            the ids of the Quests whose counters were wrong
+        """
+        columns = cls._progress_columns
+        quests = session.query(
+            cls.id, *[getattr(cls, column) for column in columns]
+        )
+        if quest_ids is not None:
+            quests = quests.filter(cls.id.in_(quest_ids))
+        stored = dict(
+            (quest[0], dict(zip(columns, quest[1:]))) for quest in quests
         )
 
-        percent_complete = round(
-            total_complete_count / len(labors) * 100,
-            2
+        actual = cls.get_progress(session, stored.keys())
+
+        repaired = sorted(
+            quest_id for quest_id in stored
+            if stored[quest_id] != actual[quest_id]
+        )
+        if repaired:
+            table = cls.__table__
+            session.execute(
+                table.update().where(table.c.id == bindparam("b_id")).values(
+                    dict(
+                        (column, bindparam("b_" + column))
+                        for column in columns
+                    )
+                ),
+                [
+                    dict(
+                        [("b_id", quest_id)] + [
+                            ("b_" + column, count)
+                            for column, count in actual[quest_id].iteritems()
+                        ]
+                    )
+                    for quest_id in repaired
+                ]
+            )
+        session.commit()
+
+        return repaired
+
+    def calculate_progress(self, json, progress=None):
+        """Add the progress of this quest to the json body and return it
+
+        Args:
+            json: the json body of this quest
+            progress: the optional dict of progress counters, as returned by
+                get_progress, to use instead of the ones on the quest row
+
+        Returns:
+            the json body
+        """
+        if progress is None:
+            progress = dict(
+                (column, getattr(self, column))
+                for column in self._progress_columns
+            )
+
+        completed_labors_count = (
+            progress["starting_labor_count"]
+            - progress["unstarted_labor_count"]
+            - progress["inprogress_labor_count"]
         )
 
-        json['totalLabors'] = unique_labor_count
-        json['unstartedLabors'] = unstarted_labors_count
-        json['inprogressLabors'] = inprogress_labors_count
+        if progress["labor_count"]:
+            percent_complete = round(
+                progress["closed_labor_count"] / progress["labor_count"] * 100,
+                2
+            )
+        else:
+            percent_complete = 0.0
+
+        json['totalLabors'] = progress["starting_labor_count"]
+        json['unstartedLabors'] = progress["unstarted_labor_count"]
+        json['inprogressLabors'] = progress["inprogress_labor_count"]
         json['completedLabors'] = completed_labors_count
         json['percentComplete'] = percent_complete
 
@@ -1517,15 +3188,11 @@ class Labor(Model):
         Fate, lazy="joined", foreign_keys=[closing_fate_id]
     )
 
-    quest_id = Column(
-        Integer, ForeignKey("quests.id"), nullable=True, index=True
-    )
+    quest_id = Column(Integer, ForeignKey("quests.id"), nullable=True)
 
     quest = relationship(Quest, lazy="joined", backref="labors")
 
-    host_id = Column(
-        Integer, ForeignKey("hosts.id"), nullable=False, index=True
-    )
+    host_id = Column(Integer, ForeignKey("hosts.id"), nullable=False)
 
     host = relationship(
         Host, lazy="joined", backref="labors"
@@ -1562,10 +3229,13 @@ class Labor(Model):
         foreign_keys=[completion_event_id]
     )
 
+    # Open labors are looked up by host when evaluating Fates and by quest
+    # when checking for victory, so index them in those combinations.  The
+    # quests touching some hosts are found from the host and quest alone.
     __table_args__ = (
-        Index(
-            "labor_idx", id, quest_id, creation_event_id, completion_event_id
-        ),
+        Index("labor_host_completion_idx", host_id, completion_time),
+        Index("labor_quest_completion_idx", quest_id, completion_event_id),
+        Index("labor_host_quest_idx", host_id, quest_id),
     )
 
     @classmethod
@@ -1580,11 +3250,29 @@ class Labor(Model):
         session.execute(
             Labor.__table__.insert(), labors
         )
-        session.flush()
-        slack_message("*Labors:* created {} labor{}".format(
-            len(labors),
-            "s" if len(labors) > 1 else ""
+        Quest.update_progress(session, created=Counter(
+            (labor.get("quest_id"), labor.get("starting_labor_id") is not None)
+            for labor in labors
         ))
+        session.flush()
+        Labor.announce_created(session, len(labors))
+
+    @classmethod
+    def announce_created(cls, session, count):
+        """Send out the notifications for Labors that were just created
+
+        Args:
+            session: an active database session
+            count: the number of Labors created
+        """
+        notify_slack(
+            session,
+            "*Labors:* created {} labor{}".format(
+                count,
+                "s" if count > 1 else ""
+            ),
+            summary={"labors_created": count}
+        )
 
     @classmethod
     def achieve_many(cls, session, labor_dicts):
@@ -1595,18 +3283,9 @@ class Labor(Model):
             labor_dicts: the list of Labors dicts to achieve
                 (with keys labor and event)
         """
-        # here we will track the quests that need to get checked for victory
-        quests_to_check = []
-
-        # here we will organize the labors into quests so we can send an email
-        # of the updated quests
-        quests_updated = {}
-
-        # here we will create a giant string of the message to send to Slack
-        all_messages = ""
-
         # Let us examine and update the completion of each labor with the given
         # event, as we were passed in the dict
+        achieved_labors = []
         for labor_dict in labor_dicts:
             labor = labor_dict["labor"]
             event = labor_dict["event"]
@@ -1616,7 +3295,38 @@ class Labor(Model):
                 closing_fate_id=fate['id'],
                 flush=False, commit=False
             )
+            achieved_labors.append(labor)
+
+        Quest.update_progress(session, closed=Counter(
+            (labor.quest_id, labor.starting_labor_id is not None)
+            for labor in achieved_labors
+        ))
+        session.flush()
+
+        Labor.announce_achieved(session, achieved_labors)
+
+        session.commit()
+
+    @classmethod
+    def announce_achieved(cls, session, labors):
+        """Send out the notifications for Labors that were just achieved
+        and check the Quests they belong to for victory.
 
+        Args:
+            session: an active database session
+            labors: the list of Labors that were achieved
+        """
+        # here we will track the quests that need to get checked for victory
+        quests_to_check = []
+
+        # here we will organize the labors into quests so we can send an email
+        # of the updated quests
+        quests_updated = {}
+
+        # here we will create a giant string of the message to send to Slack
+        all_messages = ""
+
+        for labor in labors:
             # add to the message we will post to Slack
             all_messages += (
                 "*Labor {}* completed.\n\t{}: {} {} => {} {}{}\n\n".format(
@@ -1644,14 +3354,16 @@ class Labor(Model):
                 if labor.quest not in quests_to_check:
                     quests_to_check.append(labor.quest)
 
-        session.flush()
-        session.commit()
-
-        if len(labor_dicts) < 10:
-            slack_message(all_messages)
+        summary = {
+            "labors_completed": len(labors),
+            "quest_ids": quests_updated.keys(),
+        }
+        if len(labors) < 10:
+            notify_slack(session, all_messages, summary=summary)
         else:
-            slack_message(
-                "*Labors:* completed {} Labors".format(len(labor_dicts))
+            notify_slack(
+                session, "*Labors:* completed {} Labors".format(len(labors)),
+                summary=summary
             )
 
         Quest.email_quest_updates(quests_updated)
@@ -1692,12 +3404,79 @@ class Labor(Model):
         """
         self.update(ack_time=datetime.utcnow(), ack_user=user)
 
+    @classmethod
+    def reclaim_many(cls, session, quest, host_ids, event_type_id):
+        """Claim the open Labors of Hosts for a Quest
+
+        The Labors are claimed with one UPDATE per chunk of Hosts, found
+        through the labor_host_completion_idx index, instead of loading
+        the open Labors into the session.
+
+        Args:
+            session: an active database session
+            quest: the Quest claiming the Labors
+            host_ids: the ids of the Hosts whose Labors to claim
+            event_type_id: the id of the EventType that created the Labors
+        """
+        labors = Labor.__table__
+        events = Event.__table__
+        created_by_type = exists().where(and_(
+            events.c.id == labors.c.creation_event_id,
+            events.c.event_type_id == event_type_id
+        ))
+
+        try:
+            for chunk in chunked(sorted(set(host_ids))):
+                claimed = and_(
+                    labors.c.host_id.in_(chunk),
+                    labors.c.completion_time == None,
+                    created_by_type
+                )
+
+                # The claimed Labors leave the Quests they were part of
+                removed = Quest.count_labors(session, claimed)
+                Quest.update_progress(session, created=dict(
+                    (key, -count) for key, count in removed.iteritems()
+                ))
+
+                session.execute(
+                    labors.update().where(claimed).values(quest_id=quest.id)
+                )
+
+            Quest.update_progress(session, created=Quest.count_labors(
+                session, labors.c.quest_id == quest.id
+            ))
+        except Exception:
+            session.rollback()
+            raise
+
+        # The statements above bypassed the ORM, so the Labors and Quests
+        # we already had loaded are stale
+        session.expire_all()
+
     def add_to_quest(self, quest):
         """Tie this labor to a particular Quest
 
         Args:
             quest: the quest that should own this Labor
         """
+        if self.quest_id == quest.id:
+            return
+
+        chained = self.starting_labor_id is not None
+        closed = self.completion_event_id is not None
+        try:
+            Quest.update_progress(
+                self.session,
+                created={(self.quest_id, chained): -1, (quest.id, chained): 1},
+                closed={
+                    (self.quest_id, chained): -closed,
+                    (quest.id, chained): int(closed),
+                }
+            )
+        except Exception:
+            self.session.rollback()
+            raise
         self.update(quest=quest)
 
     def href(self, base_uri):
@@ -1790,3 +3569,179 @@ class Labor(Model):
         return out
 
 
+class QuestJob(Model):
+    """A QuestJob is the creation of a Quest running in the background.
+
+    Quests over many Hosts take too long to create within a request, so
+    they can be created by a job instead, a chunk of Hosts at a time, while
+    the client polls the job for its progress.
+
+    Attributes:
+        id: the unique database id
+        status: pending, running, completed or failed
+        creator: the person or system creating the Quest
+        fate_id: the Fate starting the Labors of the Quest
+        description: the description of the Quest
+        target_time: the optional targeted date and time of Quest completion
+        quest_id: the id of the Quest, once it was embarked on
+        host_count: the number of Hosts to start the Quest on
+        hosts_processed: the number of Hosts the Quest was started on so far
+        labors_created: the number of Labors of the Quest so far
+        error: the error that failed the job, if it failed
+        creation_time: when the job was submitted
+        update_time: when the job last made progress
+        completion_time: when the job completed or failed
+    """
+
+    __tablename__ = "quest_jobs"
+
+    id = Column(Integer, primary_key=True)
+    status = Column(String(16), nullable=False, default="pending")
+    creator = Column(String(64), nullable=False)
+    fate_id = Column(Integer, ForeignKey("fates.id"), nullable=False)
+    description = Column(String(4096), nullable=False)
+    target_time = Column(DateTime, nullable=True)
+    quest_id = Column(Integer, ForeignKey("quests.id"), nullable=True)
+    host_count = Column(Integer, nullable=False, default=0)
+    hosts_processed = Column(Integer, nullable=False, default=0)
+    labors_created = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    creation_time = Column(DateTime, default=datetime.utcnow, nullable=False)
+    update_time = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow,
+        nullable=False
+    )
+    completion_time = Column(DateTime, nullable=True)
+
+    @classmethod
+    def is_running(cls, session, quest_id):
+        """Check if a Quest is still being created by a job
+
+        Args:
+            session: an active database session
+            quest_id: the id of the Quest
+
+        Returns:
+            True if a pending or running job is adding Hosts to the Quest
+        """
+        return session.query(cls.id).filter(
+            cls.quest_id == quest_id,
+            cls.status.in_(("pending", "running"))
+        ).first() is not None
+
+    def run_step(self, host_ids):
+        """Do the next step of this job, in its own transaction
+
+        The first step embarks on the Quest, the following ones start it on
+        a chunk of Hosts each and the last one sends out the notifications.
+
+        Args:
+            host_ids: the ids of the Hosts to start the Quest on
+
+        Returns:
+            True if there are more steps to do
+        """
+        session = self.session
+        if self.quest_id is None:
+            quest = Quest.embark(
+                session, self.creator, self.fate_id,
+                target_time=self.target_time, description=self.description
+            )
+            self.update(quest_id=quest.id, status="running")
+            return True
+
+        quest = session.query(Quest).get(self.quest_id)
+        start = self.hosts_processed
+        chunk = host_ids[start:start + HOST_CHUNK_SIZE]
+        if chunk:
+            quest.add_hosts(self.fate_id, chunk)
+            self.update(
+                hosts_processed=self.hosts_processed + len(chunk),
+                labors_created=quest.labor_count
+            )
+            return True
+
+        quest.announce_embarked(self.fate_id, self.host_count)
+        self.update(status="completed", completion_time=datetime.utcnow())
+
+        # Victory was held off while the job was running, and the Labors
+        # may well all be closed by now
+        quest.check_for_victory()
+        return False
+
+    def fail(self, error):
+        """Mark this job as failed
+
+        Args:
+            error: the error that failed the job
+        """
+        self.update(
+            status="failed", error="{}".format(error),
+            completion_time=datetime.utcnow()
+        )
+        if self.quest_id is not None:
+            self.session.query(Quest).get(self.quest_id).check_for_victory()
+
+    def check_abandoned(self):
+        """Fail this job if it made no progress for quest_job_timeout
+        seconds, as happens when the server process running it went away
+
+        Returns:
+            True if the job was abandoned
+        """
+        if self.status not in ("pending", "running"):
+            return False
+
+        idle = datetime.utcnow() - self.update_time
+        if idle.total_seconds() < settings.quest_job_timeout:
+            return False
+
+        self.fail("Abandoned after making no progress since {}".format(
+            self.update_time
+        ))
+        return True
+
+    def href(self, base_uri):
+        """Create an HREF value for this object
+
+        Args:
+            base_uri: the base URI under which this resource will exist
+
+        Returns:
+            URI for this resource
+        """
+        return "{}/quests/jobs/{}".format(base_uri, self.id)
+
+    def to_dict(self, base_uri=None, expand=None):
+        """Translate this object into a dict for serialization
+
+        Args:
+            base_uri: if included, add an href to this resource
+            expand: list of children to expand
+
+        Returns:
+            dict representation of this object
+        """
+        out = {
+            "id": self.id,
+            "state": self.status,
+            "creator": self.creator,
+            "fateId": self.fate_id,
+            "description": self.description,
+            "targetTime": str(self.target_time) if self.target_time else None,
+            "questId": self.quest_id,
+            "hostCount": self.host_count,
+            "hostsProcessed": self.hosts_processed,
+            "laborsCreated": self.labors_created,
+            "error": self.error,
+            "creationTime": str(self.creation_time),
+            "updateTime": str(self.update_time),
+            "completionTime": (
+                str(self.completion_time) if self.completion_time else None
+            ),
+        }
+
+        if base_uri:
+            out['href'] = self.href(base_uri)
+
+        return out
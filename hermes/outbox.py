@@ -0,0 +1,61 @@
+import logging
+import threading
+
+from .models import OutboxMessage
+
+
+log = logging.getLogger(__name__)
+
+
+class OutboxWorker(threading.Thread):
+    """Background thread that delivers the notifications queued in the outbox.
+
+    Args:
+        session_factory: callable returning a new database session
+        interval: the number of seconds to wait between empty polls
+        batch_size: the maximum number of notifications to deliver at once
+        max_attempts: the number of attempts after which we give up
+    """
+    def __init__(self, session_factory, interval=5, batch_size=100,
+                 max_attempts=5):
+        super(OutboxWorker, self).__init__(name="outbox-worker")
+        self.daemon = True
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def drain(self):
+        """Deliver queued notifications until the outbox is empty
+
+        Returns:
+            the number of notifications that were delivered
+        """
+        total = 0
+        session = self.session_factory()
+        try:
+            while True:
+                delivered = OutboxMessage.deliver_pending(
+                    session, limit=self.batch_size,
+                    max_attempts=self.max_attempts
+                )
+                total += delivered
+                if delivered < self.batch_size:
+                    break
+        finally:
+            session.close()
+
+        return total
+
+    def run(self):
+        log.info("Starting outbox worker")
+        while not self.stopped.is_set():
+            try:
+                self.drain()
+            except Exception:
+                log.exception("Error draining the outbox")
+            self.stopped.wait(self.interval)
@@ -5,14 +5,19 @@ import os
 HANDLERS = [
     # Hosts
     (r"/api/v1/hosts\/?", api.HostsHandler),
+    (r"/api/v1/hosts/(?P<hostname>.*)/state\/?", api.HostStateHandler),
     (r"/api/v1/hosts/(?P<hostname>.*)\/?", api.HostHandler),
 
+    # Host States
+    (r"/api/v1/hoststates\/?", api.HostStatesHandler),
+
     # Event Types
     (r"/api/v1/eventtypes\/?", api.EventTypesHandler),
     (r"/api/v1/eventtypes/(?P<id>\d+)\/?", api.EventTypeHandler),
 
     # Events
     (r"/api/v1/events\/?", api.EventsHandler),
+    (r"/api/v1/events/stream\/?", api.EventsStreamHandler),
     (r"/api/v1/events/(?P<id>\d+)\/?", api.EventHandler),
 
     # Fates
@@ -25,9 +30,14 @@ HANDLERS = [
 
     # Quests
     (r"/api/v1/quests\/?", api.QuestsHandler),
+    (r"/api/v1/quests/jobs/(?P<id>\d+)\/?", api.QuestJobHandler),
     (r"/api/v1/quests/(?P<id>\d+)\/?", api.QuestHandler),
     (r"/api/v1/quests/(?P<id>\d+)/mail\/?", api.QuestMailHandler),
 
+    # Live changes
+    (r"/api/v1/changes\/?", api.ChangesHandler),
+    (r"/api/v1/changes/ws\/?", api.ChangesSocketHandler),
+
     # Queries to 3rd party tools
     (r"/api/v1/extquery\/?", api.ExtQueryHandler),
 
@@ -37,6 +47,9 @@ HANDLERS = [
     # Query the server for its configs
     (r"/api/v1/serverConfig", api.ServerConfig),
 
+    # Query the server process for its statistics
+    (r"/api/v1/serverStats", api.ServerStats),
+
     # Frontend Handlers
     (
         r"/((?:css|fonts|img|js|vendor|templates)/.*)",
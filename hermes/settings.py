@@ -50,6 +50,8 @@ settings = Settings({
     "frontend": "https://hermes.company.net",
     "slack_webhook": None,
     "slack_proxyhost": None,
+    "slack_window": 0,
+    "slack_max_rate": 10,
     "debug": False,
     "domain": "localhost",
     "port": 8990,
@@ -57,6 +59,7 @@ settings = Settings({
     "email_notifications": False,
     "email_sender_address": "hermes@localhost",
     "email_always_copy": "",
+    "smtp_server": "localhost",
     "restrict_networks": [],
     "bind_address": None,
     "api_xsrf_enabled": True,
@@ -69,4 +72,16 @@ settings = Settings({
     "fullstory_id": None,
     "strongpoc_server": None,
     "count_events": True,
+    "totals_cache_ttl": 60,
+    "event_batch_window": 0,
+    "notification_outbox": False,
+    "outbox_interval": 5,
+    "outbox_max_attempts": 5,
+    "change_feed_interval": 1000,
+    "change_feed_timeout": 30,
+    "change_feed_grace": 30,
+    "event_archive_days": 90,
+    "host_cache_size": 100000,
+    "host_cache_check_interval": 5,
+    "quest_job_timeout": 300,
 })
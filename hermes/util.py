@@ -2,11 +2,15 @@
 Project-wide utilities.
 """
 
+from collections import OrderedDict
 import logging
 import random
 import requests
 import smtplib
+import socket
 import string
+import threading
+import time
 
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -30,11 +34,78 @@ def id_generator(size=6, chars=string.ascii_lowercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
 
 
-def slack_message(message):
+class LruCache(object):
+    """A bounded mapping that evicts the least recently used entries.
+
+    Args:
+        max_size: the maximum number of entries kept
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Look up an entry, marking it as the most recently used
+
+        Args:
+            key: the key of the entry
+
+        Returns:
+            the value of the entry, or None if it isn't cached
+        """
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Cache an entry, evicting the least recently used ones if full
+
+        Args:
+            key: the key of the entry
+            value: the value of the entry
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all the entries, keeping the statistics"""
+        self.entries.clear()
+
+    def stats(self):
+        """Get the statistics of this cache
+
+        Returns:
+            dict of the size, hits, misses, evictions and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / float(lookups) if lookups else None,
+        }
+
+
+def slack_message(message, raise_errors=False):
     """Post a message to Slack if a webhook as been defined.
 
     Args:
         message: the content of the Slack post
+        raise_errors: if True, raise errors instead of logging them
     """
     if not settings.slack_webhook:
         return
@@ -57,11 +128,245 @@ def slack_message(message):
         response = requests.post(
             settings.slack_webhook, json=json, proxies=proxies
         )
+        if raise_errors:
+            response.raise_for_status()
     except Exception as exc:
+        if raise_errors:
+            raise
         log.warn("Error writing to Slack: {}".format(exc.message))
 
 
-def email_message(recipients, subject, message, html_message=None, cc=None, sender=None):
+def summarize_slack_messages(messages):
+    """Combine many Slack messages into the content of a single post.
+
+    Messages that carry a summary (ex: {"labors_completed": 12,
+    "quest_ids": [1, 2]}) are added up into one line per kind, while the
+    other messages are included as they are.
+
+    Args:
+        messages: list of (message, summary) tuples
+
+    Returns:
+        the content of the Slack post
+    """
+    if len(messages) == 1:
+        return messages[0][0]
+
+    labors_created = 0
+    labors_completed = 0
+    quest_ids = set()
+    others = []
+    for message, summary in messages:
+        if not summary:
+            others.append(message)
+            continue
+        labors_created += summary.get("labors_created", 0)
+        labors_completed += summary.get("labors_completed", 0)
+        quest_ids.update(summary.get("quest_ids", []))
+
+    lines = []
+    if labors_created:
+        lines.append("*Labors:* created {} labor{}".format(
+            labors_created, "s" if labors_created > 1 else ""
+        ))
+    if labors_completed:
+        lines.append("*Labors:* {} labor{} completed{}".format(
+            labors_completed,
+            "s" if labors_completed > 1 else "",
+            " across {} quest{}".format(
+                len(quest_ids), "s" if len(quest_ids) > 1 else ""
+            ) if quest_ids else ""
+        ))
+    lines.extend(others)
+
+    return "\n\n".join(lines)
+
+
+class SlackSink(object):
+    """Collects Slack messages and posts them from a background thread.
+
+    Messages posted within the same window are combined into one summary
+    post, and no more than max_rate posts are made per minute; while we are
+    held back by the rate, messages keep accumulating into the next post.
+
+    The rate is per process, and messages still queued when the process
+    exits are lost.  With the notification outbox enabled, the outbox
+    worker summarizes the Slack messages itself instead, with the rate
+    holding across processes and no message marked sent before its post.
+
+    Args:
+        window: the number of seconds over which messages are combined
+        max_rate: the maximum number of posts per minute
+    """
+    def __init__(self, window, max_rate):
+        self.window = window
+        self.min_interval = 60.0 / max_rate if max_rate else 0
+        self.messages = []
+        self.last_post = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def post(self, message, summary=None):
+        """Queue a message for the next Slack post
+
+        Args:
+            message: the content of the message
+            summary: optional dict of counts used to summarize the message
+        """
+        with self.lock:
+            self.messages.append((message, summary))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="slack-sink"
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+    def flush(self):
+        """Post the queued messages if the rate allows for it
+
+        Returns:
+            True if a post was made
+        """
+        with self.lock:
+            if not self.messages:
+                return False
+            if time.time() - self.last_post < self.min_interval:
+                return False
+            messages, self.messages = self.messages, []
+            self.last_post = time.time()
+
+        slack_message(summarize_slack_messages(messages))
+        return True
+
+    def run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error posting to Slack")
+
+
+_slack_sink = None
+
+
+def queue_slack_message(message, summary=None):
+    """Post a message to Slack, through the SlackSink if slack_window is set.
+
+    Args:
+        message: the content of the Slack post
+        summary: optional dict of counts used to summarize the message
+    """
+    global _slack_sink
+
+    if not settings.slack_webhook:
+        return
+
+    if not settings.slack_window:
+        slack_message(message)
+        return
+
+    if _slack_sink is None:
+        _slack_sink = SlackSink(settings.slack_window, settings.slack_max_rate)
+    _slack_sink.post(message, summary)
+
+
+class SmtpTransport(object):
+    """Delivers emails over a single persistent SMTP connection.
+
+    Messages passed to send are queued up and delivered in batches over the
+    same connection, so sending many emails only pays for one handshake.
+    If the connection was dropped, it is reopened and the message is retried
+    once.  Call flush at the end of a batch, or use the transport as a
+    context manager to flush and close it when done.
+
+    Args:
+        host: the SMTP server to connect to, default is smtp_server
+        batch_size: the number of queued messages that triggers a flush
+    """
+    def __init__(self, host=None, batch_size=100):
+        self.host = host or settings.smtp_server
+        self.batch_size = batch_size
+        self.queue = []
+        self.failures = []
+        self.smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.flush()
+        finally:
+            self.close()
+
+    def _connect(self):
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host)
+        return self.smtp
+
+    def _disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+            self.smtp = None
+
+    def _sendmail(self, sender, recipients, message):
+        try:
+            self._connect().sendmail(sender, recipients, message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # The server dropped us, reconnect and try again once
+            self._disconnect()
+            self._connect().sendmail(sender, recipients, message)
+
+    def send(self, sender, recipients, message):
+        """Queue an email for delivery
+
+        Args:
+            sender: the sender email address
+            recipients: the list of email addresses to deliver to
+            message: the full text of the email
+        """
+        self.queue.append((sender, recipients, message))
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Deliver all the queued emails.  Failed deliveries are also
+        collected in the failures attribute of the transport.
+
+        Returns:
+            the list of (recipients, error) tuples of failed deliveries
+        """
+        queue, self.queue = self.queue, []
+        failures = []
+        for sender, recipients, message in queue:
+            try:
+                self._sendmail(sender, recipients, message)
+            except Exception as exc:
+                log.warn("Error sending email: {}".format(exc))
+                failures.append((recipients, exc))
+                self.failures.append((recipients, exc))
+                if isinstance(exc, (smtplib.SMTPServerDisconnected, socket.error)):
+                    self._disconnect()
+
+        return failures
+
+    def close(self):
+        """Close the SMTP connection"""
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+
+def email_message(recipients, subject, message, html_message=None, cc=None, sender=None,
+                  raise_errors=False, transport=None):
     """Email a message to a user.
 
     Args:
@@ -71,6 +376,9 @@ def email_message(recipients, subject, message, html_message=None, cc=None, send
         html_message: optional html formatted message we wish to send
         cc: optional list of email addresses to carbon copy
         sender: optional sender email address
+        raise_errors: if True, raise errors instead of logging them
+        transport: optional SmtpTransport to queue the email on instead of
+            connecting to the SMTP server just for this email
     """
 
     if not settings.email_notifications:
@@ -139,8 +447,16 @@ def email_message(recipients, subject, message, html_message=None, cc=None, send
         msg.as_string()
     ))
 
+    if transport is not None:
+        transport.send(
+            settings.email_sender_address,
+            recipients + extra_recipients,
+            msg.as_string()
+        )
+        return
+
     try:
-        smtp = smtplib.SMTP("localhost")
+        smtp = smtplib.SMTP(settings.smtp_server)
         smtp.sendmail(
             settings.email_sender_address,
             recipients + extra_recipients,
@@ -148,6 +464,8 @@ def email_message(recipients, subject, message, html_message=None, cc=None, send
         )
         smtp.quit()
     except Exception as exc:
+        if raise_errors:
+            raise
         log.warn("Error sending email: {}".format(exc.message))
 
 
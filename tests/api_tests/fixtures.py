@@ -57,6 +57,8 @@ def tornado_app(request, tmpdir):
     Session.configure(bind=db_engine)
 
     Fate._all_fates = None
+    Host._cache = None
+    Host._checked_at = None
 
     my_settings = {
         "db_engine": db_engine,
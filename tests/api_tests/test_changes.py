@@ -0,0 +1,192 @@
+import json
+import threading
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from hermes import models
+from hermes.feed import ChangeFeed
+
+from .fixtures import tornado_server, tornado_app, sample_data1_server
+from .util import assert_error
+
+
+def create_event(client, hostname, event_type_id):
+    client.create(
+        "/events",
+        hostname=hostname,
+        user="testman@example.com",
+        eventTypeId=event_type_id
+    )
+
+
+def test_changes_since(sample_data1_server):
+    client = sample_data1_server
+
+    result = client.get("/changes").json()
+    assert result["lastEventId"] == 2
+    assert result["changes"] == []
+
+    result = client.get("/changes?since=0").json()
+    assert result["lastEventId"] == 2
+    assert [
+        (change["type"], change["eventId"]) for change in result["changes"]
+    ] == [("eventCreated", 1), ("eventCreated", 2)]
+
+    result = client.get("/changes?since=0&eventTypeId=2").json()
+    assert [change["eventId"] for change in result["changes"]] == [2]
+
+    assert_error(client.get("/changes?hostname=nonexistent"), 404)
+    assert_error(client.get("/changes?since=abc"), 400)
+
+
+def test_changes_late_commit(sample_data1_server):
+    client = sample_data1_server
+    my_settings = client.tornado_server.tornado_app.my_settings
+
+    create_event(client, "test", 2)
+    create_event(client, "test", 2)
+
+    # Take event 3 out, as if its transaction hadn't committed yet
+    table = models.Event.__table__
+    session = my_settings["db_session"]()
+    row = dict(session.execute(table.select().where(table.c.id == 3)).first())
+    session.execute(table.delete().where(table.c.id == 3))
+    session.commit()
+
+    # Event 4 is held back so that we don't skip event 3 for good
+    result = client.get("/changes?since=2").json()
+    assert result["lastEventId"] == 2
+    assert result["changes"] == []
+
+    session.execute(table.insert().values(**row))
+    session.commit()
+
+    result = client.get("/changes?since=2").json()
+    assert result["lastEventId"] == 4
+    assert [change["eventId"] for change in result["changes"]] == [3, 4]
+
+    # A gap older than the grace window is a rolled back transaction
+    session.execute(table.delete().where(table.c.id == 3))
+    session.commit()
+    session.close()
+    my_settings["change_feed_grace"] = 0
+
+    result = client.get("/changes?since=2").json()
+    assert result["lastEventId"] == 4
+    assert [change["eventId"] for change in result["changes"]] == [4]
+
+
+def test_changes_long_poll(sample_data1_server):
+    client = sample_data1_server
+    client.tornado_server.tornado_app.my_settings["change_feed_interval"] = 50
+
+    client.create(
+        "/quests",
+        creator="johnny@example.com",
+        fateId=1,
+        description="This is a quest almighty",
+        hostnames=["example", "sample"]
+    )
+    last_event_id = client.get("/changes").json()["lastEventId"]
+
+    # Nothing happens, so we get nothing once the timeout expires
+    start = time.time()
+    result = client.get(
+        "/changes?since={}&timeout=0.5".format(last_event_id)
+    ).json()
+    assert time.time() - start >= 0.5
+    assert result["changes"] == []
+    assert result["lastEventId"] == last_event_id
+
+    results = []
+
+    def poll():
+        results.append(client.get(
+            "/changes?since={}&questId=1&timeout=10".format(last_event_id)
+        ).json())
+
+    thread = threading.Thread(target=poll)
+    thread.start()
+    time.sleep(0.2)
+
+    # An event that doesn't touch the quest doesn't wake us up
+    create_event(client, "test", 2)
+    time.sleep(0.2)
+    assert results == []
+
+    create_event(client, "example", 2)
+    thread.join()
+    assert [
+        (change["type"], change["hostId"])
+        for change in results[0]["changes"]
+    ] == [("eventCreated", 1), ("laborClosed", 1)]
+
+    # Completing the quest
+    create_event(client, "sample", 2)
+    result = client.get("/changes?since={}&questId=1".format(
+        results[0]["lastEventId"]
+    )).json()
+    assert [change["type"] for change in result["changes"]] == [
+        "eventCreated", "laborClosed", "questCompleted"
+    ]
+    assert result["changes"][-1]["quest"]["id"] == 1
+    assert result["changes"][-1]["quest"]["completionTime"] is not None
+
+
+def test_changes_websocket(sample_data1_server):
+    client = sample_data1_server
+    client.tornado_server.tornado_app.my_settings["change_feed_interval"] = 50
+
+    io_loop = IOLoop()
+    url = "ws://localhost:{}/api/v1/changes/ws?hostname=sample&since=1".format(
+        client.tornado_server.port
+    )
+    connection = io_loop.run_sync(
+        lambda: websocket_connect(url, io_loop=io_loop), timeout=5
+    )
+
+    create_event(client, "example", 1)
+    create_event(client, "sample", 1)
+
+    changes = [
+        json.loads(io_loop.run_sync(connection.read_message, timeout=5))
+        for _ in range(2)
+    ]
+    assert [(change["type"], change["hostId"]) for change in changes] == [
+        ("eventCreated", 2), ("laborOpened", 2)
+    ]
+    assert changes[1]["labor"]["creationEventId"] == changes[0]["eventId"]
+
+    connection.close()
+    io_loop.close()
+
+
+def test_changes_websocket_catch_up(sample_data1_server):
+    client = sample_data1_server
+    my_settings = client.tornado_server.tornado_app.my_settings
+    # Catching up takes several batches of one event
+    my_settings["change_feed"] = ChangeFeed(
+        my_settings["db_session"], 50, batch_size=1
+    )
+
+    for _ in range(3):
+        create_event(client, "test", 2)
+
+    io_loop = IOLoop()
+    url = "ws://localhost:{}/api/v1/changes/ws?since=1".format(
+        client.tornado_server.port
+    )
+    connection = io_loop.run_sync(
+        lambda: websocket_connect(url, io_loop=io_loop), timeout=5
+    )
+
+    changes = [
+        json.loads(io_loop.run_sync(connection.read_message, timeout=5))
+        for _ in range(4)
+    ]
+    assert [change["eventId"] for change in changes] == [2, 3, 4, 5]
+
+    connection.close()
+    io_loop.close()
@@ -1,6 +1,13 @@
+from datetime import datetime, timedelta
 import json
 import pytest
 import requests
+from sqlalchemy.exc import OperationalError
+import threading
+import time
+
+from hermes import exc, models
+from hermes.handlers import api
 
 from .fixtures import tornado_server, tornado_app, sample_data1_server, sample_data2_server
 from .util import (
@@ -367,4 +374,348 @@ def test_count_events_disabled(sample_data2_server):
             "offset": 0,
         },
         strip=["timestamp", "events"]
-    )
\ No newline at end of file
+    )
+
+
+def test_coalesced_events(sample_data1_server):
+    client = sample_data1_server
+    client.tornado_server.tornado_app.my_settings["event_batch_window"] = 200
+
+    host_ids = {"example": 1, "sample": 2, "test": 3}
+    posts = [
+        ("example", 1), ("sample", 1), ("test", 1), ("example", 2)
+    ]
+    results = {}
+
+    def post(index, hostname, event_type_id):
+        results[index] = client.create(
+            "/events",
+            hostname=hostname,
+            user="testman@example.com",
+            eventTypeId=event_type_id,
+            note="This is a coalesced event"
+        )
+
+    threads = [
+        threading.Thread(target=post, args=(index,) + args)
+        for index, args in enumerate(posts)
+    ]
+    # stagger the requests so they arrive in order within one window
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+
+    event_ids = set()
+    for index, (hostname, event_type_id) in enumerate(posts):
+        result = results[index]
+        assert result.status_code == 201
+        event = result.json()
+        assert event["hostId"] == host_ids[hostname]
+        assert event["eventTypeId"] == event_type_id
+        assert result.headers["Location"] == "/api/v1/events/{}".format(
+            event["id"]
+        )
+        event_ids.add(event["id"])
+
+    assert len(event_ids) == len(posts)
+
+    # the second event for the same host is applied after the first one,
+    # so the labor it started is already closed
+    labors = client.get("/labors?open=true").json()
+    assert labors["totalLabors"] == 2
+    assert set(
+        labor["hostId"] for labor in labors["labors"]
+    ) == set([2, 3])
+
+
+def test_coalesced_event_new_host(sample_data1_server):
+    client = sample_data1_server
+    client.tornado_server.tornado_app.my_settings["event_batch_window"] = 20
+
+    start = time.time()
+    result = client.create(
+        "/events",
+        hostname="brandnew",
+        user="testman@example.com",
+        eventTypeId=1,
+        note="This is a coalesced event for a new host"
+    )
+    assert time.time() - start < 2
+    assert result.status_code == 201
+    event = result.json()
+
+    host = client.get("/hosts/brandnew").json()
+    assert event["hostId"] == host["id"]
+    assert client.get("/events/{}".format(event["id"])).json()["note"] == (
+        "This is a coalesced event for a new host"
+    )
+
+
+def test_cursor_pagination(sample_data2_server):
+    client = sample_data2_server
+
+    all_events = client.get("/events?limit=all").json()["events"]
+    assert len(all_events) > 3
+
+    seen = []
+    cursor = ""
+    while cursor is not None:
+        result = client.get("/events", params={"cursor": cursor, "limit": 3})
+        assert result.status_code == 200
+        page = result.json()
+        assert "totalEvents" not in page
+        assert len(page["events"]) <= 3
+        # each page is returned oldest first, like the offset pages
+        seen = [event["id"] for event in page["events"]] + seen
+        cursor = page["nextCursor"]
+
+    assert seen == [event["id"] for event in all_events]
+
+    # filters still apply when using a cursor
+    page = client.get(
+        "/events", params={"cursor": "", "eventTypeId": 1}
+    ).json()
+    assert page["nextCursor"] is None
+    assert all(event["eventTypeId"] == 1 for event in page["events"])
+
+    assert_error(client.get("/events", params={"cursor": "garbage"}), 400)
+
+
+def test_stream_events(sample_data1_server, monkeypatch):
+    client = sample_data1_server
+    monkeypatch.setattr(api.EventsStreamHandler, "chunk_size", 2)
+
+    records = [
+        {"hostname": "example", "user": "testman", "eventTypeId": 1},
+        {"hostname": "sample", "user": "testman", "eventTypeId": 1},
+        {"hostname": "newhost", "user": "testman",
+         "category": "system-reboot", "state": "required"},
+        {"hostname": "example", "user": "testman", "eventTypeId": 42},
+        {"hostname": "example", "user": "testman", "eventTypeId": 2},
+    ]
+    body = "\n".join(json.dumps(record) for record in records) + "\nnot json"
+
+    def chunks():
+        # send the body in pieces that don't line up with the records
+        for index in range(0, len(body), 7):
+            yield body[index:index + 7]
+
+    result = requests.post(
+        client.base_url + "/events/stream", data=chunks(),
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert result.status_code == 200
+    lines = [json.loads(line) for line in result.text.splitlines()]
+
+    created = [line for line in lines if line["status"] == "created"]
+    errors = [line for line in lines if line["status"] == "error"]
+    assert [line["totalEvents"] for line in created] == [2, 2]
+    assert [error["line"] for error in errors] == [4, 6]
+    assert lines[-1] == {"status": "ok", "totalEvents": 4, "totalErrors": 2}
+
+    event = client.get(
+        "/events/{}".format(created[1]["eventIds"][0])
+    ).json()
+    assert event["user"] == "testman@example.com"
+    assert client.get("/hosts/newhost").status_code == 200
+
+    # the reboot of example closed the labor its first event opened
+    labors = client.get("/labors?open=true").json()
+    assert set(labor["hostId"] for labor in labors["labors"]) == set([2, 4])
+
+
+def test_stream_events_atomic(sample_data1_server, monkeypatch):
+    client = sample_data1_server
+    create_many = models.Event.create_many.__func__
+    calls = []
+
+    def failing_create_many(cls, session, events, tx, **kwargs):
+        calls.append(tx)
+        if len(calls) == 2:
+            raise exc.ValidationError("Something went wrong")
+        return create_many(cls, session, events, tx, **kwargs)
+
+    monkeypatch.setattr(
+        models.Event, "create_many", classmethod(failing_create_many)
+    )
+
+    class Hook(object):
+        def __init__(self):
+            self.event_ids = []
+
+        def on_event(self, event):
+            self.event_ids.append(event.id)
+
+    hook = Hook()
+    monkeypatch.setattr(models, "_HOOKS", [hook])
+
+    # two events for the same host are created in two rounds
+    records = [
+        {"hostname": "example", "user": "testman", "eventTypeId": 1},
+        {"hostname": "example", "user": "testman", "eventTypeId": 2},
+    ]
+    body = "\n".join(json.dumps(record) for record in records)
+    body += "\n[1]\n\"x\"\n"
+
+    result = requests.post(
+        client.base_url + "/events/stream", data=body,
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    lines = [json.loads(line) for line in result.text.splitlines()]
+
+    assert [(line["status"], line.get("line")) for line in lines[:2]] == [
+        ("error", 3), ("error", 4)
+    ]
+    assert lines[2]["status"] == "error"
+    assert lines[2]["error"]["code"] == 400
+    assert lines[-1] == {"status": "ok", "totalEvents": 0, "totalErrors": 4}
+
+    # the first round was rolled back along with the second, without
+    # letting the hooks know about it
+    assert len(calls) == 2
+    assert client.get("/events").json()["totalEvents"] == 2
+    assert hook.event_ids == []
+
+    # the hooks are called once the chunk is committed
+    body = json.dumps(records[0])
+    result = requests.post(
+        client.base_url + "/events/stream", data=body,
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    event_ids = json.loads(result.text.splitlines()[0])["eventIds"]
+    assert hook.event_ids == event_ids
+
+
+def test_stream_events_errors(sample_data1_server, monkeypatch):
+    client = sample_data1_server
+    monkeypatch.setattr(api.EventsStreamHandler, "chunk_size", 1)
+    monkeypatch.setattr(api.EventsStreamHandler, "max_line_size", 100)
+    create_many = models.Event.create_many.__func__
+
+    def failing_create_many(cls, session, events, tx, **kwargs):
+        if events[0]["event_type_id"] == 2:
+            raise OperationalError("INSERT", {}, Exception("Lock timeout"))
+        return create_many(cls, session, events, tx, **kwargs)
+
+    monkeypatch.setattr(
+        models.Event, "create_many", classmethod(failing_create_many)
+    )
+
+    records = [
+        {"hostname": "example", "user": "testman", "eventTypeId": 2},
+        {"hostname": "example", "user": "testman", "note": "x" * 200},
+        {"hostname": "sample", "user": "testman", "eventTypeId": 1},
+    ]
+    body = "\n".join(json.dumps(record) for record in records)
+
+    def chunks():
+        # send the long line in pieces, so it has to be cut off
+        for index in range(0, len(body), 30):
+            yield body[index:index + 30]
+
+    result = requests.post(
+        client.base_url + "/events/stream", data=chunks(),
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert result.status_code == 200
+    lines = [json.loads(line) for line in result.text.splitlines()]
+
+    assert lines[0]["status"] == "error"
+    assert lines[0]["error"]["code"] == 500
+    assert lines[0]["firstLine"] == 1
+    assert lines[1] == {
+        "status": "error",
+        "line": 2,
+        "error": {"code": 400, "message": "Line longer than 100 bytes"},
+    }
+    assert lines[2]["status"] == "created"
+    assert lines[2]["firstLine"] == 3
+    assert lines[-1] == {"status": "ok", "totalEvents": 1, "totalErrors": 2}
+
+
+def test_archived_events(sample_data1_server):
+    client = sample_data1_server
+    my_settings = client.tornado_server.tornado_app.my_settings
+
+    client.create(
+        "/events",
+        hostname="example",
+        user="testman@example.com",
+        eventTypeId=3,
+        note="This is a fresh event"
+    )
+
+    session = my_settings["db_session"]()
+    assert models.ArchivedEvent.archive(
+        session, datetime.utcnow() + timedelta(seconds=1)
+    ) == 2
+    session.close()
+
+    # only the hot events when the range starts after the archived ones
+    result = client.get("/events?after={}".format(
+        datetime.utcnow() + timedelta(seconds=1)
+    )).json()
+    assert result["totalEvents"] == 0
+
+    # the archived events otherwise, even without a time range
+    result = client.get("/events").json()
+    assert result["totalEvents"] == 3
+    assert [event["id"] for event in result["events"]] == [1, 2, 3]
+
+    result = client.get("/events?before={}".format(
+        datetime.utcnow() + timedelta(seconds=1)
+    )).json()
+    assert [event["id"] for event in result["events"]] == [1, 2, 3]
+
+    event = client.get("/events/1").json()
+    assert event["id"] == 1
+    assert event["hostId"] == 1
+    assert_error(client.get("/events/100"), 404)
+
+    result = client.get("/events?after=2000-01-01&hostname=example").json()
+    assert result["totalEvents"] == 3
+    assert [event["id"] for event in result["events"]] == [1, 2, 3]
+
+    result = client.get("/events?afterEventType=2").json()
+    assert [event["id"] for event in result["events"]] == [2, 3]
+
+    # a filtered query spanning the archive isn't estimated from the table
+    result = client.get(
+        "/events?after=2000-01-01&eventTypeId=1&totals=estimated"
+    ).json()
+    assert result["totalEvents"] == 1
+
+
+def test_after_event_type_per_host(sample_data1_server):
+    client = sample_data1_server
+    for hostname, event_type_id in [
+        ("sample", 1), ("sample", 3), ("example", 1), ("test", 3)
+    ]:
+        client.create(
+            "/events",
+            hostname=hostname,
+            user="testman@example.com",
+            eventTypeId=event_type_id
+        )
+
+    result = client.get("/events?afterEventType=1").json()
+    assert [event["id"] for event in result["events"]] == [5, 6]
+
+    result = client.get("/events?afterEventType=1&hostname=sample").json()
+    assert [event["id"] for event in result["events"]] == [3, 4]
+
+    # the hosts without an event of that type are left out
+    result = client.get(
+        "/events?afterEventType=1&afterEventTypePerHost=true"
+    ).json()
+    assert result["totalEvents"] == 3
+    assert [event["id"] for event in result["events"]] == [3, 4, 5]
+
+    # only the global mode needs an event of that type
+    assert_error(client.get("/events?afterEventType=7"), 400)
+    result = client.get(
+        "/events?afterEventType=7&afterEventTypePerHost=true"
+    ).json()
+    assert result["events"] == []
@@ -1,8 +1,9 @@
 import json
 import pytest
 import requests
+from sqlalchemy.event import listen, remove
 
-from .fixtures import tornado_server, tornado_app
+from .fixtures import tornado_server, tornado_app, sample_data1_server
 from .util import (
     assert_error, assert_success, assert_created, assert_deleted, Client
 )
@@ -123,4 +124,187 @@ def test_merging(tornado_server):
             "id": 2,
             "hostname": "newname"
         }
-    )
\ No newline at end of file
+    )
+
+
+def test_bulk_rename(tornado_server):
+    client = Client(tornado_server)
+    client.create("/hosts", hosts=[
+        {"hostname": "a.old.com"}, {"hostname": "b.old.com"},
+        {"hostname": "b.new.com"}
+    ])
+
+    assert_success(
+        client.update("/hosts", hosts=[
+            {"hostname": "a.old.com", "newHostname": "a.new.com"},
+            {"hostname": "b.old.com", "newHostname": "b.new.com"},
+        ]),
+        {
+            "hosts": [
+                {"hostname": "a.old.com", "newHostname": "a.new.com", "id": 1},
+                {"hostname": "b.old.com", "newHostname": "b.new.com", "id": 3},
+            ],
+            "totalHosts": 2,
+        }
+    )
+
+    hosts = client.get("/hosts").json()["hosts"]
+    assert sorted(host["hostname"] for host in hosts) == [
+        "a.new.com", "b.new.com"
+    ]
+
+    assert_error(
+        client.update("/hosts", hosts=[
+            {"hostname": "a.old.com", "newHostname": "c.new.com"}
+        ]),
+        400
+    )
+
+
+def test_totals(tornado_server):
+    client = Client(tornado_server)
+    client.create("/hosts", hosts=[
+        {"hostname": "example"}, {"hostname": "sample"}, {"hostname": "test"}
+    ])
+
+    def total(**params):
+        return client.get("/hosts", params=params).json()["totalHosts"]
+
+    assert total() == 3
+    assert total(totals="exact") == 3
+    assert total(totals="estimated") == 3
+    assert total(totals="cached") == 3
+    assert total(totals="cached", hostname="sample") == 1
+    assert total(totals="none") is None
+
+    client.create("/hosts", hostname="another")
+
+    # cached totals are reused for the same filters, no matter the page
+    assert total(totals="cached", limit=2, offset=2) == 3
+    assert total(totals="cached", hostname="another") == 1
+    assert total(totals="exact") == 4
+    assert total(totals="estimated") == 4
+
+    assert_error(client.get("/hosts", params={"totals": "bogus"}), 400)
+
+
+def test_host_state(sample_data1_server):
+    client = sample_data1_server
+
+    result = client.get("/hosts/example/state").json()
+    assert [
+        (state["category"], state["state"], state["eventId"])
+        for state in result["states"]
+    ] == [("system-reboot", "completed", 2)]
+
+    assert client.get("/hosts/sample/state").json()["states"] == []
+    assert_error(client.get("/hosts/nonexistent/state"), 404)
+
+    # a bulk creation updates the states of all the hosts at once
+    client.create(
+        "/events",
+        hostnames=["example", "sample"],
+        user="testman@example.com",
+        eventTypeId=3
+    )
+    client.create(
+        "/events",
+        hostname="sample",
+        user="testman@example.com",
+        eventTypeId=4
+    )
+
+    result = client.get("/hoststates?limit=all").json()
+    assert result["totalHostStates"] == 3
+    assert [
+        (state["hostname"], state["category"], state["state"])
+        for state in result["hostStates"]
+    ] == [
+        ("example", "system-maintenance", "required"),
+        ("example", "system-reboot", "completed"),
+        ("sample", "system-maintenance", "ready"),
+    ]
+
+    result = client.get(
+        "/hoststates?category=system-maintenance&hostname=sample"
+    ).json()
+    assert [state["eventId"] for state in result["hostStates"]] == [5]
+
+    result = client.get("/hoststates?state=required").json()
+    assert [state["hostname"] for state in result["hostStates"]] == ["example"]
+
+
+def test_host_details(sample_data1_server):
+    client = sample_data1_server
+    engine = client.tornado_server.tornado_app.my_settings["db_engine"]
+
+    for x in range(4):
+        client.create(
+            "/quests",
+            creator="johnny@example.com",
+            fateId=1,
+            description="Quest {}".format(x),
+            hostnames=["example", "sample"]
+        )
+        client.create(
+            "/events",
+            hostname="example",
+            user="testman@example.com",
+            eventTypeId=2
+        )
+
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args)
+
+    def get_host(limit):
+        del statements[:]
+        listen(engine, "before_cursor_execute", count_statement)
+        result = client.get(
+            "/hosts/example?limit={}&expand=labors&expand=quests"
+            "&expand=events&expand=fates&expand=eventtypes".format(limit)
+        ).json()
+        remove(engine, "before_cursor_execute", count_statement)
+        return result, len(statements)
+
+    small, small_statements = get_host(1)
+    large, large_statements = get_host(10)
+
+    # the number of statements doesn't depend on the page size
+    assert small_statements == large_statements
+
+    assert len(small["labors"]) == 1
+    assert [labor["id"] for labor in large["labors"]] == [1, 3, 5, 7]
+    assert large["labors"][-1] == small["labors"][0]
+    assert [quest["id"] for quest in large["quests"]] == [1, 2, 3, 4]
+    assert len(large["quests"][0]["labors"]) == 2
+
+    assert len(large["events"]) == 10
+    assert large["events"][-1] == small["events"][0]
+    assert large["events"][-1]["eventType"]["id"] == 2
+    assert large["lastEvent"] == large["events"][-1]["timestamp"]
+
+
+def test_server_stats(sample_data1_server):
+    client = sample_data1_server
+
+    # renaming a host to itself just drops the cache, so we start empty
+    client.update("/hosts/sample", hostname="sample")
+    start = client.get("/serverStats").json()["hostCache"]
+    assert start["size"] == 0
+
+    client.get("/events?hostname=example")
+    client.get("/events?hostname=example")
+    client.get("/labors?hostname=example")
+
+    stats = client.get("/serverStats").json()["hostCache"]
+    assert stats["size"] == 1
+    assert stats["hits"] - start["hits"] == 2
+    assert stats["misses"] - start["misses"] == 1
+
+    # a rename drops the cached ids
+    client.update("/hosts/example", hostname="newname")
+    assert client.get("/serverStats").json()["hostCache"]["size"] == 0
+    assert_error(client.get("/events?hostname=example"), 400)
+    assert client.get("/events?hostname=newname").status_code == 200
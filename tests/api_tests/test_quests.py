@@ -2,6 +2,8 @@ import json
 import pytest
 import requests
 import logging
+import time
+from sqlalchemy.event import listen, remove
 
 from .fixtures import tornado_server, tornado_app, sample_data1_server
 
@@ -824,7 +826,7 @@ def test_filter_by_creator(sample_data1_server):
     )
 
 
-def test_filter_by_hostnames(sample_data1_server):
+def test_filter_by_hostnames(sample_data1_server, monkeypatch):
     client = sample_data1_server
     # We start with 0 quests in the test data
     assert_success(
@@ -880,6 +882,12 @@ def test_filter_by_hostnames(sample_data1_server):
     assert quest_2['quests'][0]['id'] == 1
     assert quest_2['quests'][1]['id'] == 2
 
+    # Hosts spread over several chunks still match each quest once
+    monkeypatch.setattr("hermes.models.HOST_CHUNK_SIZE", 1)
+    quests = client.get("/quests?hostnames=example,sample,test").json()
+    assert quests["totalQuests"] == 2
+    assert [quest["id"] for quest in quests["quests"]] == [1, 2]
+
     assert_success(
         client.get("/quests?hostnames=not-a-server"),
         {
@@ -891,6 +899,99 @@ def test_filter_by_hostnames(sample_data1_server):
     )
 
 
+def test_list_statements(sample_data1_server):
+    client = sample_data1_server
+    engine = client.tornado_server.tornado_app.my_settings["db_engine"]
+
+    for x in range(3):
+        client.create(
+            "/quests",
+            creator="johnny@example.com",
+            fateId=1,
+            description="Quest {}".format(x),
+            hostnames=["example", "sample", "test"]
+        )
+    client.create(
+        "/events",
+        hostname="example",
+        user="testman@example.com",
+        eventTypeId=2
+    )
 
+    statements = []
 
+    def count_statement(*args):
+        statements.append(args)
 
+    def get_quests(limit):
+        del statements[:]
+        listen(engine, "before_cursor_execute", count_statement)
+        result = client.get(
+            "/quests?limit={}&progressInfo=true&expand=labors".format(limit)
+        ).json()
+        remove(engine, "before_cursor_execute", count_statement)
+        return result["quests"], len(statements)
+
+    small, small_statements = get_quests(1)
+    large, large_statements = get_quests("all")
+
+    # the number of statements doesn't depend on the number of quests
+    assert small_statements == large_statements
+
+    assert [len(quest["labors"]) for quest in large] == [3, 3, 3]
+    assert large[0] == small[0]
+    assert [
+        (quest["totalLabors"], quest["unstartedLabors"], quest["completedLabors"])
+        for quest in large
+    ] == [(3, 2, 1)] * 3
+
+    # the progress is counted from the labors, not read off the counters
+    engine.execute(
+        "UPDATE quests SET starting_labor_count = 0, unstarted_labor_count = 0"
+    )
+    large, large_statements = get_quests("all")
+    assert [
+        (quest["totalLabors"], quest["unstartedLabors"], quest["completedLabors"])
+        for quest in large
+    ] == [(3, 2, 1)] * 3
+
+
+def test_async_creation(sample_data1_server, monkeypatch):
+    client = sample_data1_server
+    monkeypatch.setattr("hermes.models.HOST_CHUNK_SIZE", 2)
+
+    response = client.post(
+        "/quests?async=true",
+        data=json.dumps({
+            "creator": "johnny@example.com",
+            "fateId": 1,
+            "description": "This is a quest almighty",
+            "hostnames": ["example", "sample", "test"]
+        })
+    )
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] == "accepted"
+    assert job["hostCount"] == 3
+    assert response.headers.get("Location") == "/api/v1/quests/jobs/{}".format(
+        job["id"]
+    )
+
+    for attempt in range(50):
+        job = client.get("/quests/jobs/{}".format(job["id"])).json()
+        if job["state"] not in ("pending", "running"):
+            break
+        time.sleep(0.1)
+
+    assert job["state"] == "completed"
+    assert job["hostsProcessed"] == 3
+    assert job["laborsCreated"] == 3
+    assert job["error"] is None
+
+    quest = client.get(
+        "/quests/{}?progressInfo=true".format(job["questId"])
+    ).json()
+    assert quest["description"] == "This is a quest almighty"
+    assert quest["totalLabors"] == 3
+
+    assert_error(client.get("/quests/jobs/100"), 404)
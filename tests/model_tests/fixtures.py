@@ -17,6 +17,8 @@ def session(db_engine, request, tmpdir):
     session = models.Session()
 
     models.Fate._all_fates = None
+    models.Host._cache = None
+    models.Host._checked_at = None
 
     def fin():
         session.close()
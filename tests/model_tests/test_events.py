@@ -1,3 +1,4 @@
+from datetime import datetime, timedelta
 import pytest
 from sqlalchemy.exc import IntegrityError
 
@@ -84,4 +85,67 @@ def test_very_large_note(sample_data1):
     assert event.host == host
     assert event.user == "testman"
     assert event.event_type == event_type1
-    assert event.note == very_large_note
\ No newline at end of file
+    assert event.note == very_large_note
+
+def test_create_many_returns_ids(sample_data1):
+    tx = models.EventBatch.allocate(sample_data1)
+    assert models.EventBatch.allocate(sample_data1) == tx + 1
+
+    hosts = sample_data1.query(models.Host).all()
+    # enough events to take more than one insert statement on SQLite
+    events = [
+        {
+            "host_id": hosts[index % len(hosts)].id,
+            "user": "system",
+            "event_type_id": 7,
+            "note": "Event {}".format(index),
+        }
+        for index in range(500)
+    ]
+    event_ids = models.Event.create_many(sample_data1, events, tx)
+
+    assert len(event_ids) == len(events)
+    for event_id, event in zip(event_ids, events):
+        created = sample_data1.query(models.Event).get(event_id)
+        assert created.tx == tx
+        assert created.note == event["note"]
+        assert created.host_id == event["host_id"]
+
+
+def test_archive(sample_data1):
+    hosts = sample_data1.query(models.Host).all()
+    event_types = sample_data1.query(models.EventType).all()
+
+    models.Event.create(sample_data1, hosts[2], "testman", event_types[6])
+    # this one opens a labor, so it has to stay
+    models.Event.create(sample_data1, hosts[1], "testman", event_types[0])
+    assert sample_data1.query(models.Labor).count() == 1
+
+    assert models.ArchivedEvent.get_horizon(sample_data1) is None
+
+    before = datetime.utcnow() + timedelta(seconds=1)
+    assert models.ArchivedEvent.archive(
+        sample_data1, before, batch_size=2
+    ) == 3
+
+    assert [
+        event.id for event in sample_data1.query(models.Event)
+    ] == [4]
+    archived = sample_data1.query(models.ArchivedEvent).order_by(
+        models.ArchivedEvent.id
+    ).all()
+    assert [event.id for event in archived] == [1, 2, 3]
+    assert archived[2].host_id == hosts[2].id
+    assert archived[2].event_type_id == event_types[6].id
+    assert models.ArchivedEvent.get_horizon(sample_data1) == archived[2].timestamp
+
+    # the archived events can still be queried with the other ones
+    events = models.Event.query_with_archive(
+        sample_data1, lambda model: [model.host_id == hosts[0].id]
+    ).order_by(models.Event.timestamp).all()
+    assert [event.id for event in events] == [1, 2]
+    assert events[0].host == hosts[0]
+
+    assert models.Event.query_with_archive(
+        sample_data1, lambda model: []
+    ).count() == 4
@@ -2,7 +2,7 @@ import pytest
 from sqlalchemy.exc import IntegrityError
 
 from hermes import exc
-from hermes.models import Fate, EventType
+from hermes.models import Fate, EventType, CacheGeneration
 
 from .fixtures import db_engine, session, sample_data1
 
@@ -98,4 +98,50 @@ def test_follows_id_valid(sample_data1):
         Fate.create(
             sample_data1, event_type1, description="Coolio",
             follows_id=20
-        )
\ No newline at end of file
+        )
+
+def test_compiled_transitions(sample_data1):
+    starting_fates = Fate.get_starting_fates_by_type(sample_data1)
+    assert sorted(starting_fates.keys()) == [1, 3]
+    assert starting_fates[1]["id"] == 1
+    assert starting_fates[3]["id"] == 4
+
+    successor_fates = Fate.get_successor_fates(sample_data1)
+    assert sorted(successor_fates.keys()) == [(1, 2), (1, 4), (4, 4), (5, 5)]
+    assert [fate["id"] for fate in successor_fates[(1, 2)]] == [2]
+    assert [fate["id"] for fate in successor_fates[(1, 4)]] == [3]
+    assert [fate["id"] for fate in successor_fates[(4, 4)]] == [5]
+    assert successor_fates[(4, 4)][0]["precedes_ids"] == [6]
+
+    # creating a new Fate should invalidate the compiled tables
+    event_type7 = sample_data1.query(EventType).get(7)
+    Fate.create(
+        sample_data1, event_type7, follows_id=6, description="New fate"
+    )
+    successor_fates = Fate.get_successor_fates(sample_data1)
+    assert [fate["id"] for fate in successor_fates[(6, 7)]] == [7]
+    assert Fate.get_all_fates(sample_data1)[6]["precedes_ids"] == [7]
+
+
+def test_cache_generation(sample_data1):
+    successor_fates = Fate.get_successor_fates(sample_data1)
+    assert (1, 4) in successor_fates
+
+    # Simulate another server process re-pointing Fate 3 to follow Fate 4
+    sample_data1.execute("UPDATE fates SET follows_id = 4 WHERE id = 3")
+    CacheGeneration.bump(sample_data1, "fates")
+    sample_data1.commit()
+
+    # Our copy is stale until we check the generation
+    assert (1, 4) in Fate.get_successor_fates(sample_data1)
+    Fate.check_cache(sample_data1)
+    successor_fates = Fate.get_successor_fates(sample_data1)
+    assert (1, 4) not in successor_fates
+    assert [fate["id"] for fate in successor_fates[(4, 4)]] == [3, 5]
+
+    # Updating a Fate through the model bumps the generation for others
+    generation = CacheGeneration.get_generation(sample_data1, "fates")
+    fate = sample_data1.query(Fate).get(3)
+    fate.update(follows_id=1)
+    assert CacheGeneration.get_generation(sample_data1, "fates") == generation + 1
+    assert (1, 4) in Fate.get_successor_fates(sample_data1)
@@ -1,8 +1,13 @@
+from datetime import datetime, timedelta
 import pytest
+from sqlalchemy import text
+from sqlalchemy.event import listen, remove
 from sqlalchemy.exc import IntegrityError
 
-from hermes import exc
-from hermes.models import Host, EventType, Labor, Event
+from hermes import exc, models
+from hermes.models import Host, EventType, Labor, Event, EventBatch
+from hermes.models import HostState
+from hermes.util import LruCache
 
 from .fixtures import db_engine, session, sample_data1
 
@@ -82,3 +87,183 @@ def test_get_labors(sample_data1):
     assert all_labors[0].creation_event == closing_event
 
 
+
+
+def test_upsert_many(session, monkeypatch):
+    Host.create(session, "abc-123")
+    monkeypatch.setattr(models, "HOST_CHUNK_SIZE", 2)
+
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args)
+    listen(session.bind, "before_cursor_execute", count_statement)
+
+    host_ids = Host.upsert_many(
+        session, ["abc-123", "abc-456", "abc-789", "abc-456"]
+    )
+    remove(session.bind, "before_cursor_execute", count_statement)
+    session.commit()
+
+    hosts = dict(session.query(Host.hostname, Host.id))
+    assert host_ids == hosts
+    assert set(hosts) == set(["abc-123", "abc-456", "abc-789"])
+
+    # a check of the cache generation, a lookup for each chunk of hostnames,
+    # then an insert and a lookup for each chunk of new hosts
+    assert len(statements) == 5
+
+    # upserting again doesn't create anything
+    assert Host.upsert_many(session, ["abc-789", "abc-123"]) == {
+        "abc-123": hosts["abc-123"], "abc-789": hosts["abc-789"]
+    }
+    assert session.query(Host).count() == 3
+
+    with pytest.raises(exc.ValidationError):
+        Host.upsert_many(session, ["abc-123", None])
+
+
+def test_upsert_many_race(session, monkeypatch):
+    Host.create(session, "abc-123")
+    session.commit()
+
+    # Another request created abc-123 after we looked for it
+    monkeypatch.setattr(
+        Host, "get_ids", classmethod(lambda cls, session, hostnames, fresh=False: {})
+    )
+    host_ids = Host.upsert_many(session, ["abc-123", "abc-456"])
+    session.commit()
+
+    assert host_ids == dict(session.query(Host.hostname, Host.id))
+    assert session.query(Host).count() == 2
+
+    # ...or deleted it before we could read it back
+    monkeypatch.setattr(
+        Host, "_insert_missing_statement",
+        classmethod(lambda cls, session: text("SELECT :hostname"))
+    )
+    with pytest.raises(exc.ConcurrencyError):
+        Host.upsert_many(session, ["abc-789"])
+
+
+def test_rename_many(sample_data1):
+    example, sample, test = sample_data1.query(Host).order_by(Host.id).all()
+    event_types = sample_data1.query(EventType).order_by(EventType.id).all()
+
+    Event.create(sample_data1, example, "testman", event_types[6])
+    Event.create(sample_data1, example, "testman", event_types[0])
+    Event.create(sample_data1, sample, "testman", event_types[1])
+    Event.create(sample_data1, sample, "testman", event_types[5])
+
+    host_ids = Host.rename_many(sample_data1, {
+        "example.dropbox.com": "sample.dropbox.com",
+        "test.dropbox.com": "test.example.com",
+    })
+    assert host_ids == {
+        "example.dropbox.com": 2,
+        "test.dropbox.com": 3,
+    }
+
+    # the renamed host keeps its id, the merged one is gone
+    assert dict(sample_data1.query(Host.hostname, Host.id)) == {
+        "sample.dropbox.com": 2,
+        "test.example.com": 3,
+    }
+
+    assert sample_data1.query(Event).filter(Event.host_id == 2).count() == 6
+    assert sample_data1.query(Labor).filter(Labor.host_id == 2).count() == 1
+
+    # the newest state of each category wins
+    assert dict(
+        sample_data1.query(HostState.category, HostState.state)
+        .filter(HostState.host_id == 2)
+    ) == {
+        "system-reboot": "completed",
+        "system-shutdown": "required",
+    }
+
+
+def test_host_state_upsert(sample_data1):
+    required, completed = [
+        event_type.id for event_type in
+        sample_data1.query(EventType).order_by(EventType.id).all()[:2]
+    ]
+    now = datetime.utcnow()
+
+    def create(event_type_id, timestamp):
+        Event.create_many(sample_data1, [{
+            "host_id": 3, "user": "testman",
+            "event_type_id": event_type_id, "timestamp": timestamp,
+        }], EventBatch.allocate(sample_data1))
+
+    def state():
+        return sample_data1.query(
+            HostState.state, HostState.timestamp
+        ).filter(
+            HostState.host_id == 3, HostState.category == "system-reboot"
+        ).one()
+
+    create(completed, now)
+    assert state() == ("completed", now)
+
+    # an older event doesn't replace the state, a newer one does
+    create(required, now - timedelta(hours=1))
+    assert state() == ("completed", now)
+
+    create(required, now + timedelta(hours=1))
+    assert state() == ("required", now + timedelta(hours=1))
+
+
+def test_rename_many_invalid(sample_data1):
+    with pytest.raises(exc.ValidationError):
+        Host.rename_many(sample_data1, {"nonexistent": "sample.dropbox.com"})
+
+    with pytest.raises(exc.ValidationError):
+        Host.rename_many(sample_data1, {
+            "example.dropbox.com": "sample.dropbox.com",
+            "sample.dropbox.com": "test.dropbox.com",
+        })
+
+
+def test_host_cache(sample_data1):
+    Host._cache = LruCache(2)
+
+    assert Host.get_ids(
+        sample_data1, ["example.dropbox.com", "sample.dropbox.com", "nope"]
+    ) == {"example.dropbox.com": 1, "sample.dropbox.com": 2}
+    assert Host.get_id(sample_data1, "example.dropbox.com") == 1
+
+    # the least recently used hostname is evicted
+    assert Host.get_id(sample_data1, "test.dropbox.com") == 3
+    assert Host.get_id(sample_data1, "sample.dropbox.com") == 2
+
+    stats = Host.get_cache().stats()
+    assert stats["size"] == 2
+    assert stats["hits"] == 1
+    assert stats["misses"] == 5
+    assert stats["evictions"] == 2
+
+    # renaming a host drops the cached ids
+    Host.rename_many(sample_data1, {"sample.dropbox.com": "foo.dropbox.com"})
+    assert Host.get_cache().stats()["size"] == 0
+    assert Host.get_id(sample_data1, "sample.dropbox.com") is None
+    assert Host.get_id(sample_data1, "foo.dropbox.com") == 2
+
+    # as does a rename by another process, once the generation is checked
+    Host.get_id(sample_data1, "test.dropbox.com")
+    models.CacheGeneration.bump(sample_data1, "hosts")
+    Host._checked_at = None
+    Host.check_cache(sample_data1)
+    assert Host.get_cache().stats()["size"] == 0
+
+    # writes check the generation right away, without waiting for the
+    # check interval
+    Host.get_id(sample_data1, "test.dropbox.com")
+    sample_data1.execute(
+        Host.__table__.update().where(Host.id == 3)
+        .values(hostname="bar.dropbox.com")
+    )
+    models.CacheGeneration.bump(sample_data1, "hosts")
+    assert Host.get_id(sample_data1, "test.dropbox.com") == 3
+    host_ids = Host.upsert_many(sample_data1, ["test.dropbox.com"])
+    assert host_ids["test.dropbox.com"] not in (None, 3)
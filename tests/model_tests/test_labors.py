@@ -4,7 +4,7 @@ from sqlalchemy import desc
 from sqlalchemy.exc import IntegrityError
 
 from hermes import exc
-from hermes.models import Event, EventType, Fate, Host, Labor
+from hermes.models import Event, EventBatch, EventType, Fate, Host, Labor
 
 from .fixtures import db_engine, session, sample_data1, sample_data2
 
@@ -327,6 +327,90 @@ def test_longer_chain(sample_data2):
     assert len(host.labors) == 3
 
 
+def test_longer_chain_bulk(sample_data2):
+    """Test chained labors A->B->C->D with events thrown in bulk"""
+    hosts = sample_data2.query(Host).all()
+    assert len(hosts) > 1
 
+    def throw(event_type_id, tx):
+        Event.create_many(sample_data2, [
+            {
+                "host_id": host.id,
+                "user": "system",
+                "event_type_id": event_type_id,
+                "tx": tx,
+            }
+            for host in hosts
+        ], tx)
 
+    throw(1, 101)
+    labors = Labor.get_open_unacknowledged(sample_data2)
+    assert len(labors) == len(hosts)
+    assert all(labor.starting_labor_id is None for labor in labors)
+    starting_labor_ids = set(labor.id for labor in labors)
+
+    throw(2, 102)
+    labors = Labor.get_open_unacknowledged(sample_data2)
+    assert len(labors) == len(hosts)
+    assert set(labor.starting_labor_id for labor in labors) == (
+        starting_labor_ids
+    )
+    closed = sample_data2.query(Labor).filter(
+        Labor.id.in_(starting_labor_ids)
+    ).all()
+    assert all(labor.closing_fate_id is not None for labor in closed)
+    assert all(labor.completion_event.tx == 102 for labor in closed)
+
+    throw(3, 103)
+    labors = Labor.get_open_unacknowledged(sample_data2)
+    assert len(labors) == len(hosts)
+    assert all(labor.for_creator is True for labor in labors)
+
+    # The last event closes the final labors without creating new ones
+    throw(4, 104)
+    labors = Labor.get_open_unacknowledged(sample_data2)
+    assert len(labors) == 0
+    assert sample_data2.query(Labor).count() == 3 * len(hosts)
 
+
+def test_several_successor_fates(sample_data1):
+    host = sample_data1.query(Host).get(1)
+    required, completed = sample_data1.query(EventType).order_by(
+        EventType.id
+    ).all()[:2]
+    maintenance_completed = sample_data1.query(EventType).get(5)
+
+    # a second fate follows the reboot requirement on the same event type,
+    # and both continue their own chain
+    verified = Fate.create(
+        sample_data1, completed, follows_id=1, description="Reboot verified"
+    )
+    Fate.create(
+        sample_data1, maintenance_completed, follows_id=2,
+        description="Follow up on reboot"
+    )
+    Fate.create(
+        sample_data1, maintenance_completed, follows_id=verified.id,
+        description="Follow up on verification"
+    )
+    sample_data1.commit()
+
+    # the one by one and the set-based evaluations agree
+    Event.create(sample_data1, host, "system", required)
+    Event.create(sample_data1, host, "system", completed)
+    for event_type in (required, completed):
+        Event.create_many(sample_data1, [{
+            "host_id": host.id, "user": "system",
+            "event_type_id": event_type.id,
+        }], EventBatch.allocate(sample_data1))
+
+    labors = sample_data1.query(Labor).order_by(Labor.id).all()
+    assert [
+        (labor.fate_id, labor.completion_time is None) for labor in labors
+    ] == [
+        (1, False), (2, True), (verified.id, True),
+        (1, False), (2, True), (verified.id, True)
+    ]
+    for start in (0, 3):
+        assert labors[start + 1].starting_labor_id == labors[start].id
+        assert labors[start + 2].starting_labor_id == labors[start].id
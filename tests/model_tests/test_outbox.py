@@ -0,0 +1,220 @@
+from datetime import datetime, timedelta
+import pytest
+import smtplib
+
+from hermes import models, util
+from hermes.models import Event, EventType, Host, Labor, OutboxMessage
+from hermes.settings import settings
+
+from .fixtures import db_engine, session, sample_data1
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setitem(settings.settings, "notification_outbox", True)
+    monkeypatch.setitem(settings.settings, "slack_webhook", "http://slack")
+
+    posted = []
+
+    def slack_message(message, raise_errors=False):
+        posted.append(message)
+    monkeypatch.setattr(models, "slack_message", slack_message)
+
+    return posted
+
+
+def test_enqueue_with_transaction(sample_data1, outbox):
+    host = sample_data1.query(Host).get(1)
+    event_type = sample_data1.query(EventType).get(1)
+
+    Event.create(sample_data1, host, "system", event_type)
+
+    # Nothing was posted while the event was being created
+    assert outbox == []
+    messages = sample_data1.query(OutboxMessage).all()
+    assert len(messages) == 1
+    assert messages[0].kind == "slack"
+    assert messages[0].sent_time is None
+
+    assert OutboxMessage.deliver_pending(sample_data1) == 1
+    assert outbox == ["*Labors:* created 1 labor"]
+    assert messages[0].sent_time is not None
+
+    # Delivered notifications are not delivered again
+    assert OutboxMessage.deliver_pending(sample_data1) == 0
+    assert len(outbox) == 1
+
+
+def test_enqueue_rolled_back(sample_data1, outbox):
+    OutboxMessage.enqueue(sample_data1, "slack", message="never sent")
+    sample_data1.rollback()
+
+    assert sample_data1.query(OutboxMessage).count() == 0
+
+
+def test_delivery_retries(sample_data1, outbox, monkeypatch):
+    def slack_message(message, raise_errors=False):
+        raise ValueError("Slack is down")
+    monkeypatch.setattr(models, "slack_message", slack_message)
+
+    OutboxMessage.enqueue(sample_data1, "slack", message="hello")
+    sample_data1.commit()
+
+    assert OutboxMessage.deliver_pending(sample_data1, max_attempts=2) == 0
+    assert OutboxMessage.deliver_pending(sample_data1, max_attempts=2) == 0
+
+    message = sample_data1.query(OutboxMessage).one()
+    assert message.attempts == 2
+    assert message.last_error == "Slack is down"
+    assert message.sent_time is None
+
+    # Once we gave up on a notification, it is no longer attempted
+    monkeypatch.setattr(models, "slack_message", outbox.append)
+    assert OutboxMessage.deliver_pending(sample_data1, max_attempts=2) == 0
+    assert outbox == []
+
+
+class FakeSMTP(object):
+    connections = []
+
+    def __init__(self, host):
+        self.host = host
+        self.sent = []
+        self.drop_next = False
+        FakeSMTP.connections.append(self)
+
+    def sendmail(self, sender, recipients, message):
+        if self.drop_next:
+            self.drop_next = False
+            raise smtplib.SMTPServerDisconnected("Connection dropped")
+        self.sent.append(recipients)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_email_delivery_reuses_connection(sample_data1, outbox, monkeypatch):
+    monkeypatch.setitem(settings.settings, "email_notifications", True)
+    monkeypatch.setitem(settings.settings, "environment", "prod")
+    monkeypatch.setattr(util.smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(FakeSMTP, "connections", [])
+
+    for index in range(5):
+        models.notify_email(
+            sample_data1, "user{}@example.com".format(index),
+            "Subject {}".format(index), "Message {}".format(index)
+        )
+    sample_data1.commit()
+
+    assert OutboxMessage.deliver_pending(sample_data1) == 5
+    assert len(FakeSMTP.connections) == 1
+    assert len(FakeSMTP.connections[0].sent) == 5
+
+
+def test_smtp_transport_reconnects(monkeypatch):
+    monkeypatch.setattr(util.smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(FakeSMTP, "connections", [])
+
+    with util.SmtpTransport(batch_size=2) as transport:
+        transport.send("hermes@localhost", ["a@example.com"], "one")
+        assert FakeSMTP.connections == []
+
+        transport.send("hermes@localhost", ["b@example.com"], "two")
+        assert len(FakeSMTP.connections) == 1
+
+        FakeSMTP.connections[0].drop_next = True
+        transport.send("hermes@localhost", ["c@example.com"], "three")
+
+    assert transport.failures == []
+    assert len(FakeSMTP.connections) == 2
+    assert FakeSMTP.connections[0].sent == [
+        ["a@example.com"], ["b@example.com"]
+    ]
+    assert FakeSMTP.connections[1].sent == [["c@example.com"]]
+
+
+def test_slack_summary():
+    assert util.summarize_slack_messages([("hello", None)]) == "hello"
+
+    assert util.summarize_slack_messages([
+        ("*Labors:* created 3 labors", {"labors_created": 3}),
+        ("*Labor 1* completed.", {
+            "labors_completed": 1, "quest_ids": [1]
+        }),
+        ("*Quest 2* completed", None),
+        ("*Labors:* completed 20 Labors", {
+            "labors_completed": 20, "quest_ids": [1, 2]
+        }),
+    ]) == (
+        "*Labors:* created 3 labors\n\n"
+        "*Labors:* 21 labors completed across 2 quests\n\n"
+        "*Quest 2* completed"
+    )
+
+
+def test_slack_sink_rate(monkeypatch):
+    posted = []
+    monkeypatch.setattr(util, "slack_message", posted.append)
+
+    # a long window keeps the background thread out of our way
+    sink = util.SlackSink(window=600, max_rate=1)
+    sink.post("first", {"labors_created": 1})
+    assert sink.flush() is True
+    assert posted == ["first"]
+
+    # we already posted this minute, so these have to wait
+    sink.post("second", {"labors_created": 2})
+    sink.post("third", {"labors_created": 3})
+    assert sink.flush() is False
+    assert posted == ["first"]
+
+    sink.last_post -= 60
+    assert sink.flush() is True
+    assert posted == ["first", "*Labors:* created 5 labors"]
+
+
+def test_slack_summary_delivery(sample_data1, outbox, monkeypatch):
+    monkeypatch.setitem(settings.settings, "slack_window", 10)
+    monkeypatch.setitem(settings.settings, "slack_max_rate", 1)
+    post = models.slack_message
+
+    def slack_message(message, raise_errors=False):
+        raise ValueError("Slack is down")
+    monkeypatch.setattr(models, "slack_message", slack_message)
+
+    def queue(*messages):
+        for message, created in messages:
+            OutboxMessage.enqueue(
+                sample_data1, "slack", message=message,
+                summary={"labors_created": created}
+            )
+        sample_data1.execute(OutboxMessage.__table__.update().values(
+            creation_time=datetime.utcnow() - timedelta(seconds=20)
+        ).where(OutboxMessage.sent_time == None))
+        sample_data1.commit()
+
+    # the messages stay queued until the summary is posted
+    queue(("one", 1), ("two", 2))
+    assert OutboxMessage.deliver_pending(sample_data1) == 0
+    assert [
+        (message.attempts, message.sent_time)
+        for message in sample_data1.query(OutboxMessage)
+    ] == [(1, None), (1, None)]
+
+    monkeypatch.setattr(models, "slack_message", post)
+    assert OutboxMessage.deliver_pending(sample_data1) == 2
+    assert outbox == ["*Labors:* created 3 labors"]
+
+    # the rate holds back the next post
+    queue(("three", 3))
+    assert OutboxMessage.deliver_pending(sample_data1) == 0
+    assert len(outbox) == 1
+
+    sample_data1.execute(OutboxMessage.__table__.update().values(
+        sent_time=datetime.utcnow() - timedelta(seconds=60)
+    ).where(OutboxMessage.sent_time != None))
+    assert OutboxMessage.deliver_pending(sample_data1) == 1
+    assert outbox[1] == "three"
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import desc
+
+from hermes.models import Event, Labor, Quest
+
+from .fixtures import db_engine, session, sample_data1
+
+
+def query_plan(session, query):
+    """Get the SQLite query plan details of an ORM query"""
+    statement = query.statement.compile(session.bind)
+    params = [statement.params[name] for name in statement.positiontup]
+    cursor = session.connection().connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN {}".format(statement), params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def assert_no_full_scan(session, query, table, index=None):
+    plan = query_plan(session, query)
+    details = [detail for detail in plan if " {} ".format(table) in detail + " "]
+    assert details, plan
+    for detail in details:
+        assert not detail.startswith("SCAN"), plan
+        if index:
+            assert "USING INDEX {} ".format(index) in detail, plan
+
+
+def test_hot_event_queries(sample_data1):
+    week_ago = datetime.utcnow() - timedelta(days=7)
+
+    # the events of a host, latest first
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Event).filter(Event.host_id == 1)
+        .order_by(desc(Event.timestamp)).limit(10),
+        "events", "event_host_time_idx"
+    )
+
+    # the recent events of some event types
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Event).filter(
+            Event.event_type_id.in_([1, 2]), Event.timestamp >= week_ago
+        ).order_by(desc(Event.timestamp)).limit(10),
+        "events", "event_type_time_idx"
+    )
+
+    # the last event of a type for a host
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Event).filter(
+            Event.event_type_id == 1, Event.host_id == 1
+        ).order_by(desc(Event.timestamp)).limit(1),
+        "events"
+    )
+
+    # the events of a bulk creation
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Event).filter(Event.tx == 1),
+        "events"
+    )
+
+
+def test_hot_labor_queries(sample_data1):
+    # the open labors of some hosts, when evaluating Fates
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Labor).filter(
+            Labor.completion_time == None, Labor.host_id.in_([1, 2])
+        ),
+        "labors", "labor_host_completion_idx"
+    )
+
+    # the open labors of a quest, when checking for victory
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Labor).filter(
+            Labor.quest_id == 1, Labor.completion_event_id == None
+        ),
+        "labors", "labor_quest_completion_idx"
+    )
+
+
+def test_hot_quest_queries(sample_data1):
+    # the open quests, with their progress counters
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Quest).filter(Quest.completion_time == None),
+        "quests", "quest_completion_idx"
+    )
+
+    # the quests touching some hosts, answered from the labors by host
+    assert_no_full_scan(
+        sample_data1,
+        sample_data1.query(Quest).filter(Quest.touching_hosts([1, 2])),
+        "labors", "labor_host_quest_idx"
+    )
@@ -1,8 +1,9 @@
 import pytest
 from sqlalchemy.exc import IntegrityError
 
-from hermes import exc
+from hermes import exc, models
 from hermes.models import EventType, Host, Quest, Labor, Event, Fate
+from hermes.models import QuestJob
 
 from datetime import datetime, timedelta
 
@@ -679,5 +680,126 @@ def test_explicit_chain(sample_data2):
     assert len(charlie_quest.labors) == 1
 
 
+def test_progress_counters(sample_data2):
+    hosts = [sample_data2.query(Host).get(1), sample_data2.query(Host).get(2)]
+    needed = EventType.get_event_type(
+        sample_data2, "system-maintenance", "needed"
+    )
+
+    def progress(quest):
+        return (
+            quest.labor_count, quest.closed_labor_count,
+            quest.starting_labor_count, quest.unstarted_labor_count,
+            quest.inprogress_labor_count
+        )
+
+    quest = Quest.create(
+        sample_data2, "testman", hosts, fate_id=1,
+        description="Servers need audit"
+    )
+    assert progress(quest) == (2, 0, 2, 2, 0)
+
+    # closing a labor chains a new one
+    Event.create(sample_data2, hosts[0], "system", needed)
+    assert progress(quest) == (3, 1, 2, 1, 1)
+    assert quest.calculate_progress({}) == {
+        "totalLabors": 2,
+        "unstartedLabors": 1,
+        "inprogressLabors": 1,
+        "completedLabors": 0,
+        "percentComplete": 33.33,
+    }
+
+    # labors claimed by another quest move over to it
+    audit = EventType.get_event_type(
+        sample_data2, "system-maintenance", "audit"
+    )
+    Event.create(sample_data2, hosts[1], "system", audit)
+    other = Quest.create(
+        sample_data2, "testman", [hosts[1]], fate_id=1, create=False,
+        description="Reclaimed audit"
+    )
+    assert progress(other) == (2, 0, 2, 2, 0)
+    assert progress(quest) == (2, 1, 1, 0, 1)
+
+    assert Quest.get_progress(sample_data2, [quest.id, other.id]) == dict(
+        (q.id, dict(zip(Quest._progress_columns, progress(q))))
+        for q in (quest, other)
+    )
+    assert Quest.repair_progress(sample_data2) == []
+
+    sample_data2.execute(Quest.__table__.update().values(labor_count=0))
+    assert Quest.repair_progress(sample_data2) == [quest.id, other.id]
+    assert progress(quest) == (2, 1, 1, 0, 1)
+    assert progress(other) == (2, 0, 2, 2, 0)
 
 
+def test_reclaim(sample_data2):
+    hosts = sample_data2.query(Host).order_by(Host.id).all()
+    audit, needed, _, _, reboot = (
+        sample_data2.query(EventType).order_by(EventType.id).all()[:5]
+    )
+
+    Event.create(sample_data2, hosts[0], "system", audit)
+    Event.create(sample_data2, hosts[1], "system", audit)
+    Event.create(sample_data2, hosts[0], "system", reboot)
+    Event.create(sample_data2, hosts[2], "system", audit)
+    Event.create(sample_data2, hosts[2], "system", needed)
+    audit_labor = sample_data2.query(Labor).filter(
+        Labor.host_id == hosts[0].id, Labor.fate_id == 1
+    ).one()
+
+    # only the open labors of the quest hosts started by the quest's fate
+    # are claimed
+    quest = Quest.create(
+        sample_data2, "testman", [hosts[0], hosts[2]], fate_id=1,
+        create=False, description="Reclaimed audit"
+    )
+    assert [labor.id for labor in quest.labors] == [audit_labor.id]
+    assert sample_data2.query(Labor).filter(
+        Labor.quest_id != None
+    ).count() == 1
+    assert quest.calculate_progress({})["unstartedLabors"] == 1
+    assert Quest.repair_progress(sample_data2) == []
+
+
+def test_job_holds_victory(sample_data1, monkeypatch):
+    monkeypatch.setattr(models, "HOST_CHUNK_SIZE", 1)
+    example, sample = sample_data1.query(Host).order_by(Host.id).all()[:2]
+    completed = sample_data1.query(EventType).get(2)
+
+    job = QuestJob.create(
+        sample_data1, creator="testman@example.com", fate_id=1,
+        description="Reboots", host_count=2
+    )
+    host_ids = [example.id, sample.id]
+    assert job.run_step(host_ids)
+    assert job.run_step(host_ids)
+    quest = sample_data1.query(Quest).get(job.quest_id)
+
+    # closing all the labors so far doesn't complete the quest while
+    # the job is still adding hosts to it
+    Event.create(sample_data1, example, "system", completed)
+    assert quest.completion_time is None
+    assert job.run_step(host_ids)
+    Event.create(sample_data1, sample, "system", completed)
+    assert quest.completion_time is None
+
+    assert not job.run_step(host_ids)
+    assert job.status == "completed"
+    assert quest.labor_count == 2
+    assert quest.completion_time is not None
+
+
+def test_abandoned_job(sample_data1):
+    job = QuestJob.create(
+        sample_data1, creator="testman@example.com", fate_id=1,
+        description="Reboots", host_count=2
+    )
+    assert not job.check_abandoned()
+    assert job.status == "pending"
+
+    job.update(update_time=datetime.utcnow() - timedelta(hours=1))
+    assert job.check_abandoned()
+    assert job.status == "failed"
+    assert job.error.startswith("Abandoned")